@@ -0,0 +1,133 @@
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve, LinAlgError
+from box.dummymixer import DummyMixer
+
+class BroydenMixer(DummyMixer):
+    """ A class for modified Broyden mixing, as described in
+        D.D. Johnson, Phys. Rev. B 38, 12807 (1988).
+
+        Compared to Anderson mixing, the history is weighted by the
+        inverse residuals and the update is regularized with w0, which
+        keeps it stable when the history becomes nearly linearly dependent. """
+
+
+    def __init__(self, mixing_constant=0.2, memory=8, convergence=1e-3, chop=None, w0=0.01):
+        DummyMixer.__init__(self, mixing_constant, convergence)
+        self.name = 'Broyden'
+        self.memory = memory
+        self.chop = chop
+        self.w0 = w0
+
+
+    def reset(self):
+        DummyMixer.reset(self)
+        self.dF = []
+        self.u = []
+        self.w = []
+        self.x_last = None
+        self.F_last = None
+
+
+    def precondition(self, F):
+        """ Return the preconditioned residual; no preconditioning here. """
+        return F
+
+
+    def _weight(self, F):
+        """ Weight of the iteration with residual F (larger for small residuals). """
+        return min(max(0.01/np.sqrt(np.dot(F,F)), 1.0), 1E5)
+
+
+    def __call__(self, xi, yi):
+        self.it += 1
+        F = yi - xi
+        PF = self.beta*self.precondition(F)
+
+        if self.F_last is not None:
+            # normalized differences with the previous iteration
+            dF = F - self.F_last
+            norm = np.sqrt(np.dot(dF,dF))
+            if norm>0:
+                dF = dF/norm
+                dx = (xi - self.x_last)/norm
+                self.dF.append(dF)
+                self.u.append(self.beta*self.precondition(dF) + dx)
+                self.w.append(self._weight(F))
+                if len(self.dF)>self.memory:
+                    self.dF.pop(0)
+                    self.u.pop(0)
+                    self.w.pop(0)
+        self.x_last = xi.copy()
+        self.F_last = F.copy()
+
+        xb = xi + PF
+        if len(self.dF)>0:
+            dF = np.array(self.dF)
+            w = np.array(self.w)
+            # a_kl = w_k w_l <dF_k|dF_l>, beta = (w0^2 + a)^-1, gamma_l = sum_k c_k beta_kl
+            a = np.outer(w,w)*np.dot(dF,dF.transpose())
+            c = w*np.dot(dF,F)
+            try:
+                gamma = np.linalg.solve(self.w0**2*np.eye(len(w)) + a, c)
+                xb -= np.dot(w*gamma, np.array(self.u))
+            except np.linalg.LinAlgError:
+                # singular history, use simple mixing in this step.
+                pass
+
+        # The input must not change more than chop for all
+        maxdev=max(abs(xb-xi))
+        if self.chop!=None and maxdev>self.chop:
+            xb = xi + self.chop/maxdev*(xb-xi)
+
+        fmax = abs(F).max()
+        self.fmax.append(fmax)
+        if fmax<self.convergence:
+            return True, xb
+        else:
+            return False, xb
+
+
+
+class KerkerMixer(BroydenMixer):
+    """ Modified Broyden mixing with a Kerker-like preconditioner.
+
+        In metals the long-wavelength charge sloshing is what makes
+        the SCC cycle slow. Kerker preconditioning damps it by
+        q^2/(q^2+q0^2) = (1 + q0^2/(4 pi) v(q))^-1, with v the Coulomb
+        kernel. Here the gamma matrix plays the role of v, and the
+        residual is preconditioned by
+
+            P = (1 + dos*gbar) (1 + dos*gamma)^-1,
+
+        where gbar is the mean on-site gamma. Local charge transfer is
+        mixed as usual and long-range transfer is damped.
+
+        dos:    estimate of the density of states per atom at the Fermi
+                level (1/Hartree), controls the strength of the damping;
+                dos=0 is plain Broyden mixing.
+
+        The gamma matrix is given with set_gamma (done by the Solver
+        for each geometry); without it no preconditioning is done. """
+
+
+    def __init__(self, mixing_constant=0.2, memory=8, convergence=1e-3, chop=None, w0=0.01, dos=1.0):
+        BroydenMixer.__init__(self, mixing_constant, memory, convergence, chop, w0)
+        self.name = 'Kerker'
+        self.dos = dos
+        self.lu = None
+
+
+    def set_gamma(self, G):
+        """ Set the gamma matrix (in Hartree) used in the preconditioner. """
+        G = np.asarray(G)
+        self.scale = 1.0 + self.dos*np.mean(G.diagonal())
+        try:
+            self.lu = lu_factor(np.eye(len(G)) + self.dos*G)
+        except (LinAlgError,ValueError):
+            self.lu = None
+
+
+    def precondition(self, F):
+        if self.lu is None or len(F)!=len(self.lu[1]):
+            return F
+        return self.scale*lu_solve(self.lu, F)
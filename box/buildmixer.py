@@ -1,7 +1,9 @@
 from box.misc import AndersonMixer
 from box.pulay import PulayMixer
+from box.broyden import BroydenMixer, KerkerMixer
 
-mixers = {'pulay':PulayMixer, 'anderson':AndersonMixer}
+mixers = {'pulay':PulayMixer, 'anderson':AndersonMixer,
+          'broyden':BroydenMixer, 'kerker':KerkerMixer}
 
 def BuildMixer(params):
     if params == None:
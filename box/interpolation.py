@@ -9,6 +9,7 @@ from scipy.interpolate import splprep
 from scipy.interpolate import splrep
 from scipy.interpolate import splev
 from scipy.interpolate import splint
+from scipy.linalg import solve_banded
 try:
     import pylab as pl
 except:
@@ -16,6 +17,31 @@ except:
 vec=np.array
 linspace=np.linspace
 
+
+def natural_spline_second_derivatives(x,y):
+    """
+    Return the second derivatives of natural cubic spline(s).
+
+    The tridiagonal system for the interior points is solved with a
+    banded solver; y can be (n,) or (n,m) for m functions on the same grid.
+    """
+    x=np.asarray(x,float)
+    y=np.asarray(y,float)
+    n=len(x)
+    d2=np.zeros(y.shape)
+    if n<3:
+        return d2
+    sig = (x[1:-1]-x[:-2])/(x[2:]-x[:-2])
+    ab = np.zeros((3,n-2))
+    ab[0,1:]  = 1-sig[:-1]
+    ab[1,:]   = 2.0
+    ab[2,:-1] = sig[1:]
+    dy = (y[1:]-y[:-1])/np.reshape(x[1:]-x[:-1],(-1,)+(1,)*(y.ndim-1))
+    rhs = 6*(dy[1:]-dy[:-1])/np.reshape(x[2:]-x[:-2],(-1,)+(1,)*(y.ndim-1))
+    d2[1:-1] = solve_banded((1,1),ab,rhs)
+    return d2
+
+
 class MultipleSplineFunction:
     """ Class for interpolating many functions at the same time on the same grid.
 
@@ -37,17 +63,20 @@ class MultipleSplineFunction:
         self.labels=[]
         self.indices=[]
         self.y=[]
+        self.d2=[]
         self.initialized=False
         self.m=0
 
-    def add_function(self,y,label='',index=0):
+    def add_function(self,y,label='',index=0,d2=None):
         """ Add function on the same x-grid.
 
         label: characterizes the function and
         index: some additional number to characterize function (used for speed-up)
+        d2:    precomputed second derivatives of the spline (optional)
         """
         assert not self.initialized
         self.y.append(y)
+        self.d2.append(d2)
         self.labels.append(label)
         self.indices.append(index)
         self.m+=1
@@ -70,34 +99,16 @@ class MultipleSplineFunction:
         assert not self.initialized
         self.initialized=True
 
-        self.d2=[]
-        n=self.n
-        for i in range(self.m):
-            u=np.zeros_like(self.x)
-            d2=np.zeros_like(self.x)
-            y=self.y[i]
-            x=self.x
-            qn       = 0.0
-            un       = 0.0
-
-            if len(x) != len(y):
+        for y in self.y:
+            if len(self.x) != len(y):
                 raise RuntimeError('x- and y-tables need to have identical '
                                    'numbers of entries. Here x: %i, y: %i.' % \
-                                       ( len(x), len(y) ))
-
-            # Solve the second derivatives
-            for i in range(1,n-1):
-                sig  = (x[i]-x[i-1])/(x[i+1]-x[i-1])
-                p    = sig*d2[i-1]+2
-                d2[i]= (sig-1)/p
-                u[i] = ( 6*((y[i+1]-y[i])/(x[i+1]-x[i])-(y[i]-y[i-1])/(x[i]-x[i-1]))/(x[i+1]-x[i-1])-sig*u[i-1] )/p
-
-            d2[n-1]=(un-qn*u[n-2])/(qn*d2[n-2]+1)
-            for i in range(n-1)[::-1]:
-                d2[i]=d2[i]*d2[i+1]+u[i]
-            self.d2.append(d2)
-        self.d2=np.array(self.d2)
-        self.y=np.array(self.y)
+                                       ( len(self.x), len(y) ))
+        self.y=np.array(self.y).reshape(self.m,self.n)
+        if self.m>0 and all([d2 is not None for d2 in self.d2]):
+            self.d2=np.array(self.d2).reshape(self.m,self.n)
+        else:
+            self.d2=natural_spline_second_derivatives(self.x,self.y.transpose()).transpose()
 
 
     def get_range(self):
@@ -139,46 +150,46 @@ class MultipleSplineFunction:
                (If x is outside the interpolation range, return 0's)
         der:   if None, return both function values and derivatives. If 0,1,2:
                return function values, first, or second derivatives.
+
+        For scalar x the returned arrays have shape (m,), for x-array
+        the shape is (m,len(x)), m being the number of functions.
         """
         if not self.initialized:
             self._initialize()
 
-        #if x<self.x[0] or x>=self.x[-1]:
-        #    if der==None:
-        #        return np.zeros((self.m,)),np.zeros((self.m))
-        #    else:
-        #        return np.zeros((self.m,))
-
-        hi = np.searchsorted(self.x, x)
-        lo = hi-1
-        #assert xlo<=x<=xhi
-
-        # If x > cutoff, descrease hi. In this case hi == lo and all
-        # returned values will be zero.
-        if isinstance(x, np.ndarray):
-            hi = np.where(hi == len(self.x), hi-1, hi)
-        else:
-            if hi == len(self.x):
-                hi -= 1
+        scalar = np.ndim(x)==0
+        x = np.atleast_1d(np.asarray(x,float))
 
-        xlo, xhi = self.x[lo], self.x[hi]
+        # the grid is linear: find the bins directly
+        h = self.h
+        lo = np.floor((x-self.xmin)/h).astype(int)
+        lo = np.clip(lo,0,self.n-2)
+        hi = lo+1
+        outside = (x<self.xmin) | (x>self.xmax)
 
-        h=self.h
-        a, b=(xhi-x)/h, (x-xlo)/h
+        a, b=(self.x[hi]-x)/h, (x-self.x[lo])/h
         ylo, yhi=self.y[:,lo], self.y[:,hi]
         dlo, dhi=self.d2[:,lo], self.d2[:,hi]
 
-        y=a*ylo + b*yhi + ((a**3-a)*dlo+(b**3-b)*dhi)*(h**2)/6
-        dy=(yhi-ylo)/h - (3*a**2-1)/6*h*dlo + (3*b**2-1)/6*h*dhi
+        ret = []
+        if der==None or der==0:
+            y=a*ylo + b*yhi + ((a**3-a)*dlo+(b**3-b)*dhi)*(h**2)/6
+            ret.append(y)
+        if der==None or der==1:
+            dy=(yhi-ylo)/h - (3*a**2-1)/6*h*dlo + (3*b**2-1)/6*h*dhi
+            ret.append(dy)
+        if der==2:
+            ret.append( a*dlo + b*dhi )
+
+        for r in ret:
+            r[:,outside] = 0.0
+        if scalar:
+            ret = [r[:,0] for r in ret]
 
         if der==None:
-            return y,dy
-        elif der==0:
-            return y
-        elif der==1:
-            return dy
-        elif der==2:
-            return a*self.d2[:,lo] + b*self.d2[:,hi]
+            return ret[0],ret[1]
+        else:
+            return ret[0]
 
 
 class FastSplineFunction:
@@ -201,24 +212,8 @@ class FastSplineFunction:
         self.y=y
         self.a=x[0]
         self.b=x[-1]
-        d2=np.zeros_like(y)
-        u=np.zeros_like(y)
-        n=len(x)
-        qn       = 0.0
-        un       = 0.0
-
-        # Solve the second derivatives
-        for i in range(1,n-1):
-            sig  = (x[i]-x[i-1])/(x[i+1]-x[i-1])
-            p    = sig*d2[i-1]+2
-            d2[i]= (sig-1)/p
-            u[i] = ( 6*((y[i+1]-y[i])/(x[i+1]-x[i])-(y[i]-y[i-1])/(x[i]-x[i-1]))/(x[i+1]-x[i-1])-sig*u[i-1] )/p
-
-        d2[n-1]=(un-qn*u[n-2])/(qn*d2[n-2]+1)
-        for i in range(n-1)[::-1]:
-            d2[i]=d2[i]*d2[i+1]+u[i]
-        self.n=n
-        self.d2=d2
+        self.n=len(x)
+        self.d2=natural_spline_second_derivatives(x,y)
         self.grid=grid
         self.xmin, self.xmax=x[0], x[-1]
         if grid=='linear':
@@ -262,7 +257,7 @@ class FastSplineFunction:
 
 
 class SplineFunction:
-    def __init__(self,x,y,k=3,s=0,name=None):
+    def __init__(self,x,y,k=3,s=0,name=None,tck=None):
         """ Simple B-spline function; order k is cubic by default.
 
         Parameters:
@@ -272,11 +267,14 @@ class SplineFunction:
         k:  order of spline (cubic by default)
         s:  smoothness parameters (means exact reproduction of x,y values)
         name: name of the function
+        tck: precomputed B-spline representation (t,c,k) of splrep(x,y,s=s,k=k)
 
         """
         if s==-1:
             s=len(x)-np.sqrt(2.0*len(x))
-        self.tck=splrep(x,y,s=s,k=k)
+        if tck is None:
+            tck=splrep(x,y,s=s,k=k)
+        self.tck=tck
         self.x=x
         self.y=y
         self.a=x[0]
@@ -87,8 +87,11 @@ class Hotbit(Output):
                           * If tables['AB']==None, ignore interactions for A and B
                             (both chemical and repulsive)
 
-        mixer:            Density mixer.
+        mixer:            Density mixer ('Anderson', 'Pulay', 'Broyden' or 'Kerker').
                           example: {'name':'Anderson','mixing_constant':0.2, 'memory':5}.
+                          'Kerker' is Broyden with the residual preconditioned by
+                          the gamma matrix, which damps charge sloshing in metals
+                          (see box.broyden.KerkerMixer).
         charge:           Total charge for system (-1 means an additional electron)
         width:            Width of Fermi occupation (eV)
         SCC:              Self-Consistent Charge calculation
@@ -178,7 +181,18 @@ class Hotbit(Output):
             'tol_imaginary_e': 1E-13,    # tolerance for imaginary band energy
             'tol_mulliken':1E-5,         # tolerance for mulliken charge sum deviation from integer
             'tol_eigenvector_norm':1E-6, # tolerance for eigenvector norm for eigensolver
-            'symop_range':5              # range for the number of symmetry operations in all symmetries
+            'tol_occupation':1E-13,      # leave states with smaller occupations out of density matrices
+            'symop_range':5,             # range for the number of symmetry operations in all symmetries
+            'eigensolver_workers':1,     # number of parallel workers for diagonalizing k-points
+            'eigensolver_pool':'thread', # 'thread' or 'process' pool for eigensolver workers
+            'norm_check_interval':1,     # check eigenvector norms for every n'th diagonalization (0=never)
+            'eigensolver':'geig',        # 'geig' or 'cholesky' (reuse Cholesky factors of S in SCC iterations)
+            'eigensolver_buffer':None,   # with 'cholesky', solve only the lowest occupied+buffer states in intermediate SCC iterations
+            'sparse_gamma':False,        # store the derivatives of the gamma correction as a pair list
+            'smearing':'fermi',          # occupation smearing: 'fermi', 'methfessel-paxton' or 'cold'
+            'smearing_order':1,          # order of Methfessel-Paxton smearing
+            'dq_extrapolation':'linear', # initial charges from previous solutions: 'linear', 'aspc' or 'xlbomd'
+            'dq_extrapolation_order':5   # order of 'aspc' (0...8) or 'xlbomd' (3...7) extrapolation
         }              
         internal0.update(internal)
         for key in internal0:
@@ -196,6 +210,13 @@ class Hotbit(Output):
                 self.txt.flush()
             except:
                 pass
+        try:
+            kt = self.st.solver.get_k_timings(total=True)
+            if kt is not None and len(kt)>1:
+                print('Eigensolver time per k-point: avg %.3f, min %.3f, max %.3f s' \
+                      %(kt.mean(),kt.min(),kt.max()), file=self.txt)
+        except:
+            pass
         if len(self.notes)>0:
             print('Notes and warnings:', file=self.txt)
             for note in self.notes:
@@ -385,8 +406,8 @@ class Hotbit(Output):
         else:
             number = 8. #real
         M = self.st.nk*self.st.norb**2*number
-        #     H   S   dH0   dS    wf  H1  dH   rho rhoe
-        mem = M + M + 3*M + 3*M + M + M + 3*M + M + M
+        #     H   S   wf  H1  rho rhoe  (dH0 and dS are not constructed)
+        mem = M + M + M + M + M + M
         print('Memory consumption estimate: > %.2f GB' %(mem/1E9), file=self.txt)
         self.txt.flush()
         if self.dry_run:
@@ -542,10 +563,30 @@ class Hotbit(Output):
 
 
     def get_stress(self,atoms):
-        self.solve_ground_state(atoms)
-        # TODO: ASE needs an array from this method, would it be proper to
-        # somehow inform that the stresses are not calculated?
-        return np.zeros((6,))
+        """
+        Return the stress tensor (in eV/Angstrom^3) in Voigt order
+        (xx, yy, zz, yz, xz, xy).
+
+        sigma = W/V, where the virial W_ab = sum_(i,j,n) rijn_a dE/drijn_b
+        is accumulated from the same pair terms as the forces:
+        band structure, electrostatics, repulsion and pair potentials.
+        Implemented only for Bravais containers.
+        """
+        if self.calculation_required(atoms,['stress']):
+            self.solve_ground_state(atoms)
+            if self.el.atoms.container.type!='Bravais':
+                raise NotImplementedError('Stress is implemented only for Bravais containers.')
+            self.start_timing('stress')
+            Wbs = self.st.get_band_structure_virial()
+            Wrep = self.rep.get_repulsive_virial()
+            Wcoul = self.st.es.gamma_virial() #zero for non-SCC
+            Wpp = self.pp.get_virial()
+            self.stop_timing('stress')
+            W = (Wbs+Wrep+Wcoul+Wpp)*Hartree
+            W = 0.5*(W+W.transpose())
+            self.stress = np.array([W[0,0],W[1,1],W[2,2],W[1,2],W[0,2],W[0,1]])/self.el.atoms.get_volume()
+            self.el.set_solved('stress')
+        return self.stress.copy()
 
 
     def get_charge(self):
@@ -0,0 +1,243 @@
+"""
+Block-sparse storage of the real-space Hamiltonian and overlap matrices.
+"""
+
+# Copyright (C) 2008 NSC Jyvaskyla
+# Please see the accompanying LICENSE file for further information.
+
+import numpy as np
+
+
+def run_starts(i, j):
+    """
+    Return the indices where runs of identical (i,j) start.
+
+    Pairs have to be sorted with respect to (i,j).
+    """
+    if len(i)==0:
+        return np.zeros((0,),int)
+    new = np.ones(len(i),bool)
+    new[1:] = (i[1:]!=i[:-1]) | (j[1:]!=j[:-1])
+    return np.flatnonzero(new)
+
+
+
+class BlockMatrices:
+    def __init__(self, first_orbitals, nr_orbitals, onsite, seps=0.0):
+        """
+        Block-sparse Hamiltonian and overlap.
+
+        The matrix elements between atoms i and j, when j is operated by
+        symmetry operation n, are stored as dense blocks of size noi x noj,
+        only for interacting (i,j,n) with i<=j. Blocks are grouped by element
+        pair, so that within a group all blocks have the same shape and
+        they can be stacked into arrays (npairs,noi,noj). Within a group
+        the blocks are sorted by (i,j,n).
+
+        Dense k-space matrices are constructed only on demand (get_dense).
+
+        parameters:
+        ===========
+        first_orbitals: index of the first orbital for each atom
+        nr_orbitals:    number of orbitals for each atom
+        onsite:         on-site energies for all orbitals
+        seps:           add this to the diagonal of S
+        """
+        self.o1 = np.asarray(first_orbitals,int)
+        self.no = np.asarray(nr_orbitals,int)
+        self.onsite = np.asarray(onsite,float)
+        self.norb = len(self.onsite)
+        self.seps = seps
+        self.groups = {}
+
+
+    def add_group(self, key, i, j, n, h, s, dh, ds, rij=None):
+        """
+        Add blocks for one element pair.
+
+        parameters:
+        ===========
+        key:     element pair, e.g. 'CH'
+        i,j,n:   atom and symmetry operation indices of the blocks
+        h,s:     blocks (npairs,noi,noj)
+        dh,ds:   block derivatives with respect to the vector rijn (npairs,noi,noj,3)
+                 (None if derivatives are not needed)
+        rij:     the vectors rijn (npairs,3), needed for the virial
+        """
+        self.groups[key] = { 'i':np.asarray(i,int),
+                             'j':np.asarray(j,int),
+                             'n':np.asarray(n,int),
+                             'h':h, 's':s, 'dh':dh, 'ds':ds, 'rij':rij }
+
+
+    def get_groups(self):
+        """ Return the dictionary of block groups. """
+        return self.groups
+
+
+    def has_derivatives(self):
+        """ Are the block derivatives stored? """
+        return all( [g['dh'] is not None for g in self.groups.values()] )
+
+
+    def get_number_of_blocks(self):
+        """ Return the total number of stored (i,j,n) blocks. """
+        return sum( [len(g['i']) for g in self.groups.values()] )
+
+
+    def _orbital_indices(self, i, j, noi, noj):
+        """ Return row and column orbital indices (npairs,noi,1), (npairs,1,noj) of blocks. """
+        rows = self.o1[i].reshape(-1,1)+np.arange(noi).reshape(1,-1)
+        cols = self.o1[j].reshape(-1,1)+np.arange(noj).reshape(1,-1)
+        return rows[:,:,None], cols[:,None,:]
+
+
+    def get_dense(self, phases, Rot, derivatives=True):
+        """
+        Return dense H0(k), S(k) and (optionally) the derivatives dH0(k), dS(k).
+
+        Blocks with the same (i,j) are first summed over symmetry operations;
+        the lower triangle is filled with the Hermitian conjugates. With
+        dH0[k,m,l,:] the derivative of H0[k,m,l] with respect to the position
+        of the atom orbital m sits on.
+
+        parameters:
+        ===========
+        phases:      phases[n,k] for symmetry operations and k-points
+        Rot:         rotation matrices Rot[n] of symmetry operations
+        derivatives: if False, return None for dH0 and dS
+        """
+        phases = np.asarray(phases)
+        nk = phases.shape[1]
+        norb = self.norb
+        H0 = np.zeros((nk,norb,norb),complex)
+        S  = np.zeros((nk,norb,norb),complex)
+        diag = np.arange(norb)
+        H0[:,diag,diag] = self.onsite
+        S[:,diag,diag] = 1.0 + self.seps
+        if derivatives:
+            dH0 = np.zeros((nk,norb,norb,3),complex)
+            dS  = np.zeros((nk,norb,norb,3),complex)
+        else:
+            dH0, dS = None, None
+
+        for g in self.groups.values():
+            if len(g['i'])==0:
+                continue
+            starts = run_starts(g['i'],g['j'])
+            i, j = g['i'][starts], g['j'][starts]
+            noi, noj = g['h'].shape[1:3]
+            rows, cols = self._orbital_indices(i,j,noi,noj)
+            # transposed indices for the Hermitian conjugates (i!=j only)
+            off = i!=j
+            rowsT = cols[off].transpose((0,2,1))
+            colsT = rows[off].transpose((0,2,1))
+            if derivatives:
+                # derivatives with respect to the position of atom j
+                dh2 = np.einsum('pabx,pxy->paby',g['dh'],Rot[g['n']])
+                ds2 = np.einsum('pabx,pxy->paby',g['ds'],Rot[g['n']])
+
+            for k in range(nk):
+                ph = phases[g['n'],k]
+                hk = np.add.reduceat(ph[:,None,None]*g['h'],starts,axis=0)
+                sk = np.add.reduceat(ph[:,None,None]*g['s'],starts,axis=0)
+                H0[k][rows,cols] += hk
+                S[k][rows,cols] += sk
+                H0[k][rowsT,colsT] += hk[off].transpose((0,2,1)).conj()
+                S[k][rowsT,colsT] += sk[off].transpose((0,2,1)).conj()
+
+                if derivatives:
+                    ph4 = ph[:,None,None,None]
+                    dH0[k][rows,cols] -= np.add.reduceat(ph4*g['dh'],starts,axis=0)
+                    dS[k][rows,cols] -= np.add.reduceat(ph4*g['ds'],starts,axis=0)
+                    dh2k = np.add.reduceat(ph4*dh2,starts,axis=0)[off]
+                    ds2k = np.add.reduceat(ph4*ds2,starts,axis=0)[off]
+                    dH0[k][rowsT,colsT] += dh2k.transpose((0,2,1,3)).conj()
+                    dS[k][rowsT,colsT] += ds2k.transpose((0,2,1,3)).conj()
+
+        return H0, S, dH0, dS
+
+
+    def _pair_gradients(self, phases, Rot, wk, rho, rhoe, H1=None):
+        """
+        Yield (group, Fi, Fj, off) for each group of blocks.
+
+        Fi[p] is the band structure force on atom i of block p, and Fj
+        the force on atom j for the blocks off (those with i!=j).
+        See get_forces for the parameters.
+        """
+        for g in self.groups.values():
+            if len(g['i'])==0:
+                continue
+            i, j, n = g['i'], g['j'], g['n']
+            noi, noj = g['h'].shape[1:3]
+            rows, cols = self._orbital_indices(i,j,noi,noj)
+            off = np.flatnonzero(i!=j)
+            rowsT, colsT = rows[off], cols[off]
+            # derivatives with respect to the position of atom j
+            dh2 = np.einsum('pmlx,pxy->pmly',g['dh'][off],Rot[n[off]])
+            ds2 = np.einsum('pmlx,pxy->pmly',g['ds'][off],Rot[n[off]])
+            if H1 is not None:
+                H1ml = H1[rows,cols]
+                H1lm = H1[colsT,rowsT]
+
+            Fi = np.zeros((len(i),3),complex)
+            Fj = np.zeros((len(off),3),complex)
+            for k in range(len(wk)):
+                ph = wk[k]*phases[n,k]
+                # orbital m on atom i, orbital l on atom j:
+                # contributions dH0_ml = -ph*dh_ml to atom i...
+                rho_lm = rho[k][cols,rows]
+                X_ml = -rhoe[k][cols,rows]
+                if H1 is not None:
+                    X_ml = X_ml + H1ml*rho_lm
+                Fi += ph[:,None]*( np.einsum('pmla,pml->pa',g['dh'],rho_lm) + \
+                                   np.einsum('pmla,pml->pa',g['ds'],X_ml) )
+                # ...and dH0_lm = conj(ph*dh2_ml) to atom j
+                rho_ml = rho[k][rowsT,colsT]
+                X_lm = -rhoe[k][rowsT,colsT]
+                if H1 is not None:
+                    X_lm = X_lm + H1lm*rho_ml
+                Fj -= ph[off].conj()[:,None]*( np.einsum('pmla,pml->pa',dh2,rho_ml) + \
+                                               np.einsum('pmla,pml->pa',ds2,X_lm) )
+            yield g, 2*Fi.real, 2*Fj.real, off
+
+
+    def get_forces(self, phases, Rot, wk, rho, rhoe, H1=None):
+        """
+        Return the band structure forces directly from the block derivatives.
+
+        F_I = - sum_k w_k sum_(m in I) sum_l [ dH(k)_ml rho(k)_lm - dS(k)_ml rhoe(k)_lm ] + c.c.,
+
+        where dH = dH0 + H1*dS; the same as with the dense derivatives of
+        get_dense, but dH0(k) and dS(k) are never constructed.
+
+        parameters:
+        ===========
+        phases:  phases[n,k] for symmetry operations and k-points
+        Rot:     rotation matrices Rot[n] of symmetry operations
+        wk:      k-point weights
+        rho:     density matrices rho[k]
+        rhoe:    energy-weighted density matrices rhoe[k]
+        H1:      the SCC part of the Hamiltonian, H = H0 + H1*S (None for non-SCC)
+        """
+        F = np.zeros((len(self.o1),3))
+        for g, Fi, Fj, off in self._pair_gradients(phases,Rot,wk,rho,rhoe,H1):
+            np.add.at(F, g['i'], Fi)
+            np.add.at(F, g['j'][off], Fj)
+        return F
+
+
+    def get_virial(self, phases, Rot, wk, rho, rhoe, H1=None):
+        """
+        Return the band structure virial W_ab = sum_(i,j,n) rijn_a dE/drijn_b.
+
+        The force Fi on atom i of block (i,j,n) equals dE/drijn; blocks with
+        i==j are listed for both n and -n, hence they get the factor 1/2.
+        Valid for pure translations (Bravais); parameters as for get_forces.
+        """
+        W = np.zeros((3,3))
+        for g, Fi, Fj, off in self._pair_gradients(phases,Rot,wk,rho,rhoe,H1):
+            w = np.where(g['i']==g['j'],0.5,1.0)
+            W += np.dot(g['rij'].transpose()*w,Fi)
+        return W
@@ -1,3 +1,4 @@
 from hotbit.coulomb.direct_coulomb import DirectCoulomb
 from hotbit.coulomb.ewald_sum import EwaldSum
 from hotbit.coulomb.multipole_expansion import MultipoleExpansion
+from hotbit.coulomb.particle_mesh_ewald import ParticleMeshEwald
@@ -2,11 +2,40 @@
 Coulomb base class.
 """
 
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from hotbit.symmetrycache import symmetry_key
+
+
+def pair_operator(nat, il, jl, w):
+    """
+    Return the sparse matrix A with A(i, j) = sum of w over pairs (i, j).
+
+    Used to turn charge-independent pair kernels into a linear operator,
+    such that e.g. the potential is phi = A*q.
+    """
+    return csr_matrix((w, (il, jl)), shape=(nat, nat))
+
 
 class Coulomb:
     def __init__(self):
         pass
 
+    def _geometry_key(self, a):
+        """
+        Return a key that changes whenever the geometry (positions, cell,
+        symmetry operations) changes.
+
+        Quantities cached with this key depend only on the geometry; during
+        SCC iterations only the charges change and the cache is reused.
+        """
+        key = [ a.get_positions().tobytes(), np.asarray(a.get_cell()).tobytes(),
+                tuple(a.get_pbc()) ]
+        if hasattr(a, 'container'):
+            key.append( symmetry_key(a) )
+        return tuple(key)
+
     def get_potential(self, a=None):
         """
         Return the electrostatic potential for each atom.
@@ -20,6 +49,12 @@ class Coulomb:
         """
         raise NotImplementedError()
 
+    def get_virial(self, a=None):
+        """
+        Return the virial of the Coulomb interaction (needed for the stress).
+        """
+        raise NotImplementedError()
+
     def get_gamma(self, a=None):
         """
         Return the gamma correlation matrix, i.e. phi(i) = gamma(i, j)*q(j).
@@ -19,7 +19,7 @@ from scipy.special import erfc
 from hotbit.neighbors import get_neighbors
 from box.timing import Timer
 
-from hotbit.coulomb.baseclass import Coulomb
+from hotbit.coulomb.baseclass import Coulomb, pair_operator
 
 # diag_indices_from was introduced in numpy 1.4.0
 if hasattr(np, 'diag_indices_from'):
@@ -54,23 +54,53 @@ class DirectCoulomb(Coulomb):
         self.r_av  = None
         # Last charges
         self.q_a   = None
+        # Geometry of the cached neighbor list
+        self.key   = None
 
 
     def update(self, a, q=None):
         if q is None:
             q = a.get_initial_charges()
 
-        r = a.get_positions()
-        # FIXME!!! Check for change in cell, symmetries
-        if self.r_av is None or self.q_a is None:
-           self._update(a, q)
-        elif np.any(r != self.r_av) or np.any(q != self.q_a):
+        if self.q_a is None or self.key is None:
             self._update(a, q)
+        elif not np.array_equal(q, self.q_a) or self._geometry_key(a) != self.key:
+            self._update(a, q)
+
+
+    def _update_pairs(self, a):
+        """
+        Find the neighbors and the pair kernels phi(d) and -phi'(d)/d,
+        and build the sparse operators for the potential and the field.
+
+        Done only when the geometry changes; in SCC iterations only the
+        charges change and the potential is a single sparse mat-vec.
+        """
+        self.timer.start('neighbors')
+        il, jl, dl, nl = get_neighbors(a, self.cutoff)
+        if il is None:
+            il, jl = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+            dl, nl = np.zeros(0), np.zeros((0, 3))
+        if self.cutoff is None:
+            phi  = 1.0/dl
+            E    = 1.0/dl**2
+        else:
+            f    = erfc(dl/self.cutoff)
+            df   = 2/sqrt(pi)*np.exp(-(dl/self.cutoff)**2)/self.cutoff
+            phi  = f/dl
+            E    = (df + f/dl)/dl
+        self.pairs = ( il, jl, dl, nl, phi, E )
+        nat = len(a)
+        self.phi_op = pair_operator(nat, il, jl, phi)
+        self.E_op   = [ pair_operator(nat, il, jl, E*nl[:, c]) for c in range(3) ]
+        self.key = self._geometry_key(a)
+        self.timer.stop('neighbors')
 
 
     def _update(self, a, q):
         """
-        Compute the electrostatic potential and field on each atom in a.
+        Compute the electrostatic potential on each atom in a. The field
+        and the virial are computed when requested.
 
         Parameters:
         -----------
@@ -84,34 +114,34 @@ class DirectCoulomb(Coulomb):
         self.r_av  = a.get_positions().copy()
         self.q_a   = q.copy()
 
-        nat  = len(a)
-
-        il, jl, dl, nl = get_neighbors(a, self.cutoff)
+        if self.key is None or self._geometry_key(a) != self.key:
+            self._update_pairs(a)
 
-        if il is not None:
-            if self.cutoff is None:
-                phi  = q[jl]/dl
-                dl **= 2
-                E    = q[jl].reshape(-1, 1)*nl/dl.reshape(-1, 1)
-            else:
-                f    = erfc(dl/self.cutoff)
-                df   = 2/sqrt(pi)*np.exp(-(dl/self.cutoff)**2)/self.cutoff
-                phi  = q[jl]*f/dl
-                E    = q[jl]*(df + f/dl)/dl
-                E    = E.reshape(-1, 1)*nl
-
-        self.phi_a  = np.zeros(nat, dtype=float)
-        self.E_av   = np.zeros([nat, 3], dtype=float)
-
-        if il is not None:
-            # FIXME!!! Is there some fast numpy magic to compute this?
-            for i in range(nat):
-                self.phi_a[i]    = phi[il == i].sum()
-                self.E_av[i, :]  = E[il == i].sum(axis=0)
+        self.phi_a  = self.phi_op.dot(q)
+        # Field and virial are not needed in SCC iterations, computed on demand
+        self.E_av   = None
+        self.W_cc   = None
 
         self.timer.stop('direct_coulomb')
 
 
+    def _field(self):
+        """ Return the field for the current charges. """
+        if self.E_av is None:
+            self.E_av = np.transpose([ op.dot(self.q_a) for op in self.E_op ])
+        return self.E_av
+
+
+    def _virial(self):
+        """ Return the virial for the current charges. """
+        if self.W_cc is None:
+            il, jl, dl, nl, phi, E = self.pairs
+            q = self.q_a
+            # W = 1/2 sum q_i q_j phi'(d) d n n, with phi'(d) = -E
+            self.W_cc = -0.5*np.dot((q[il]*q[jl]*E*dl)*nl.transpose(), nl)
+        return self.W_cc
+
+
     def get_potential(self, a=None):
         """
         Return the electrostatic potential for each atom.
@@ -129,7 +159,7 @@ class DirectCoulomb(Coulomb):
         if a is not None:
             self.update(a)
 
-        return self.E_av
+        return self._field()
 
 
     def get_potential_and_field(self, a=None):
@@ -140,7 +170,17 @@ class DirectCoulomb(Coulomb):
         if a is not None:
             self.update(a)
 
-        return self.phi_a, self.E_av
+        return self.phi_a, self._field()
+
+
+    def get_virial(self, a=None):
+        """
+        Return the virial W_ab = 1/2 sum_(i,j) q_i q_j phi'(r_ij) r_ij,a r_ij,b/r_ij.
+        """
+        if a is not None:
+            self.update(a)
+
+        return self._virial()
 
 
     def get_gamma(self, a=None):
@@ -152,20 +192,13 @@ class DirectCoulomb(Coulomb):
 
         self.timer.start('get_gamma')
 
-        nat = len(self.a)
-
-        il, jl, dl, nl = get_neighbors(self.a, self.cutoff)
+        if self.key is None or self._geometry_key(self.a) != self.key:
+            self._update_pairs(self.a)
 
-        if il is None:
+        if self.phi_op.nnz == 0:
             G = None
         else:
-            G = np.zeros([nat, nat], dtype=float)
-            if self.cutoff is None:
-                for i, j, d in zip(il, jl, dl):
-                    G[i, j] += 1.0/d
-            else:
-                for i, j, d in zip(il, jl, dl):
-                    G[i, j] += 1.0*erfc(d/self.cutoff)/d
+            G = self.phi_op.toarray()
 
         self.timer.stop('get_gamma')
         return G
@@ -189,4 +222,4 @@ class DirectCoulomb(Coulomb):
         if a is not None:
             self.update(a)
 
-        return self.q_a.reshape(-1, 1)*self.E_av
+        return self.q_a.reshape(-1, 1)*self._field()
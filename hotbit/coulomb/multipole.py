@@ -16,7 +16,7 @@ from __future__ import division
 
 import numpy as np
 
-from _hotbit import solid_harmonic_R, multipole_to_multipole
+from _hotbit import multipole_to_multipole
 from _hotbit import multipole_to_local, local_to_local, transform_multipole
 
 
@@ -44,6 +44,47 @@ def zero_moments(l_max):
         np.zeros([lm2index(l_max,l_max)+1], dtype=complex)
 
 
+def get_solid_harmonics(r, l_max, r0):
+    """
+    Return the regular solid harmonics of a set of atoms.
+
+    R_l^m(r) = r^l P_l^m(cos theta) exp(i m phi) / (l+m)!, evaluated for
+    all atoms at once by the usual recurrence. Same convention as
+    solid_harmonic_R, which does it for one position.
+
+    The harmonics depend only on the positions, the multipole moments
+    of charges q are M0_l = dot(q, R0_al) and M_L = dot(q, R_aL).conj()
+    (see get_moments).
+
+    Parameters:
+    r:      Positions
+    l_max:  Maximum angular momentum number for the expansion
+    r0:     Expansion origin
+    """
+
+    dr_av  = np.asarray(r, dtype=float).reshape(-1, 3) - r0
+    x, y, z  = dr_av.transpose()
+    r2     = np.sum(dr_av*dr_av, axis=1)
+    xy     = x + 1j*y
+
+    # R[l][m] for m = 0..l
+    R      = [ [ np.ones(len(dr_av), dtype=complex) ] ]
+    for l in range(l_max):
+        Rl  = [ ]
+        for m in range(l):
+            Rl += [ ( (2*l+1)*z*R[l][m] - r2*R[l-1][m] )/( (l+1)**2 - m**2 ) ]
+        Rl += [ z*R[l][l], -xy*R[l][l]/(2*l+2) ]
+        R  += [ Rl ]
+
+    R0_al  = np.array([ R[l][0].real for l in range(l_max+1) ]).transpose()
+    R_aL   = np.zeros([len(dr_av), lm2index(l_max, l_max)+1], dtype=complex)
+    for l in range(1, l_max+1):
+        for m in range(1, l+1):
+            R_aL[:, lm2index(l, m)] = R[l][m]
+
+    return R0_al, R_aL
+
+
 def get_moments(r, q, l_max, r0):
     """
     Compute the multipole moments of a set of atoms
@@ -55,12 +96,77 @@ def get_moments(r, q, l_max, r0):
     r0:     Expansion origin
     """
 
-    # This could be easily moved to C if it turns out to be slow
-    M0_l, M_L  = zero_moments(l_max)
-    for r, q in zip(r, q):
-        cR0_l, cR_L = solid_harmonic_R(r-r0, l_max)
-        M0_l += q*cR0_l
-        M_L  += q*cR_L
+    R0_al, R_aL  = get_solid_harmonics(r, l_max, r0)
+
+    return np.dot(q, R0_al), np.dot(q, R_aL).conj()
+
+
+
+def _full_table(R0_l, R_L, l_max):
+    """
+    Return the harmonics or expansion coefficients as one complex
+    array X[..., l, m] for m = 0..l+1 (zero for m > l).
+    """
+
+    X  = np.zeros(R0_l.shape[:-1]+(l_max+1, l_max+2), dtype=complex)
+    X[..., 0]  = R0_l
+    for l in range(1, l_max+1):
+        X[..., l, 1:l+1]  = R_L[..., lm2index(l, 1):lm2index(l, l)+1]
+    return X
+
+
+def local_to_atoms(L0_l, L_L, R0_al, R_aL):
+    """
+    Evaluate a local expansion at a set of atoms.
+
+    Same as local_to_local to l = 1 for each atom, i.e. the potential
+    is phi_a = Lp0_l[0] and the field E_av = [ -Lp_L[0].real,
+    -Lp_L[0].imag, Lp0_l[1] ], but for all atoms at once. The expansion
+    is
+
+        phi(r0+d) = sum_l (-1)^l [ L_l^0 R_l^0(d)
+                                   + 2 Re sum_m>0 L_l^m conj(R_l^m(d)) ],
+
+    and the field follows from dR_l^m/dz = R_(l-1)^m and
+    (d/dx -+ i d/dy) R_l^m = -+ R_(l-1)^(m-+1).
+
+    Parameters:
+    -----------
+    L0_l, L_L:     Local expansion around r0
+    R0_al, R_aL:   Solid harmonics of the atoms around r0 to the same
+                   order (see get_solid_harmonics)
+    """
+
+    l_max  = len(L0_l)-1
+    R      = _full_table(R0_al, R_aL, l_max)
+    L      = _full_table(L0_l, L_L, l_max)
+
+    # sign (-1)^l and weight 2 for m > 0
+    s_l    = (-1.0)**np.arange(l_max+1)
+    w_m    = np.ones(l_max+2)
+    w_m[1:]  = 2.0
+    Lw     = s_l.reshape(-1, 1)*w_m*L
+
+    phi_a  = np.tensordot(R.conj(), Lw, axes=([1, 2], [0, 1])).real
+
+    E_av   = np.zeros([len(R), 3], dtype=float)
+    if l_max == 0:
+        return phi_a, E_av
+
+    # R_(l-1)^m for l = 1..l_max
+    Rd     = R[:, :-1, :]
+    Ls     = s_l[1:].reshape(-1, 1)*L[1:]
+
+    # d/dz
+    dz_a   = np.tensordot(Rd.conj(), Lw[1:], axes=([1, 2], [0, 1])).real
+
+    # (d/dx + i d/dy), m = 0 term and m > 0 terms
+    G_a    = np.dot(Rd[:, :, 1], Ls[:, 0])
+    G_a   -= np.tensordot(Rd[:, :, :-1].conj(), Ls[:, 1:], axes=([1, 2], [0, 1]))
+    G_a   += np.tensordot(Rd[:, :, 2:], Ls[:, 1:-1].conj(), axes=([1, 2], [0, 1]))
 
-    return M0_l, M_L.conj()
+    E_av[:, 0]  = -G_a.real
+    E_av[:, 1]  = -G_a.imag
+    E_av[:, 2]  = -dz_a
 
+    return phi_a, E_av
@@ -19,29 +19,42 @@ import numpy as np
 
 from hotbit.neighbors import n_from_ranges
 
-from hotbit.coulomb.multipole import get_moments, zero_moments
+from hotbit.coulomb.multipole import get_solid_harmonics, zero_moments
 from hotbit.coulomb.multipole import multipole_to_multipole, multipole_to_local
-from hotbit.coulomb.multipole import local_to_local, transform_multipole
+from hotbit.coulomb.multipole import local_to_atoms, transform_multipole
 
 from box.timing import Timer
 
-from hotbit.coulomb.baseclass import Coulomb
+from hotbit.coulomb.baseclass import Coulomb, pair_operator
 
-# diag_indices_from was introduced in numpy 1.4.0
-if hasattr(np, 'diag_indices_from'):
-    diag_indices_from = np.diag_indices_from
-else:
-    def diag_indices_from(m):
-        i = [ ] 
-        for n in m.shape:
-            i += [ np.arange(n, dtype=int) ]
-        return tuple(i)
+
+def group_by_rotation(ops):
+    """
+    Group translations by rotation.
+
+    Returns a list of (T, [ dr, ... ]) for the list of (dr, T) in ops,
+    such that each rotation is applied to the multipoles only once. T is
+    None for the identity, which needs no transformation.
+    """
+    groups = { }
+    for dr, T in ops:
+        if np.allclose(T, np.eye(3)):
+            key = None
+        else:
+            key = np.asarray(T, dtype=float).tobytes()
+        if key not in groups:
+            groups[key] = ( None if key is None else T, [ ] )
+        groups[key][1].append(dr)
+    return list(groups.values())
 
 
 class MultipoleExpansion(Coulomb):
     _TOL = 1e-6
+    # Number of pairs in a block of the near field kernels
+    _BLOCK = 2**18
     
-    def __init__(self, l_max=8, n=3, k=5, r0=None, timer=None):
+    def __init__(self, l_max=8, n=3, k=5, r0=None, timer=None,
+                 near_field_cache=2000):
         """
         Instantiate a new MultipoleExpansion object which computes
         the electrostatic interaction by direct summation using a
@@ -54,6 +67,10 @@ class MultipoleExpansion(Coulomb):
         n:       Number of cells to combine during each telescoping step
         k:       Summation cutoff. The interaction range will be n**k 
                  (number of cells, typically k = 5).
+        near_field_cache:
+                 Largest number of atoms for which the near field potential
+                 operator (nat**2 elements) is kept between SCC iterations.
+                 For larger systems it is summed in blocks at each update.
         """
         if l_max < 1:
             raise ValueError('l_max must be >= 1.')
@@ -63,6 +80,7 @@ class MultipoleExpansion(Coulomb):
             raise ValueError('k must be >= 1.')
 
         self.l_max = l_max
+        self.near_field_cache = near_field_cache
 
         if type(n) == int:
             n = np.array([n]*3)
@@ -105,35 +123,32 @@ class MultipoleExpansion(Coulomb):
         self.r_av  = None
         # Last charges
         self.q_a   = None
+        # Field, computed on demand
+        self.E_av  = None
+        # Geometry of the cached expansion
+        self.key   = None
 
 
     def update(self, a, q=None):
         if q is None:
             q = a.get_initial_charges()
 
-        r = a.get_positions()
-        # FIXME!!! Check for change in cell, symmetries
-        if self.r_av is None or self.q_a is None:
-           self._update(a, q)
-        elif np.any(r != self.r_av) or np.any(q != self.q_a):
+        if self.q_a is None or self.key is None:
+            self._update(a, q)
+        elif not np.array_equal(q, self.q_a) or self._geometry_key(a) != self.key:
             self._update(a, q)
 
 
-    def _update(self, a, q):
+    def _update_geometry(self, a):
         """
-        Compute multipoles, do the transformations, and compute the
-        electrostatic potential and field on each atom in a.
+        Compute the charge-independent parts of the expansion: the solid
+        harmonics of the atoms, the expansion centers, translations and
+        rotations of the telescoping steps, and the near field kernels.
 
-        Parameters:
-        -----------
-        a:   Hotbit Atoms object, or atoms object that implements the transform
-             and rotation interface.
-        q:   Charges
+        Done only when the geometry changes; in SCC iterations only the
+        charges change and these are reused.
         """
-        self.timer.start('multipole_to_multipole')
-
-        self.r_av  = a.get_positions().copy()
-        self.q_a   = q.copy()
+        self.timer.start('geometry')
 
         nat  = len(a)
         r    = a.get_positions()
@@ -143,9 +158,8 @@ class MultipoleExpansion(Coulomb):
         else:
             r0_v  = self.r0_v
 
-        T0_l, T_L = get_moments(r, q, self.l_max, r0_v)
+        self.R0_al, self.R_aL = get_solid_harmonics(r, self.l_max, r0_v)
 
-        self.M   = [ ( T0_l.copy(), T_L.copy() ) ]
         self.r0  = [ r0_v ]
 
         sym_ranges = a.get_symmetry_operation_ranges()
@@ -157,15 +171,10 @@ class MultipoleExpansion(Coulomb):
                                  'be 1.')
         n1, n2, n3 = n_from_ranges(sym_ranges, self.n1, self.n2)
 
-        # Compute telescoped multipoles
+        # Translations and rotations for the telescoped multipoles
+        self.m2m = [ ]
         level = np.ones(3, dtype=int)
         for k in range(np.max(self.k)-2):
-            M0_l  = T0_l
-            M_L   = T_L
-
-            T0_l  = np.zeros_like(M0_l)
-            T_L   = np.zeros_like(M_L)
-
             if k >= self.k[0]-2:
                 _n1 = [ 0, 1 ]
             else:
@@ -192,44 +201,28 @@ class MultipoleExpansion(Coulomb):
                         n    += 1
             r0_v /= n
             self.r0 += [ r0_v ]
-            #self.r0 += [ self.r0[0] ]
 
-            # Transform multipoles
+            ops = [ ]
             for x1 in range(*_n1):
                 for x2 in range(*_n2):
                     for x3 in range(*_n3):
-                        # Loop over all symmetry operations and compute
-                        # telescoped multipoles
+                        # Loop over all symmetry operations
                         # FIXME!!! Currently only supports continuous
                         # symmetries, think about discrete/recurrent ones.
-                        x = np.array([x1, x2, x3]) #+ self.dx
+                        x = np.array([x1, x2, x3])
 
-                        # The origin is already okay, skip it
-                        #if np.any(np.abs(x) > self._TOL):
                         r1  = a.transform(self.r0[k], x*level)
                         T   = a.rotation(x*level)
-                        S0_l, S_L = transform_multipole(T, self.l_max,
-                                                        M0_l, M_L)
-                        multipole_to_multipole(r1-self.r0[k], self.l_max,
-                                               S0_l, S_L, T0_l, T_L)
-
-            self.M += [ ( T0_l.copy(), T_L.copy() ) ]
+                        ops += [ ( r1-self.r0[k], T ) ]
+            self.m2m += [ group_by_rotation(ops) ]
 
             level *= self.n2-self.n1+1
 
-        self.timer.stop('multipole_to_multipole')
-
-        ###
-
-        self.timer.start('multipole_to_local')
-
-        # Compute the local expansion from telescoped multipoles
-        L0_l, L_L   = zero_moments(self.l_max)
+        # Translations and rotations for the local expansion
+        self.m2l = [ ]
         m1, m2, m3  = n_from_ranges(sym_ranges, self.m1, self.m2)
-        Mi          = len(self.M)-1
+        Mi          = len(self.r0)-1
         for k in range(np.max(self.k)-1):
-            M0_l, M_L  = self.M[Mi]
-
             if k >= self.k[0]-1:
                 _m1 = [ 0, 1 ]
             else:
@@ -245,106 +238,221 @@ class MultipoleExpansion(Coulomb):
             else:
                 _m3 = m3
 
+            ops = [ ]
             for x1 in range(*_m1):
                 for x2 in range(*_m2):
                     for x3 in range(*_m3):
-                        # Loop over all symmetry operations and compute the
-                        # local expansion from the telescoped multipoles
-                        x = np.array([x1, x2, x3]) #+ self.dx
+                        x = np.array([x1, x2, x3])
 
                         # No local expansion in the inner region
                         if np.any(x < self.n1) or np.any(x > self.n2):
                             r1  = a.transform(self.r0[Mi], x*level)
                             T   = a.rotation(x*level)
-                            S0_l, S_L = transform_multipole(T, self.l_max,
-                                                            M0_l, M_L)
-                            multipole_to_local(-r1+self.r0[Mi], self.l_max,
-                                               S0_l, S_L, L0_l, L_L)
+                            ops += [ ( -r1+self.r0[Mi], T ) ]
+            self.m2l += [ ( Mi, group_by_rotation(ops) ) ]
 
             level //= self.n2-self.n1+1
             Mi    -= 1
 
-        self.L = ( L0_l, L_L )
+        # Near field: all atoms in the neighboring boxes, stored as the
+        # positions of the images (the cell itself first). Every pair
+        # between the cell and these boxes interacts, so the kernels are
+        # dense; they are summed in blocks of rows and only the potential
+        # operator of small systems is kept.
+        self.r_near = [ r.copy() ]
+        for x1 in range(*n1):
+            for x2 in range(*n2):
+                for x3 in range(*n3):
+                    # self-interaction needs to be treated separately
+                    if x1 != 0 or x2 != 0 or x3 != 0:
+                        x = np.array([x1, x2, x3])
 
-        self.timer.stop('multipole_to_local')
+                        r1      = a.transform(self.r0[0], x)
+                        T       = a.rotation(x)
 
-        ###
+                        rT      = np.dot(r-self.r0[0], np.transpose(T))
+                        self.r_near += [ r1+rT ]
+
+        self.P_op  = None
+        if nat <= self.near_field_cache:
+            il, jl, w  = [ ], [ ], [ ]
+            for rows in self._blocks(nat):
+                P     = self._near_field(rows)[0]
+                il   += [ np.repeat(rows, nat) ]
+                jl   += [ np.tile(np.arange(nat), len(rows)) ]
+                w    += [ P.ravel() ]
+            self.P_op = pair_operator(nat, np.concatenate(il),
+                                      np.concatenate(jl), np.concatenate(w))
 
-        self.phi_a  = np.zeros(nat, dtype=float)
-        self.E_av   = np.zeros([nat, 3], dtype=float)
-    
-        ###
+        # Dipole correction for 3D sum
+        s1, s2, s3 = sym_ranges
+        self.dipole_correction = s1[1] == np.Inf and s2[1] == np.Inf and \
+            s3[1] == np.Inf
+        if self.dipole_correction:
+            self.dr_av  = r-self.r0[0]
+            self.V      = a.get_volume()
 
-        self.timer.start('local_to_local')
+        self.key = self._geometry_key(a)
 
-        for i in a:
-            loc0_l, loc_L          = local_to_local(i.position-self.r0[0],
-                                                   self.l_max, L0_l, L_L, 1)
-            self.phi_a[i.index]    = loc0_l[0]
-            self.E_av[i.index, :]  = [ -loc_L[0].real,
-                                       -loc_L[0].imag,
-                                        loc0_l[1] ]
+        self.timer.stop('geometry')
 
-        self.timer.stop('local_to_local')
+
+    def _blocks(self, nat):
+        """
+        Return the atom indices in blocks of rows, such that a block of the
+        near field kernels has at most _BLOCK elements.
+        """
+        nrows = max(1, self._BLOCK//nat)
+        return [ np.arange(i, min(i+nrows, nat)) for i in range(0, nat, nrows) ]
+
+
+    def _near_field(self, rows, q=None):
+        """
+        Return the near field contribution at atoms rows.
+
+        Without charges q, return the kernel P(rows, j) such that
+        phi(i) = sum_j P(i, j) q(j), and None. With charges q, return the
+        potential and the field at the atoms rows.
+        """
+        nat  = len(self.r_near[0])
+        nr   = len(rows)
+        r    = self.r_near[0][rows].reshape(nr, 1, 3)
+
+        P    = np.zeros([nr, nat], dtype=float)
+        E    = None
+        if q is not None:
+            E  = np.zeros([nr, 3], dtype=float)
+        for k, rT in enumerate(self.r_near):
+            dr      = r - rT.reshape(1, nat, 3)
+            abs_dr  = np.sqrt(np.sum(dr*dr, axis=2))
+            if k == 0:
+                # No self-interaction
+                abs_dr[np.arange(nr), rows] = np.Inf
+            P  += 1.0/abs_dr
+            if q is not None:
+                E += np.einsum('ij,ijv->iv', q/abs_dr**3, dr)
+
+        if q is None:
+            return P, None
+        else:
+            return np.dot(P, q), E
+
+
+    def _update(self, a, q):
+        """
+        Compute multipoles, do the transformations, and compute the
+        electrostatic potential and field on each atom in a.
+
+        Parameters:
+        -----------
+        a:   Hotbit Atoms object, or atoms object that implements the transform
+             and rotation interface.
+        q:   Charges
+        """
+        if self.key is None or self._geometry_key(a) != self.key:
+            self._update_geometry(a)
+
+        self.timer.start('multipole_to_multipole')
+
+        self.r_av  = a.get_positions().copy()
+        self.q_a   = q.copy()
+
+        T0_l  = np.dot(q, self.R0_al)
+        T_L   = np.dot(q, self.R_aL).conj()
+
+        self.M   = [ ( T0_l.copy(), T_L.copy() ) ]
+
+        # Compute telescoped multipoles
+        for ops in self.m2m:
+            M0_l  = T0_l
+            M_L   = T_L
+
+            T0_l  = np.zeros_like(M0_l)
+            T_L   = np.zeros_like(M_L)
+
+            # Transform multipoles, rotate once for each rotation
+            for T, drs in ops:
+                if T is None:
+                    S0_l, S_L = M0_l, M_L
+                else:
+                    S0_l, S_L = transform_multipole(T, self.l_max, M0_l, M_L)
+                for dr in drs:
+                    multipole_to_multipole(dr, self.l_max, S0_l, S_L, T0_l, T_L)
+
+            self.M += [ ( T0_l.copy(), T_L.copy() ) ]
+
+        self.timer.stop('multipole_to_multipole')
 
         ###
 
-        self.timer.start('near_field')
+        self.timer.start('multipole_to_local')
 
-        # Contribution of neighboring boxes
-        for x1 in range(*n1):
-            for x2 in range(*n2):
-                for x3 in range(*n3):
-                    # self-interaction needs to be treated separately
-                    if x1 != 0 or x2 != 0 or x3 != 0:
-                        x = np.array([x1, x2, x3])
+        # Compute the local expansion from telescoped multipoles
+        L0_l, L_L   = zero_moments(self.l_max)
+        for Mi, ops in self.m2l:
+            M0_l, M_L  = self.M[Mi]
 
-                        # construct a matrix with distances
-                        r1      = a.transform(self.r0[0], x)
-                        T       = a.rotation(x)
+            for T, drs in ops:
+                if T is None:
+                    S0_l, S_L = M0_l, M_L
+                else:
+                    S0_l, S_L = transform_multipole(T, self.l_max, M0_l, M_L)
+                for dr in drs:
+                    multipole_to_local(dr, self.l_max, S0_l, S_L, L0_l, L_L)
 
-                        rT      = np.dot(r-self.r0[0], np.transpose(T))
+        self.L = ( L0_l, L_L )
+
+        self.timer.stop('multipole_to_local')
 
-                        dr      = r.reshape(nat, 1, 3) - \
-                            (r1+rT).reshape(1, nat, 3)
-                        abs_dr  = np.sqrt(np.sum(dr*dr, axis=2))
-                        phi     = q/abs_dr
-                        E       = q.reshape(1, nat, 1)*dr/ \
-                            (abs_dr**3).reshape(nat, nat, 1)
+        ###
 
-                        self.phi_a += np.sum(phi, axis=1)
-                        self.E_av  += np.sum(E, axis=1)
+        self.timer.start('local_to_local')
 
-        # Self-contribution
-        dr        = r.reshape(nat, 1, 3) - r.reshape(1, nat, 3)
-        abs_dr    = np.sqrt(np.sum(dr*dr, axis=2))
+        # Evaluate at the atoms with the solid harmonics of this geometry
+        self.phi_a, self.E_far = local_to_atoms(L0_l, L_L, self.R0_al,
+                                                self.R_aL)
 
-        # Avoid divide by zero
-        abs_dr[diag_indices_from(abs_dr)]  = 1.0
+        self.timer.stop('local_to_local')
 
-        phi       = q/abs_dr
-        E         = q.reshape(1, nat, 1)*dr/(abs_dr**3).reshape(nat, nat, 1)
+        ###
 
-        phi[diag_indices_from(phi)]  = 0.0
-        E[diag_indices_from(phi)]    = 0.0
+        self.timer.start('near_field')
 
-        self.phi_a += np.sum(phi, axis=1)
-        self.E_av  += np.sum(E, axis=1)
+        # Contribution of neighboring boxes and self-contribution
+        if self.P_op is not None:
+            self.phi_a += self.P_op.dot(q)
+        else:
+            for rows in self._blocks(len(q)):
+                self.phi_a[rows] += self._near_field(rows, q)[0]
 
         # Dipole correction for 3D sum
-        s1, s2, s3 = sym_ranges
-        if s1[1] == np.Inf and s2[1] == np.Inf and s3[1] == np.Inf:
+        if self.dipole_correction:
             Ml0, Mlm = self.M[0]
         
             dip  = np.array([-2*Mlm[0].real, 2*Mlm[0].imag, Ml0[1]])
-            dip *= 4*pi/(3*a.get_volume())
+            dip *= 4*pi/(3*self.V)
  
-            self.phi_a -= np.dot(r-self.r0[0], dip)
-            self.E_av  += dip
+            self.phi_a -= np.dot(self.dr_av, dip)
+            self.E_far += dip
+
+        # The near field contribution to the field is computed when needed
+        self.E_av  = None
 
         self.timer.stop('near_field')
 
 
+    def _field(self):
+        """ Return the field, computed on demand. """
+        if self.E_av is None:
+            self.timer.start('near_field')
+            E_av  = self.E_far.copy()
+            for rows in self._blocks(len(self.q_a)):
+                E_av[rows] += self._near_field(rows, self.q_a)[1]
+            self.E_av = E_av
+            self.timer.stop('near_field')
+        return self.E_av
+
+
     def get_moments(self):
         """
         Return the multipole moments.
@@ -376,7 +484,7 @@ class MultipoleExpansion(Coulomb):
         if a is not None:
             self.update(a)
 
-        return self.E_av
+        return self._field()
 
 
     def get_potential_and_field(self, a=None):
@@ -387,7 +495,7 @@ class MultipoleExpansion(Coulomb):
         if a is not None:
             self.update(a)
 
-        return self.phi_a, self.E_av
+        return self.phi_a, self._field()
 
 
 ### For use as a standalone calculator
@@ -408,4 +516,4 @@ class MultipoleExpansion(Coulomb):
         if a is not None:
             self.update(a)
 
-        return self.q_a.reshape(-1, 1)*self.E_av
+        return self.q_a.reshape(-1, 1)*self._field()
@@ -0,0 +1,393 @@
+"""
+Smooth particle-mesh Ewald (SPME) summation.
+
+See: U. Essmann et al., J. Chem. Phys. 103, 8577 (1995)
+
+The reciprocal space sum is done on a grid with fast Fourier transforms,
+the charges being interpolated to the grid with cardinal B-splines; the
+real space sum uses a cell-list neighbor search. The total cost scales as
+O(N log N).
+
+The potential and field returned here does not include the contribution
+of the shape (Gaussian/Slater) of the charges, which is short ranged and
+can be easily added later.
+"""
+
+# Copyright (C) 2010 NSC Jyvaskyla, Fh-IWM
+# Please see the accompanying LICENSE file for further information.
+
+from math import log, pi, sqrt
+
+import numpy as np
+from scipy.special import erfc
+
+from hotbit.neighbors import get_neighbors
+from box.timing import Timer
+
+from hotbit.coulomb.baseclass import Coulomb, pair_operator
+
+
+def bspline(x, order):
+    """
+    Return the cardinal B-spline M_order(x) and its derivative.
+
+    M_2(x) = 1-|x-1| for 0<=x<=2, and
+    M_n(x) = x/(n-1) M_(n-1)(x) + (n-x)/(n-1) M_(n-1)(x-1).
+    """
+    x  = np.asarray(x, dtype=float)
+    y  = x[..., None] - np.arange(order-1)
+    M  = np.where((y >= 0.0) & (y <= 2.0), 1.0-np.abs(y-1.0), 0.0)
+    for n in range(3, order+1):
+        if n == order:
+            dM = M[..., 0]-M[..., 1]
+        y = x[..., None] - np.arange(order-n+1)
+        M = ( y*M[..., :-1] + (n-y)*M[..., 1:] )/(n-1)
+    return M[..., 0], dM
+
+
+def bspline_moduli(K, order):
+    """
+    Return |b(m)|^2 of the Euler exponential spline for m = 0..K-1.
+    """
+    M, dM = bspline(np.arange(1, order), order)
+    m     = np.arange(K).reshape(-1, 1)
+    k     = np.arange(order-1).reshape(1, -1)
+    den   = np.sum(M*np.exp(2j*pi*m*k/K), axis=1)
+    den2  = np.abs(den)**2
+    # interpolate the (rare) zeros of odd orders from the neighbors
+    zero  = den2 < 1e-10
+    if np.any(zero):
+        den2[zero] = 0.5*(np.roll(den2, 1)+np.roll(den2, -1))[zero]
+    return 1.0/den2
+
+
+def fft_size(n):
+    """ Return the smallest integer >= n with prime factors 2, 3 and 5. """
+    n = max(int(n), 1)
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+
+class ParticleMeshEwald(Coulomb):
+    def __init__(self, cutoff=8.0, accuracy_goal=8, order=6, grid=None,
+                 timer=None):
+        """
+        Instantiate a new ParticleMeshEwald object which computes the
+        electrostatic interaction by smooth particle-mesh Ewald summation.
+        Requires a system periodic in all three directions.
+
+        Parameters:
+        -----------
+        cutoff:         Real space cutoff.
+        accuracy_goal:  The Ewald parameter and the reciprocal space cutoff
+                        are chosen such that the neglected terms in the
+                        real and reciprocal space sums are of the order
+                        10**(-accuracy_goal).
+        order:          Order of the B-spline interpolation (even).
+        grid:           Number of grid points along each lattice vector.
+                        If None, chosen from the reciprocal space cutoff
+                        (with twice the points of the Nyquist limit).
+        """
+        if order < 3:
+            raise ValueError('order must be >= 3.')
+
+        self.cutoff         = cutoff
+        self.accuracy_goal  = accuracy_goal
+        self.order          = order
+        self.grid           = grid
+
+        self.beta   = sqrt(log(10.0)*accuracy_goal)/cutoff
+        self.m_max  = self.beta*sqrt(log(10.0)*accuracy_goal)/pi
+
+        if timer is None:
+            self.timer  = Timer('ParticleMeshEwald')
+        else:
+            self.timer  = timer
+
+        # Last positions
+        self.r_av  = None
+        # Last charges
+        self.q_a   = None
+        # Geometry of the cached grid weights and neighbor list
+        self.key   = None
+
+
+    def update(self, a, q=None):
+        if q is None:
+            q = a.get_initial_charges()
+
+        if self.q_a is None or self.key is None:
+            self._update(a, q)
+        elif not np.array_equal(q, self.q_a) or self._geometry_key(a) != self.key:
+            self._update(a, q)
+
+
+    def _update_geometry(self, a):
+        """
+        Compute the geometry-dependent parts: the B-spline weights of the
+        atoms on the grid, the reciprocal space kernel, and the real space
+        neighbors.
+        """
+        if not np.all(a.get_pbc()):
+            raise ValueError('ParticleMeshEwald requires a system periodic '
+                             'in all three directions.')
+
+        self.timer.start('geometry')
+        cell_cv  = np.asarray(a.get_cell())
+        rec_vc   = np.linalg.inv(cell_cv)
+        r_av     = a.get_positions()
+        V        = abs(np.linalg.det(cell_cv))
+        nat      = len(a)
+        p        = self.order
+
+        if self.grid is None:
+            L  = np.sqrt(np.sum(cell_cv**2, axis=1))
+            # twice the Nyquist limit, to keep the interpolation error small
+            K  = [ fft_size(max(4*self.m_max*l, 2*p)) for l in L ]
+        else:
+            K  = list(self.grid)
+        K  = np.array(K, dtype=int)
+
+        # B-spline weights, grid points and derivatives of the weights
+        u    = np.dot(r_av, rec_vc) % 1.0 * K
+        u0   = np.floor(u).astype(int)
+        x    = (u - u0)[:, :, None] + np.arange(p)
+        w, dw   = bspline(x, p)                                  # (nat,3,p)
+        idx  = ( u0[:, :, None] - np.arange(p) ) % K[None, :, None]
+        # flat grid indices (nat,p,p,p), weights and gradients
+        flat = ( idx[:, 0, :, None, None]*K[1] + idx[:, 1, None, :, None] )*K[2] + \
+               idx[:, 2, None, None, :]
+        W    = w[:, 0, :, None, None]*w[:, 1, None, :, None]*w[:, 2, None, None, :]
+        dW_u = np.array([ dw[:, 0, :, None, None]*w[:, 1, None, :, None]*w[:, 2, None, None, :],
+                          w[:, 0, :, None, None]*dw[:, 1, None, :, None]*w[:, 2, None, None, :],
+                          w[:, 0, :, None, None]*w[:, 1, None, :, None]*dw[:, 2, None, None, :] ])
+        # d/dr = sum_alpha K_alpha rec_vc[:,alpha] d/du_alpha
+        dW   = np.tensordot(rec_vc*K, dW_u, axes=(1, 0))          # (3,nat,p,p,p)
+        self.flat = flat.reshape(nat, -1)
+        self.W    = W.reshape(nat, -1)
+        self.dW   = dW.reshape(3, nat, -1)
+        self.K    = K
+        # one-dimensional weights and grid points, for the structure factors
+        self.w    = w
+        self.idx  = idx
+        self.V    = V
+
+        # reciprocal space kernel: m = integer components, G = m.rec
+        m    = [ np.fft.fftfreq(k, 1.0/k) for k in K ]
+        m_v  = ( m[0][:, None, None, None]*rec_vc[:, 0] +
+                 m[1][None, :, None, None]*rec_vc[:, 1] +
+                 m[2][None, None, :, None]*rec_vc[:, 2] )
+        m2   = np.sum(m_v**2, axis=3)
+        B    = bspline_moduli(K[0], p)[:, None, None] * \
+               bspline_moduli(K[1], p)[None, :, None] * \
+               bspline_moduli(K[2], p)[None, None, :]
+        m2[0, 0, 0] = 1.0
+        C    = np.exp(-pi**2*m2/self.beta**2)/(pi*V*m2)
+        C[0, 0, 0] = 0.0
+        self.kernel = B*C
+        # for the strain derivative of the kernel (virial)
+        self.m_v = m_v
+        self.m2  = m2
+        self.timer.stop('geometry')
+
+        self.timer.start('neighbors')
+        il, jl, dl, nl = get_neighbors(a, self.cutoff)
+        if il is None:
+            il, jl = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+            dl, nl = np.zeros(0), np.zeros((0, 3))
+        phi  = erfc(self.beta*dl)/dl
+        E    = ( 2*self.beta/sqrt(pi)*np.exp(-(self.beta*dl)**2) + phi )/dl
+        self.pairs  = ( il, jl, dl, nl, phi, E )
+        self.phi_op = pair_operator(nat, il, jl, phi)
+        self.E_op   = [ pair_operator(nat, il, jl, E*nl[:, c]) for c in range(3) ]
+        self.timer.stop('neighbors')
+
+        self.key = self._geometry_key(a)
+
+
+    def _reciprocal_potential(self, q):
+        """
+        Return the reciprocal space potential on the grid and the Fourier
+        transformed charge grid for charges q.
+        """
+        Q   = np.bincount(self.flat.ravel(), weights=(q[:, None]*self.W).ravel(),
+                          minlength=np.prod(self.K)).reshape(self.K)
+        FQ  = np.fft.fftn(Q)
+        phi = np.fft.ifftn(self.kernel*FQ).real*np.prod(self.K)
+        return phi.ravel(), FQ
+
+
+    def _update(self, a, q):
+        """
+        Compute the electrostatic potential on each atom in a. The field
+        and the virial are computed when requested.
+
+        Parameters:
+        -----------
+        a:   Hotbit Atoms object, or atoms object that implements the transform
+             and rotation interface.
+        q:   Charges
+        """
+        if self.key is None or self._geometry_key(a) != self.key:
+            self._update_geometry(a)
+
+        self.timer.start('particle_mesh_ewald')
+
+        self.a     = a
+        self.r_av  = a.get_positions().copy()
+        self.q_a   = q.copy()
+
+        # Reciprocal space sum
+        phi_g, self.FQ  = self._reciprocal_potential(q)
+        self.phi_p  = phi_g[self.flat]
+        self.phi_a  = np.sum(self.W*self.phi_p, axis=1)
+
+        # Real space sum
+        self.phi_a += self.phi_op.dot(q)
+
+        # Self energy
+        self.phi_a -= 2*q*self.beta/sqrt(pi)
+
+        # Neutralizing background of a charged cell
+        self.phi_a -= pi*np.sum(q)/(self.V*self.beta**2)
+
+        # Field and virial are not needed in SCC iterations, computed on demand
+        self.E_av  = None
+        self.W_cc  = None
+
+        self.timer.stop('particle_mesh_ewald')
+
+
+    def _field(self):
+        """ Return the field for the current charges. """
+        if self.E_av is None:
+            self.E_av  = -np.sum(self.dW*self.phi_p, axis=2).transpose()
+            self.E_av += np.transpose([ op.dot(self.q_a) for op in self.E_op ])
+        return self.E_av
+
+
+    def _virial(self):
+        """ Return the virial W_ab = dE/d(strain_ab) for the current charges. """
+        if self.W_cc is None:
+            q    = self.q_a
+            e_m  = 0.5*self.kernel*np.abs(self.FQ)**2
+            f_m  = 2*(1+pi**2*self.m2/self.beta**2)/self.m2
+            self.W_cc = -np.sum(e_m)*np.eye(3) + \
+                np.einsum('xyz,xyza,xyzb->ab', e_m*f_m, self.m_v, self.m_v)
+            il, jl, dl, nl, phi, E = self.pairs
+            self.W_cc -= 0.5*np.dot((q[il]*q[jl]*E*dl)*nl.transpose(), nl)
+            # background energy -pi q_tot**2/(2 V beta**2) scales as 1/V
+            self.W_cc += pi*np.sum(q)**2/(2*self.V*self.beta**2)*np.eye(3)
+        return self.W_cc
+
+
+    def get_potential(self, a=None):
+        """
+        Return the electrostatic potential for each atom.
+        """
+        if a is not None:
+            self.update(a)
+
+        return self.phi_a
+
+
+    def get_field(self, a=None):
+        """
+        Return the electrostatic field for each atom.
+        """
+        if a is not None:
+            self.update(a)
+
+        return self._field()
+
+
+    def get_potential_and_field(self, a=None):
+        """
+        Return the both, the electrostatic potential and the field for each
+        atom.
+        """
+        if a is not None:
+            self.update(a)
+
+        return self.phi_a, self._field()
+
+
+    def get_virial(self, a=None):
+        """
+        Return the virial W_ab = dE/d(strain_ab).
+        """
+        if a is not None:
+            self.update(a)
+
+        return self._virial()
+
+
+    def get_gamma(self, a=None):
+        """
+        Return the gamma correlation matrix, i.e. phi(i) = gamma(i, j)*q(j)
+
+        The reciprocal space part is built in one pass from the B-spline
+        structure factors S(i, m) = sum_g W(i, g) exp(-2 pi i m.g/K),
+        gamma(i, j) = sum_m kernel(m) S(i, m)* S(j, m), over the wave
+        vectors within the reciprocal space cutoff. It reproduces the
+        potential to the accuracy goal.
+        """
+        if a is not None:
+            self.update(a)
+
+        self.timer.start('get_gamma')
+
+        nat  = len(self.a)
+        K    = self.K
+
+        # Structure factors separate into the lattice directions
+        s_c  = [ ]
+        for c in range(3):
+            m  = np.fft.fftfreq(K[c], 1.0/K[c])
+            s_c += [ np.sum(self.w[:, c, :, None]*
+                            np.exp(-2j*pi*self.idx[:, c, :, None]*m/K[c]),
+                            axis=1) ]
+
+        m1, m2, m3  = np.nonzero((self.m2 <= self.m_max**2) & (self.kernel > 0.0))
+        kernel      = self.kernel[m1, m2, m3]
+
+        G      = np.zeros([nat, nat], dtype=float)
+        nm     = max(1, 2**20//nat)
+        for i in range(0, len(kernel), nm):
+            S  = s_c[0][:, m1[i:i+nm]]*s_c[1][:, m2[i:i+nm]]*s_c[2][:, m3[i:i+nm]]
+            G += np.dot(S.conj()*kernel[i:i+nm], S.transpose()).real
+
+        G += self.phi_op.toarray()
+        G[np.diag_indices_from(G)] -= 2*self.beta/sqrt(pi)
+        G -= pi/(self.V*self.beta**2)
+
+        self.timer.stop('get_gamma')
+        return G
+
+
+### For use as a standalone calculator
+
+    def get_potential_energy(self, a=None):
+        """
+        Return the Coulomb energy.
+        """
+        if a is not None:
+            self.update(a)
+
+        return np.sum(self.q_a*self.phi_a)/2
+
+    def get_forces(self, a=None):
+        """
+        Return forces
+        """
+        if a is not None:
+            self.update(a)
+
+        return self.q_a.reshape(-1, 1)*self._field()
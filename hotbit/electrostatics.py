@@ -39,11 +39,66 @@ else:
 log2 = log(2.0)
 
 
+def _pair_constants(x, il, jl, f):
+    """
+    Return f(x_i, x_j) for pairs (i, j).
+
+    f is evaluated only once for each pair of distinct values of x
+    (i.e. once per element pair).
+    """
+    u, t = np.unique(np.asarray(x, dtype=float), return_inverse=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table = f(u.reshape(-1, 1), u.reshape(1, -1))
+    return table[t[il], t[jl]]
+
+
+def _gamma_pairs(a, cutoff, neighbors):
+    """
+    Return pairs (i, j), distances (in Bohr) and normal vectors within cutoff.
+    """
+    if neighbors is None:
+        il, jl, dl, nl = get_neighbors(a, cutoff)
+    else:
+        il, jl, dl, nl = neighbors(cutoff)
+    if il is None:
+        return np.zeros(0, int), np.zeros(0, int), np.zeros(0), np.zeros((0, 3))
+    return il, jl, dl/Bohr, nl
+
+
+def _gamma_matrices(nat, U, il, jl, dl, nl, g, dg, sparse, virial):
+    """
+    Accumulate G and dG from the pair values g and derivatives dg.
+
+    G_ij = U_i delta_ij + sum_n g(d_ijn) and dG_ij = -sum_n g'(d_ijn) n_ijn;
+    with sparse=True, dG is returned as the pair list (i, j, dG[p]).
+    """
+    G  = np.zeros([nat, nat], dtype=float)
+    np.add.at(G.reshape(-1), il*nat+jl, g)
+    G[diag_indices_from(G)] += U
+    dGp = -dg.reshape(-1, 1)*nl
+    if sparse:
+        dG = ( il, jl, dGp )
+    else:
+        dG = np.zeros([nat, nat, 3], dtype=float)
+        np.add.at(dG.reshape(-1, 3), il*nat+jl, dGp)
+    if virial:
+        return G, dG, _pair_virials(il, jl, dl, nl, dg)
+    return G, dG
+
+
 def get_Gaussian_gamma_correction(a, U, FWHM=None,
-                                  cutoff=None, accuracy_goal=12):
+                                  cutoff=None, accuracy_goal=12, virial=False,
+                                  sparse=False, neighbors=None):
     """
     Gaussian charge distribution.
+
+    With virial=True, return also the pair virials (i, j, W), where
+    W[p] = gamma'(d) d n n for pair p, to be weighted by dq_i dq_j.
+    With sparse=True, dG is returned as the pair list (i, j, dG[p]).
+
+    neighbors(cutoff) returns the pairs as get_neighbors (default).
     """
+    U = np.asarray(U, dtype=float)
     if FWHM is None:
         FWHM = sqrt(8*log2/pi)/U
 
@@ -53,89 +108,105 @@ def get_Gaussian_gamma_correction(a, U, FWHM=None,
                          max_FWHM)
 
     if cutoff is None and not a.is_cluster():
-        # Estimate a cutoff from the accuracy goal if the
-        # system is periodic and no cutoff was given
+        # Estimate a cutoff from the accuracy goal if the system is periodic
+        # and no cutoff was given (clusters use all pairs); with
+        # accuracy_goal=12 the neglected terms are about 1e-12 Ha
+        # for U~0.36 Ha (larger for smaller U)
         cutoff = sqrt(log(10.0)*accuracy_goal*max_FWHM/(sqrt(4*log2)))
 
-    il, jl, dl, nl = get_neighbors(a, cutoff)
+    il, jl, dl, nl = _gamma_pairs(a, cutoff, neighbors)
 
-    nat = len(a)
-    G   = np.zeros([nat, nat], dtype=float)
-    dG  = np.zeros([nat, nat, 3], dtype=float)
-    G[diag_indices_from(G)] = U
+    const  = _pair_constants(FWHM, il, jl,
+                             lambda fi, fj: 2*np.sqrt( log2/(fi**2+fj**2) ))
+    ecr    = -erfc(const*dl)
+    decr   = 2/sqrt(pi)*np.exp(-(const*dl)**2)*const
+    g      = ecr/dl
+    dg     = -(ecr/dl-decr)/dl
 
-    if il is not None:
-        for i, j, d, n in zip(il, jl, dl/Bohr, nl):
-            const        = 2*sqrt( log2/(FWHM[i]**2+FWHM[j]**2) )
-            ecr          = -erfc(const*d)
-            decr         = 2/sqrt(pi)*exp(-(const*d)**2)*const
-            G[i, j]     += ecr/d
-            dG[i, j, :] += (ecr/d-decr)*n/d
-
-    return G, dG
+    return _gamma_matrices(len(a), U, il, jl, dl, nl, g, dg, sparse, virial)
 
 
 def get_Slater_gamma_correction(a, U, FWHM=None,
-                                cutoff=None, accuracy_goal=12):
+                                cutoff=None, accuracy_goal=12, virial=False,
+                                sparse=False, neighbors=None):
     """
     Slater-type charge distribution.
     See: M. Elstner et al., Phys. Rev. B 58, 7260 (1998)
+
+    With virial=True, return also the pair virials, with sparse=True dG
+    as a pair list; neighbors as in get_Gaussian_gamma_correction.
     """
+    U = np.asarray(U, dtype=float)
     min_U = np.min(U)
     if min_U <= 0.0:
         raise ValueError("Minimum U (%f) smaller than or equal to zero. " %
                          min_U)
 
     if cutoff is None and not a.is_cluster():
-        # Estimate a cutoff from the accuracy goal if the
-        # system is periodic and no cutoff was given
+        # Estimate a cutoff from the accuracy goal if the system is periodic
+        # and no cutoff was given (clusters use all pairs); looser than
+        # for Gaussians: with accuracy_goal=12 the neglected terms are
+        # about 1e-7 Ha for U~0.36 Ha
         cutoff = sqrt(log(10.0)*accuracy_goal/(sqrt(pi/2)*min_U))
 
-    tau = 16*np.asarray(U)/5
-
-    il, jl, dl, nl = get_neighbors(a, cutoff)
-
-    nat = len(a)
-    G   = np.zeros([nat, nat], dtype=float)
-    dG  = np.zeros([nat, nat, 3], dtype=float)
-    G[diag_indices_from(G)] = U
-
-    if il is not None:
-        for i, j, d, n in zip(il, jl, dl/Bohr, nl):
-            if abs(tau[i] - tau[j]) < 1e-6:
-                src = 1.0/(tau[i]+tau[j])
-                fac = tau[i]*tau[j]*src
-                avg = 1.6*(fac+fac*fac*src)
-                fac = avg*d
-                fac2 = fac*fac
-                efac = exp(-fac)/(48*d)
-                h = -(48 + 33*fac + fac2*(9+fac))*efac
-                G[i, j] += \
-                    h
-                dG[i, j, :] += \
-                    (   h/d \
-                      + avg*h \
-                      + (33*avg + 18*fac*avg + 3*fac2*avg)*efac )*n
-            else:
-                fi1  = 1.0/(2*(tau[i]**2-tau[j]**2)**2)
-                fj1  = -tau[i]**4*tau[j]*fi1
-                fi1 *= -tau[j]**4*tau[i]
-
-                fi2  = 1.0/((tau[i]**2-tau[j]**2)**3)
-                fj2  = -(tau[i]**6-3*tau[i]**4*tau[j]**2)*fi2
-                fi2 *=  (tau[j]**6-3*tau[j]**4*tau[i]**2)
-
-                expi = exp(-tau[i]*d)
-                expj = exp(-tau[j]*d)
-
-                G[i, j] += \
-                      expi*(fi1+fi2/d) \
-                    + expj*(fj1+fj2/d)
-                dG[i, j, :] += \
-                    (   expi*(tau[i]*(fi1+fi2/d) + fi2/(d**2)) \
-                      + expj*(tau[j]*(fj1+fj2/d) + fj2/(d**2)) )*n
+    tau = 16*U/5
+
+    il, jl, dl, nl = _gamma_pairs(a, cutoff, neighbors)
+
+    g  = np.zeros(len(il))
+    dg = np.zeros(len(il))
+
+    # equal (or close) taus
+    eq = _pair_constants(tau, il, jl, lambda ti, tj: abs(ti-tj) < 1e-6)
+    p  = np.flatnonzero(eq)
+    if len(p) > 0:
+        def average(ti, tj):
+            src = 1.0/(ti+tj)
+            fac = ti*tj*src
+            return 1.6*(fac+fac*fac*src)
+        avg  = _pair_constants(tau, il[p], jl[p], average)
+        d    = dl[p]
+        fac  = avg*d
+        fac2 = fac*fac
+        efac = np.exp(-fac)/(48*d)
+        h    = -(48 + 33*fac + fac2*(9+fac))*efac
+        g[p]  = h
+        dg[p] = -(   h/d
+                   + avg*h
+                   + (33*avg + 18*fac*avg + 3*fac2*avg)*efac )
+
+    # different taus
+    p  = np.flatnonzero(~eq)
+    if len(p) > 0:
+        ip, jp = il[p], jl[p]
+        fi1 = _pair_constants(tau, ip, jp,
+                              lambda ti, tj: -tj**4*ti/(2*(ti**2-tj**2)**2))
+        fj1 = _pair_constants(tau, ip, jp,
+                              lambda ti, tj: -ti**4*tj/(2*(ti**2-tj**2)**2))
+        fi2 = _pair_constants(tau, ip, jp,
+                              lambda ti, tj: (tj**6-3*tj**4*ti**2)/((ti**2-tj**2)**3))
+        fj2 = _pair_constants(tau, ip, jp,
+                              lambda ti, tj: -(ti**6-3*ti**4*tj**2)/((ti**2-tj**2)**3))
+        ti, tj = tau[ip], tau[jp]
+        d    = dl[p]
+        expi = np.exp(-ti*d)
+        expj = np.exp(-tj*d)
+        g[p]  =   expi*(fi1+fi2/d) \
+                + expj*(fj1+fj2/d)
+        dg[p] = -(   expi*(ti*(fi1+fi2/d) + fi2/(d**2))
+                   + expj*(tj*(fj1+fj2/d) + fj2/(d**2)) )
+
+    return _gamma_matrices(len(a), U, il, jl, dl, nl, g, dg, sparse, virial)
+
+
+def _pair_virials(il, jl, dl, nl, dg):
+    """
+    Return (i, j, W) with W[p] = gamma'(d) d n n for the pairs p.
 
-    return G, dG
+    The virial of the correction is then 1/2 sum_p dq_i dq_j W[p].
+    """
+    W = (dg*dl).reshape(-1,1,1)*nl[:,:,None]*nl[:,None,:]
+    return il, jl, W
 
 
 _gamma_correction_dict = {
@@ -153,7 +224,12 @@ class Electrostatics:
         self.N = len(calc.el)
         self.dq = np.zeros((self.N))
         self.G = np.zeros((self.N,self.N))
-        self.dG = np.zeros((self.N,self.N,3))
+        self.sparse = calc.get('sparse_gamma')
+        if self.sparse:
+            self.dG = (np.zeros(0,int), np.zeros(0,int), np.zeros((0,3)))
+        else:
+            self.dG = np.zeros((self.N,self.N,3))
+        self.Wp = (np.zeros(0,int), np.zeros(0,int), np.zeros((0,3,3)))
 
         self.accuracy_goal = accuracy_goal
 
@@ -175,7 +251,7 @@ class Electrostatics:
     def set_dq(self,dq):
         """ (Re)setting dq gives new gamma-potential. """
         self.dq=dq
-        self.epsilon = np.sum(self.G*self.dq, axis=1)
+        self.epsilon = dot(self.G, self.dq)
         if self.solver is not None:
             self.solver.update(self.calc.el.atoms, dq)
             # Unit mess: The Coulomb solver is unit agnostic, but the Elements
@@ -208,12 +284,37 @@ class Electrostatics:
                 # Elements object returns the distances in Bohr
                 # (from get_distances())
                 E = self.solver.get_field()*Bohr**2
-            depsilon  = np.sum(self.dq.reshape(1, -1, 1)*self.dG, axis=1)
+            if self.sparse:
+                i, j, dGp = self.dG
+                depsilon  = np.zeros((self.N,3))
+                for c in range(3):
+                    depsilon[:,c] = np.bincount(i, weights=self.dq[j]*dGp[:,c],
+                                                minlength=self.N)
+            else:
+                depsilon  = np.sum(self.dq.reshape(1, -1, 1)*self.dG, axis=1)
             f         = self.dq.reshape(-1, 1) * ( depsilon + E )
             self.calc.stop_timing('f_es')
             return f
 
 
+    def gamma_virial(self):
+        """
+        Return the virial of electrostatic interactions.
+
+        W_ab = 1/2 sum_(i,j,n) dq_i dq_j gamma'(dijn) rijn_a rijn_b/dijn
+        """
+        if not self.SCC:
+            return np.zeros((3,3))
+        self.calc.start_timing('virial_es')
+        i, j, Wp = self.Wp
+        W = 0.5*np.tensordot(self.dq[i]*self.dq[j],Wp,axes=(0,0))
+        if self.solver is not None:
+            # Unit mess: the solver is unit agnostic (see set_dq)
+            W = W + self.solver.get_virial()*Bohr
+        self.calc.stop_timing('virial_es')
+        return W
+
+
     def construct_h1(self,dq=None):
         """ Make the electrostatic part of the Hamiltonian. """
         self.calc.start_timing('h1')
@@ -259,19 +360,47 @@ class Electrostatics:
         FWHM = [ self.calc.el.get_element(i).get_FWHM()
                  for i in range(len(a)) ]
 
-        G, dG = self.gamma_correction(a, U,
-                                      FWHM = FWHM,
-                                      cutoff = self.calc.get('gamma_cut'),
-                                      accuracy_goal = self.accuracy_goal)
+        G, dG, Wp = self.gamma_correction(a, U,
+                                          FWHM = FWHM,
+                                          cutoff = self.calc.get('gamma_cut'),
+                                          accuracy_goal = self.accuracy_goal,
+                                          virial = True,
+                                          sparse = self.sparse,
+                                          neighbors = self._neighbors)
 
-        self.G, self.dG  = G, dG
+        self.G, self.dG, self.Wp  = G, dG, Wp
 
         self.ext = np.array( [self.calc.env.phi(i) for i in range(self.N)] )
         self.calc.stop_timing('gamma matrix')
 
 
+    def _neighbors(self, cutoff):
+        '''
+        Return (i, j, d, n) as hotbit.neighbors.get_neighbors.
+
+        The pairs are taken from the pair list of Elements (built for the
+        Hamiltonian) when it contains all pairs within cutoff (Angstrom),
+        otherwise they are searched again. Without cutoff (clusters),
+        all pairs are returned.
+        '''
+        el = self.calc.el
+        if cutoff is None:
+            return get_neighbors(el.atoms, None)
+        if not ( el.atoms.is_cluster() or cutoff/Bohr<=self.calc.ia.hscut.min() ):
+            return get_neighbors(el.atoms, cutoff)
+        i, j, n, rij, dij = el.get_pair_list(cutoff/Bohr, full=True)
+        select = dij*Bohr < cutoff
+        if not np.any(select):
+            return None, None, None, None
+        i, j, rij, dij = i[select], j[select], rij[select], dij[select]
+        return i, j, dij*Bohr, -rij/dij.reshape(-1,1)
+
+
     def get_gamma(self):
-        return self.G + self.solver.get_gamma()*Bohr
+        G = self.solver.get_gamma()
+        if G is None:
+            return self.G
+        return self.G + G*Bohr
 
 
 ### For use as a standalone calculator, return eV/A units
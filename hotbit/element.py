@@ -5,7 +5,7 @@ import numpy as np
 from box import mix
 import numpy as npy
 from box.data import data
-from hotbit.io import read_element
+from hotbit.io import read_element, isfile
 
 orbital_list=['s','px','py','pz','dxy','dyz','dzx','dx2-y2','d3z2-r2']
                 
@@ -36,9 +36,9 @@ class Element:
         # if .elm file exists, read more data
         hbp = os.environ.get('HOTBIT_PARAMETERS')
         default='%s/%s' %(hbp,filename)
-        if os.path.isfile(filename):
+        if isfile(filename):
             file=filename
-        elif os.path.isfile(default):
+        elif isfile(default):
             file=default
         else:
             raise AssertionError('Element data for %s not found neither in %s '
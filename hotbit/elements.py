@@ -10,6 +10,9 @@ from os import environ,path
 from weakref import proxy
 from copy import copy, deepcopy
 from hotbit.atoms import container_magic
+from hotbit.neighbors import cell_list_pairs
+from hotbit.symmetrycache import SymmetryCache, symmetry_key
+from hotbit.io import isfile
 
 
 
@@ -35,6 +38,9 @@ class Elements:
         self.N = len(atoms)
         self.name = None
         self.positions = None
+        self._rijn, self._dijn = None, None
+        self._pair_lists = {}
+        self.symcache = SymmetryCache()
         if charge == None:
             self.charge = calc.get_charge()
 
@@ -57,7 +63,7 @@ class Elements:
             for key in elements:
                 if key == 'rest': continue
                 file = elements[key]
-                if not path.isfile(file):
+                if not isfile(file):
                     raise RuntimeError('Custom element file "%s" for %s not found.' %(file,key))
                 else:
                     file = path.abspath(file)
@@ -68,7 +74,7 @@ class Elements:
             for key in self.symbols:
                 if self.files[key] != None: continue
                 file = path.join(default,'%s.elm' %key)
-                if not path.isfile(file):
+                if not isfile(file):
                     raise RuntimeError('Default element file "%s" for %s not found.' %(file,key))
                 else:
                     self.files[key] = file
@@ -179,68 +185,56 @@ class Elements:
         '''
         self.calc.start_timing('geometry')
         self._update_atoms(atoms)
-        # select the symmetry operations n where atoms still interact chemically
-        nmax = len(self.ranges[0])*len(self.ranges[1])*len(self.ranges[2])
-        ijn = np.zeros( (self.N,self.N,nmax),int )
-        ijnn = np.zeros( (self.N,self.N),int )
+        self._rijn, self._dijn = None, None
+        self._pair_lists = {}
+        self.symcache.update( symmetry_key(self.atoms) )
 
-        # add the n=(0,0,0) first (separately)
-        self.Rn = [[self.nvector(r=i,ntuple=(0,0,0)) for i in range(self.N)]]
-        self.Rot = [ self.rotation((0,0,0)) ]
-        self.ntuples = [(0,0,0)]
-
-        for i in range(self.N):
-            for j in range(self.N):
-                dij = np.linalg.norm( self.Rn[0][i]-self.Rn[0][j] )
-                if dij < self.calc.ia.hscut[i,j]:
-                    ijn[i,j,ijnn[i,j]] = 0
-                    ijnn[i,j] += 1
-
-
-        # calculate the distances from unit cell 0 to ALL other possible; select chemically interacting
+        # calculate the positions in ALL possible symmetry operations
         self.calc.start_timing('operations')
         # FIXME!!! This does not consider 'gamma_cut'!
-        cut2 = self.calc.ia.hscut**2
-        n = 1
+        hscut = self.calc.ia.hscut
+        cut = hscut.max()
+        R0 = self._image_positions((0,0,0))
+        lo, hi = R0.min(axis=0)-cut, R0.max(axis=0)+cut
+        ntuples = [(0,0,0)]
+        Rn = [R0]
         for n1 in self.ranges[0]:
             for n2 in self.ranges[1]:
                 for n3 in self.ranges[2]:
                     nt = (n1,n2,n3)
                     if nt==(0,0,0): continue
-                    # check that any atom interacts with this unit cell
-                    R = np.array([self.nvector(r=i,ntuple=nt) for i in range(self.N)])
-                    rn  = np.array(self.Rn[0])
-
-                    dRt = rn[:, 0].reshape(1,-1)-R[:, 0].reshape(-1,1)
-                    dR  = dRt*dRt
-                    dRt = rn[:, 1].reshape(1,-1)-R[:, 1].reshape(-1,1)
-                    dR += dRt*dRt
-                    dRt = rn[:, 2].reshape(1,-1)-R[:, 2].reshape(-1,1)
-                    dR += dRt*dRt
-                    addn = np.any(dR <= cut2)
-
-                    if addn:
-                        n += 1
-                        self.ntuples.append(nt)
-                        self.Rn.append(R)
-                        self.Rot.append( self.rotation(nt) )
-
-        self.ijn = ijn
-        self.ijnn = ijnn
-        self.Rn = np.array(self.Rn)
-        self.Rot = np.array(self.Rot)
+                    # any atom within the cutoff from the box around unit cell 0?
+                    R = self._image_positions(nt)
+                    if np.any( np.all((R>=lo) & (R<=hi),axis=1) ):
+                        ntuples.append(nt)
+                        Rn.append(R)
+        Rn = np.array(Rn)
         self.calc.stop_timing('operations')
 
+        # select chemically interacting pairs (and symmetry operations)
         self.calc.start_timing('displacements')
-        rijn = np.zeros((len(self.ntuples),self.N,self.N,3))
-        dijn = np.zeros((len(self.ntuples),self.N,self.N))
-        # Fixme!!! Think about how to use numpy for speedup!
-        for i in range(self.N):
-            for j in range(self.N):
-                rijn[:,i,j,:] = self.Rn[:,j,:] - self.Rn[0,i,:]
-                dijn[:,i,j]   = np.sqrt( (rijn[:,i,j,:]**2).sum(axis=1) )
-        self.rijn = rijn
-        self.dijn = dijn
+        k = np.flatnonzero( np.all((Rn>=lo) & (Rn<=hi),axis=2).ravel() )
+        i, kk = cell_list_pairs(R0,Rn.reshape(-1,3)[k],cut+1E-10)
+        n, j = k[kk]//self.N, k[kk]%self.N
+        rij = Rn[n,j]-R0[i]
+        dij = np.sqrt( (rij**2).sum(axis=1) )
+        select = (dij<=hscut[i,j]) & ((n>0) | (i!=j))
+        i, j, n, rij, dij = i[select], j[select], n[select], rij[select], dij[select]
+
+        used = np.unique( np.concatenate(([0],n)) )
+        nmap = np.zeros(len(ntuples),int)
+        nmap[used] = np.arange(len(used))
+        self.ntuples = [ntuples[u] for u in used]
+        self.Rn = Rn[used]
+        self.Rot = np.array([self.symcache.get('rotation',nt,lambda: self.rotation(nt)) \
+                             for nt in self.ntuples])
+
+        # each pair once
+        n = nmap[n]
+        select = (i<j) | ((i==j) & (n>0))
+        i, j, n, rij, dij = i[select], j[select], n[select], rij[select], dij[select]
+        order = np.lexsort((n,j,i))
+        self.pairs = ( i[order], j[order], n[order], rij[order], dij[order] )
         self.calc.stop_timing('displacements')
 
 
@@ -271,8 +265,91 @@ class Elements:
         return self.ntuples
 
     def get_distances(self):
-        # FIXME!!! Update distances first?
-        return self.rijn, self.dijn
+        '''
+        Return the dense tables rijn[n,i,j] = R_j^n-R_i (nops,N,N,3) and
+        dijn = |rijn| (nops,N,N).
+
+        The tables are constructed on demand and their size grows as N^2
+        times the number of symmetry operations; use get_pair_list if possible.
+        '''
+        if self._rijn is None:
+            self._rijn = self.Rn[:,None,:,:] - self.Rn[0][None,:,None,:]
+            self._dijn = np.sqrt( (self._rijn**2).sum(axis=3) )
+        return self._rijn, self._dijn
+
+    rijn = property(lambda self: self.get_distances()[0])
+    dijn = property(lambda self: self.get_distances()[1])
+
+
+    def get_pair_list(self,cutoff=None,full=False):
+        '''
+        Return the list of interacting atom pairs.
+
+        By default, the pairs are the chemically interacting ones, with
+        |R_j^n-R_i| within the Slater-Koster cutoff. Each pair is listed
+        once (i<=j; i==j only for n!=(0,0,0)) for every symmetry operation n.
+        The list is sorted with respect to (i,j,n).
+
+        Only the symmetry operations in get_transforms() are considered,
+        also for cutoffs larger than the Slater-Koster cutoff.
+
+        @param cutoff: pairs with |R_j^n-R_i|<=cutoff (Bohr) instead
+        @param full:   list also the reverse pairs (all i,j)
+        @return: i, j, n (indices to ntuples), rijn (npairs,3), dijn (npairs,)
+        '''
+        if cutoff is None and not full:
+            return self.pairs
+        key = (cutoff,full)
+        if key not in self._pair_lists:
+            if cutoff is None:
+                cut = self.calc.ia.hscut.max()
+            else:
+                cut = cutoff
+            R0 = self.Rn[0]
+            lo, hi = R0.min(axis=0)-cut, R0.max(axis=0)+cut
+            k = np.flatnonzero( np.all((self.Rn>=lo) & (self.Rn<=hi),axis=2).ravel() )
+            i, kk = cell_list_pairs(R0,self.Rn.reshape(-1,3)[k],cut+1E-10)
+            n, j = k[kk]//self.N, k[kk]%self.N
+            rij = self.Rn[n,j]-R0[i]
+            dij = np.sqrt( (rij**2).sum(axis=1) )
+            if cutoff is None:
+                select = dij<=self.calc.ia.hscut[i,j]
+            else:
+                select = dij<=cutoff
+            select &= (n>0) | (i!=j)
+            if not full:
+                select &= (i<j) | ((i==j) & (n>0))
+            i, j, n, rij, dij = i[select], j[select], n[select], rij[select], dij[select]
+            order = np.lexsort((n,j,i))
+            self._pair_lists[key] = ( i[order], j[order], n[order], rij[order], dij[order] )
+        return self._pair_lists[key]
+
+
+    def _image_positions(self,ntuple):
+        '''
+        Return the positions (in Bohr) of all atoms operated by S(n).
+
+        The transformations of the containers operate on single vectors.
+        If the transformation is affine (checked for a few atoms), the
+        positions are obtained by one matrix product, otherwise atom by atom.
+
+        @param ntuple: 3-tuple for symmetry operation
+        '''
+        def affine():
+            with np.errstate(all='ignore'):
+                r0 = self.atoms.transform(np.zeros(3),ntuple)
+                A  = np.array([self.atoms.transform(e,ntuple) for e in np.eye(3)]) - r0
+            return r0, A
+
+        r = self.atoms.get_positions()
+        r0, A = self.symcache.get('affine',ntuple,affine)
+        with np.errstate(all='ignore'):
+            rn = r0 + np.dot(r,A)
+        check = sorted(set([0,self.N//2,self.N-1]))
+        ref = np.array([self.atoms.transform(r[i],ntuple) for i in check])
+        if not np.allclose(rn[check],ref,rtol=0,atol=1E-10*(1+np.abs(ref).max())):
+            rn = np.array([self.atoms.transform(ri,ntuple) for ri in r])
+        return rn/Bohr
 
 
     def rotation_of_axes(self,n):
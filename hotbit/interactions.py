@@ -5,13 +5,13 @@ from box import mix
 import numpy as np
 from hotbit import auxil
 from box.interpolation import MultipleSplineFunction
+from hotbit.blockmatrices import BlockMatrices
 from weakref import proxy
 from copy import copy
 from os import path
-from hotbit.io import read_HS
+from hotbit.io import read_HS, find_value, isfile
 from math import cos, sin, sqrt
 
-from _hotbit import fast_slako_transformations
 
 dot=np.dot
 array=np.array
@@ -26,6 +26,13 @@ integrals={'dds':0,'ddp':1,'ddd':2,'pds':3,'pdp':4,'pps':5,'ppp':6,\
            'sds':7,'sps':8,'sss':9,'dps':10,'dpp':11,'dss':12,'pss':13}
 
 
+def _column(d2,index,parity=1):
+    """ Return parity*d2[:,index], or None if there are no derivatives. """
+    if d2 is None:
+        return None
+    return parity*d2[:,index]
+
+
 
 
 
@@ -43,7 +50,6 @@ class Interactions:
         print("ENTER Interactions constructor")
 
         from os import environ
-        from os.path import isfile
 
         tables = copy(calc.get('tables'))
         present = calc.el.get_present()
@@ -99,6 +105,8 @@ class Interactions:
         self.max_cut = 0.0 # maximum interaction range in Bohrs
         self.read_tables()
         self.first=True
+        self.blocks=None
+        self.H0, self.S, self.dH0, self.dS = None, None, None, None
 
         print("EXIT Interactions constructor")
 
@@ -125,7 +133,7 @@ class Interactions:
                     txt+='  %s%s: None\n' %(s1,s2)
                 else:
                     txt+='  %s%s in %s\n' %(s1,s2,file)
-                    doc=mix.find_value(file,'slako_comment',fmt='strings',default=['no slako doc'])
+                    doc=find_value(file,'slako_comment',fmt='strings',default=['no slako doc'])
                     for line in doc:
                         txt+='    *'+line.lstrip()+'\n'
         return txt
@@ -152,11 +160,11 @@ class Interactions:
                 if self.files[sj+si] is None:
                     raise RuntimeError('No parametrization specified for %s-%s interaction.' % ( sj, si ))
                 #
-                x_ij, table_ij = read_HS(self.files[si+sj], si, sj)
+                x_ij, table_ij, d2_ij = read_HS(self.files[si+sj], si, sj, derivatives=True)
                 self.cut[si+sj] = x_ij[-1]
                 print("Reading file: ", self.files[si+sj])
                 #
-                x_ji, table_ji = read_HS(self.files[sj+si], sj, si)
+                x_ji, table_ji, d2_ji = read_HS(self.files[sj+si], sj, si, derivatives=True)
                 self.cut[sj+si] = x_ji[-1]
                 print("Reading file: ", self.files[sj+si])
                 #
@@ -166,6 +174,11 @@ class Interactions:
                 ei, ej = self.calc.el.elements[si], self.calc.el.elements[sj]
                 valence_i, valence_j = ei.get_valence_orbitals(), ej.get_valence_orbitals()
 
+                # the spline second derivatives of the tables can be used
+                # only if both tables are on the same grid
+                if not np.array_equal(x_ij,x_ji):
+                    d2_ij, d2_ji = None, None
+
                 pair = si + sj
                 self.h[pair] = MultipleSplineFunction(x_ij)
                 self.s[pair] = MultipleSplineFunction(x_ji)
@@ -181,12 +194,12 @@ class Interactions:
                                 # this is tabulated in other table; switch order -> parity factor
                                 parity = (-1)**( aux[li]+aux[lj] )
                                 index = integrals[short[1]+short[0]+short[2]]
-                                self.h[pair].add_function(table_ji[:,index]*parity,table,integrals[short])
-                                self.s[pair].add_function(table_ji[:,index+10]*parity,table,integrals[short])
+                                self.h[pair].add_function(table_ji[:,index]*parity,table,integrals[short],d2=_column(d2_ji,index,parity))
+                                self.s[pair].add_function(table_ji[:,index+10]*parity,table,integrals[short],d2=_column(d2_ji,index+10,parity))
                             else:
                                 index=integrals[short]
-                                self.h[pair].add_function(table_ij[:,index],table,integrals[short])
-                                self.s[pair].add_function(table_ij[:,index+10],table,integrals[short])
+                                self.h[pair].add_function(table_ij[:,index],table,integrals[short],d2=_column(d2_ij,index))
+                                self.s[pair].add_function(table_ij[:,index+10],table,integrals[short],d2=_column(d2_ij,index+10))
 
         # cutoffs for atom pair indices
         N = self.calc.el.N
@@ -286,23 +299,109 @@ class Interactions:
 
         phases[n,k]
         """
-        return np.array(self.phases)
+        return self.phases
+
+
+    def construct_blocks(self, derivatives=True):
+        """
+        Construct the real-space Hamiltonian and overlap blocks.
+
+        Only the atom pairs within the Slater-Koster cutoffs, as
+        returned by Elements.get_pair_list, are visited.
+
+        @param derivatives: construct also the derivatives of the blocks
+        """
+        el = self.calc.el
+        blocks = BlockMatrices(el.first_orbitals, el.nr_orbitals,
+                               [orb['energy'] for orb in el.orbitals()],
+                               seps=self.calc.get('sepsilon'))
 
+        DTn = np.array([el.symcache.get('orbital transformation',nt,
+                                        lambda: self.rotation_transformation(nt)) \
+                        for nt in el.ntuples])
 
-    def get_matrices(self, kpts=None):
-        """ Hamiltonian and overlap matrices. """
+        pi, pj, pn, prijn, pdijn = el.get_pair_list()
+        if np.any(pdijn<0.1):
+            p = np.flatnonzero(pdijn<0.1)[0]
+            print(el.ntuples[pn[p]])
+            raise AssertionError('Distance between atoms %i and %i is only %.4f Bohr' %(pi[p],pj[p],pdijn[p]) )
+        symbols = np.array(el.symbols)
+
+        for si in self.present:
+            for sj in self.present:
+                htable = self.h[si+sj]
+                stable = self.s[si+sj]
+                r1, r2 = htable.get_range()
+                sel = np.flatnonzero( (symbols[pi]==si) & (symbols[pj]==sj) & \
+                                      (pdijn>=r1) & (pdijn<=r2) )
+                if len(sel)==0:
+                    continue
+                noi, noj = el.nr_orbitals[pi[sel[0]]], el.nr_orbitals[pj[sel[0]]]
+                n, dij = pn[sel], pdijn[sel]
+                rijh = prijn[sel]/dij.reshape(-1,1)
+                npairs = len(sel)
+
+                # interpolate Slater-Koster tables and derivatives
+                indices = htable.get_indices()
+                hij, dhij = htable(dij)
+                sij, dsij = stable(dij)
+                h, s = zeros((npairs,14)), zeros((npairs,14))
+                h[:,indices], s[:,indices] = hij.transpose(), sij.transpose()
+                dh, ds = None, None
+                if derivatives:
+                    dh, ds = zeros((npairs,14,3)), zeros((npairs,14,3))
+                    dh[:,indices,:] = dhij.transpose()[:,:,None]*rijh[:,None,:]
+                    ds[:,indices,:] = dsij.transpose()[:,:,None]*rijh[:,None,:]
+
+                # make the Slater-Koster transformations
+                ht, st, dht, dst = \
+                    slako_transformations_batch(rijh,dij,noi,noj,h,s,dh,ds)
+
+                # Here we do the MEL transformation;
+                # H'_ij = sum_k H_ik * D_kj^T  ( |j> = sum_k D_jk |k> )
+                DT = DTn[n][:,0:noj,0:noj]
+                hb = np.einsum('pik,pkj->pij',ht,DT)
+                sb = np.einsum('pik,pkj->pij',st,DT)
+                dhb, dsb = None, None
+                if derivatives:
+                    dhb = np.einsum('pika,pkj->pija',dht,DT)
+                    dsb = np.einsum('pika,pkj->pija',dst,DT)
+
+                blocks.add_group(si+sj, pi[sel], pj[sel], pn[sel], hb, sb, dhb, dsb, prijn[sel])
+        return blocks
+
+
+    def get_blocks(self, derivatives=False):
+        """
+        Return the block-sparse real-space matrices of the last get_matrices call.
+
+        @param derivatives: make sure the blocks contain also derivatives
+                            (the blocks are re-constructed if necessary)
+        """
+        if derivatives and not self.blocks.has_derivatives():
+            self.calc.start_timing('blocks')
+            self.blocks = self.construct_blocks(derivatives=True)
+            self.calc.stop_timing('blocks')
+        return self.blocks
+
+
+    def get_matrices(self, kpts=None, derivatives=False):
+        """
+        Hamiltonian and overlap matrices.
+
+        Return H0, S, dH0, dS for all k-points. The dense derivatives dH0 and dS
+        are constructed only if derivatives=True, otherwise they are None
+        (forces are calculated directly from the blocks).
+        """
         
         print("Starting matrix construction")
 
-        timing = False
         el = self.calc.el
         states = self.calc.st
         start = self.calc.start_timing
         stop = self.calc.stop_timing
-        seps = self.calc.get('sepsilon')
         start('matrix construction')
-        orbs=el.orbitals()
-        norb=len(orbs)
+        norb = el.get_nr_orbitals()
 
         if kpts is None:
             nk = states.nk
@@ -312,120 +411,18 @@ class Interactions:
             ks.shape = (-1, 3)
             nk       = ks.shape[0]
 
-        H0  = np.zeros((nk,norb,norb),complex)
-        S   = np.zeros((nk,norb,norb),complex)
-        dH0 = np.zeros((nk,norb,norb,3),complex)
-        dS  = np.zeros((nk,norb,norb,3),complex)
-
-#        orbitals=[[orb['orbital'] for orb in el.orbitals(i)]
-#                  for i in range(len(el))]
-#        orbindex=[el.orbitals(i,indices=True)
-#                  for i in range(len(el))]
-        # FFR: fixed size????
-        h, s, dh, ds = zeros((14,)), zeros((14,)), zeros((14,3)), zeros((14,3))
-
-        phases = []
-        DTn = []
-        Rot = []
-        for n in range(len(el.ntuples)):
-            nt = el.ntuples[n]
-            phases.append( np.array([np.exp(1j*np.dot(nt,k))
-                                     for k in ks]) )
-            DTn.append( self.rotation_transformation(nt) )
-            Rot.append( self.calc.el.rotation(nt) )
-        self.phases = phases
-
-        lst = el.get_property_lists(['i','s','no','o1'])
-        Rijn, dijn = self.calc.el.get_distances()
-        for i,si,noi,o1i in lst:
-            a, b = o1i, o1i+noi
-            # on-site energies only for n==0
-            for orb in el.orbitals(i):
-                ind=orb['index']
-                H0[:,ind,ind] = orb['energy']
-                S[:,ind,ind]  = 1.0 + seps
-            for j,sj,noj,o1j in lst[i:]:
-                c, d = o1j, o1j+noj
-                htable = self.h[si+sj]
-                stable = self.s[si+sj]
-                ij_interact = False
-                r1, r2= htable.get_range()
+        phases = el.symcache.get_phases(el.ntuples,ks)
 
-                for n, (rij,dij) in enumerate(zip(Rijn[:,i,j],dijn[:,i,j])):
-                    if i==j and n==0:
-                        continue
-                    nt = el.ntuples[n]
-                    h.fill(0)
-                    s.fill(0)
-                    dh.fill(0)
-                    ds.fill(0)
-
-                    rijh  = rij/dij
-                    if dij<0.1:
-                        print(nt)
-                        raise AssertionError('Distance between atoms %i and %i is only %.4f Bohr' %(i,j,dij) )
-                    assert dij>0.1
-                    if not r1<=dij<=r2:
-                        continue
-                    ij_interact = True
-
-                    # interpolate Slater-Koster tables and derivatives
-                    if timing: start('splint+SlaKo+DH')
-                    hij, dhij = htable(dij)
-                    sij, dsij = stable(dij)
-
-                    indices = htable.get_indices()
-                    h[indices], s[indices] = hij, sij
-                    dh[indices], ds[indices] = outer(dhij,rijh), outer(dsij,rijh)
-
-                    # make the Slater-Koster transformations
-#                    obsi, obsj=orbindex[i], orbindex[j]
-                    ht, st, dht, dst = \
-                        fast_slako_transformations(rijh,dij,noi,noj,h,s,dh,ds)
-
-                    # Here we do the MEL transformation;
-                    # H'_ij = sum_k H_ik * D_kj^T  ( |j> = sum_k D_jk |k> )
-                    DT = DTn[n]
-                    ht = dot( ht,DT[0:noj,0:noj] )
-                    st = dot( st,DT[0:noj,0:noj] )
-                    dht = dot( dht.transpose((2,0,1)),DT[0:noj,0:noj] ).transpose((1,2,0))
-                    dst = dot( dst.transpose((2,0,1)),DT[0:noj,0:noj] ).transpose((1,2,0))
-                    if timing: stop('splint+SlaKo+DH')
-
-                    if timing: start('k-points')
-                    phase = phases[n]
-                    hblock  = outer(phase,ht.flatten()).reshape(nk,noi,noj)
-                    sblock  = outer(phase,st.flatten()).reshape(nk,noi,noj)
-                    dhblock = outer(phase,-dht.flatten()).reshape(nk,noi,noj,3)
-                    dsblock = outer(phase,-dst.flatten()).reshape(nk,noi,noj,3)
-
-                    H0[ :,a:b,c:d]   += hblock
-                    S[  :,a:b,c:d]   += sblock
-                    dH0[:,a:b,c:d,:] += dhblock
-                    dS[ :,a:b,c:d,:] += dsblock
-                    if timing: stop('k-points')
-
-                    if i!=j and ij_interact:
-                        # construct the other derivatives wrt. atom j.
-                        Rot = self.calc.el.Rot[n]
-                        dht2 = dot( dht,Rot )
-                        dst2 = dot( dst,Rot )
-                        dh2block = outer(phase,dht2.flatten()).reshape(nk,noi,noj,3)
-                        ds2block = outer(phase,dst2.flatten()).reshape(nk,noi,noj,3)
-                        dH0[:,c:d,a:b,:] += dh2block.transpose((0,2,1,3)).conjugate()
-                        dS[ :,c:d,a:b,:] += ds2block.transpose((0,2,1,3)).conjugate()
-
-                if i!=j and ij_interact:
-                    if timing: start('symm')
-                    # Hermitian (and anti-Hermitian) conjugates;
-                    # only if matrix block non-zero
-                    # ( H(k) and S(k) can be (anti)symmetrized as a whole )
-                    # TODO: symmetrization should be done afterwards
-                    H0[ :,c:d,a:b]   =  H0[ :,a:b,c:d].transpose((0,2,1)).conjugate()
-                    S[  :,c:d,a:b]   =  S[  :,a:b,c:d].transpose((0,2,1)).conjugate()
-                    if timing: stop('symm')
+        start('blocks')
+        blocks = self.construct_blocks(derivatives=derivatives)
+        stop('blocks')
+        start('dense matrices')
+        H0, S, dH0, dS = blocks.get_dense(phases, el.Rot, derivatives=derivatives)
+        stop('dense matrices')
 
         if kpts is None:
+            self.phases = phases
+            self.blocks = blocks
             self.H0, self.S, self.dH0, self.dS = H0, S, dH0, dS
 
         if self.first:
@@ -438,6 +435,19 @@ class Interactions:
         return H0, S, dH0, dS
 
 
+    def get_dense_derivatives(self):
+        """
+        Return the dense derivatives dH0[k,i,j,a] and dS[k,i,j,a] for the
+        k-points of the calculation. (Memory-consuming; not needed for forces.)
+        """
+        if self.dH0 is None:
+            blocks = self.get_blocks(derivatives=True)
+            self.calc.start_timing('dense matrices')
+            H0, S, self.dH0, self.dS = blocks.get_dense(self.get_phases(), self.calc.el.Rot)
+            self.calc.stop_timing('dense matrices')
+        return self.dH0, self.dS
+
+
     def get_cutoff(self):
         """ Maximum cutoff. """
         return self.max_cut
@@ -509,279 +519,323 @@ def simple_table_notation(table):
 
 s3=np.sqrt(3.0)
 
-def slako_transformations(rhat,dist,noi,noj,h,s,dh,ds):
-    """
-    Apply Slater-Koster transformation rules to orbitals iorbs and orbitals jorbs,
-    where rhat is vector i->j and table gives the values for given tabulated
-    matrix elements. Convention: orbital name starts with s,p,d,...
+
+def _slako_index_tables():
     """
-    l,m,n=rhat
-    ll,mm,nn=rhat**2
-    dl=(np.array([1,0,0])-l*rhat)/dist
-    dm=(np.array([0,1,0])-m*rhat)/dist
-    dn=(np.array([0,0,1])-n*rhat)/dist
-    dll, dmm, dnn = 2*l*dl, 2*m*dm, 2*n*dn
+    Return the static index tables for Slater-Koster transformations.
 
-    mat=np.zeros((9,9,14))
-    ind=np.zeros((9,9,14),dtype=int)
-    der=np.zeros((9,9,14,3))
+    ind[a,b,k] is the index (to the 14 tabulated integrals) of the k'th
+    term for orbital pair (a,b) and cnt[a,b] is the number of terms.
+    """
+    ind=np.zeros((9,9,3),dtype=int)
     cnt=np.zeros((9,9),dtype=int)+1
     cnt[1:,1:]=2
     cnt[4:,4:]=3
 
-    ht=np.zeros((noi,noj))
-    st=np.zeros((noi,noj))
-    dht=np.zeros((noi,noj,3))
-    dst=np.zeros((noi,noj,3))
+    ind[0,0,0]=9
+    ind[0,1,0]=8
+    ind[0,2,0]=8
+    ind[0,3,0]=8
+    ind[0,4,0]=7
+    ind[0,5,0]=7
+    ind[0,6,0]=7
+    ind[0,7,0]=7
+    ind[0,8,0]=7
+    ind[1,1,0:2]=[5,6]
+    ind[1,2,0:2]=[5,6]
+    ind[1,3,0:2]=[5,6]
+    ind[1,4,0:2]=[3,4]
+    ind[1,5,0:2]=[3,4]
+    ind[1,6,0:2]=[3,4]
+    ind[1,7,0:2]=[3,4]
+    ind[1,8,0:2]=[3,4]
+    ind[2,2,0:2]=[5,6]
+    ind[2,3,0:2]=[5,6]
+    ind[2,4,0:2]=[3,4]
+    ind[2,5,0:2]=[3,4]
+    ind[2,6,0:2]=[3,4]
+    ind[2,7,0:2]=[3,4]
+    ind[2,8,0:2]=[3,4]
+    ind[3,3,0:2]=[5,6]
+    ind[3,4,0:2]=[3,4]
+    ind[3,5,0:2]=[3,4]
+    ind[3,6,0:2]=[3,4]
+    ind[3,7,0:2]=[3,4]
+    ind[3,8,0:2]=[3,4]
+    ind[4,4,0:3]=[0,1,2]
+    ind[4,5,0:3]=[0,1,2]
+    ind[4,6,0:3]=[0,1,2]
+    ind[4,7,0:3]=[0,1,2]
+    ind[4,8,0:3]=[0,1,2]
+    ind[5,5,0:3]=[0,1,2]
+    ind[5,6,0:3]=[0,1,2]
+    ind[5,7,0:3]=[0,1,2]
+    ind[5,8,0:3]=[0,1,2]
+    ind[6,6,0:3]=[0,1,2]
+    ind[6,7,0:3]=[0,1,2]
+    ind[6,8,0:3]=[0,1,2]
+    ind[7,7,0:3]=[0,1,2]
+    ind[7,8,0:3]=[0,1,2]
+    ind[8,8,0:3]=[0,1,2]
+
+    # use the same rules for orbitals when they are reversed (pd ->dp)...
+    for a in range(9):
+        for b in range(a+1,9):
+            ind[b,a,:]=ind[a,b,:]
+
+    # ...but use different indices from table
+    #pd 3:5-->10:12
+    #sd 7->12
+    #sp 8->13
+    ind[1,0,0]=13
+    ind[2,0,0]=13
+    ind[3,0,0]=13
+    ind[4,0,0]=12
+    ind[5,0,0]=12
+    ind[6,0,0]=12
+    ind[7,0,0]=12
+    ind[8,0,0]=12
+    ind[4,1,0:2]=[10,11]
+    ind[5,1,0:2]=[10,11]
+    ind[6,1,0:2]=[10,11]
+    ind[7,1,0:2]=[10,11]
+    ind[8,1,0:2]=[10,11]
+    ind[4,2,0:2]=[10,11]
+    ind[5,2,0:2]=[10,11]
+    ind[6,2,0:2]=[10,11]
+    ind[7,2,0:2]=[10,11]
+    ind[8,2,0:2]=[10,11]
+    ind[4,3,0:2]=[10,11]
+    ind[5,3,0:2]=[10,11]
+    ind[6,3,0:2]=[10,11]
+    ind[7,3,0:2]=[10,11]
+    ind[8,3,0:2]=[10,11]
+    return ind, cnt
+
+slako_ind, slako_cnt = _slako_index_tables()
+
+
+def slako_transformations_batch(rhat,dist,noi,noj,h,s,dh,ds):
+    """
+    Apply Slater-Koster transformation rules for many atom pairs at once.
+
+    parameters:
+    ===========
+    rhat:    unit vectors i->j (npairs,3)
+    dist:    distances (npairs,)
+    noi,noj: number of orbitals on atoms i and j (same for all pairs)
+    h,s:     tabulated matrix elements (npairs,14)
+    dh,ds:   derivatives of tabulated matrix elements (npairs,14,3)
+             (if None, derivatives of the blocks are not calculated)
+
+    return:
+    =======
+    ht,st:   H and S blocks (npairs,noi,noj)
+    dht,dst: derivatives of the blocks (npairs,noi,noj,3) (or None)
+    """
+    rhat = np.asarray(rhat).transpose()
+    l,m,n=rhat
+    ll,mm,nn=rhat**2
+    dl=(np.array([1,0,0]).reshape(3,1)-l*rhat)/dist
+    dm=(np.array([0,1,0]).reshape(3,1)-m*rhat)/dist
+    dn=(np.array([0,0,1]).reshape(3,1)-n*rhat)/dist
+    dll, dmm, dnn = 2*l*dl, 2*m*dm, 2*n*dn
+
+    npairs=len(dist)
+    mat=np.zeros((9,9,3,npairs))
+    der=np.zeros((9,9,3,3,npairs))
     mxorb=max(noi,noj)
 
     mat[0,0,0]=1  #ss
     der[0,0,0]=0
-    ind[0,0,0]=9
 
     if mxorb>=2:   #sp
         mat[0,1,0]=l
         der[0,1,0,:]=dl
-        ind[0,1,0]=8
 
         mat[0,2,0]=m
         der[0,2,0,:]=dm
-        ind[0,2,0]=8
 
         mat[0,3,0]=n
         der[0,3,0,:]=dn
-        ind[0,3,0]=8
 
     if mxorb>=5:   #sd
         mat[0,4,0]=s3*l*m
         der[0,4,0,:]=s3*(dl*m+l*dm)
-        ind[0,4,0]=7
 
         mat[0,5,0]=s3*m*n
         der[0,5,0,:]=s3*(dm*n+m*dn)
-        ind[0,5,0]=7
 
         mat[0,6,0]=s3*n*l
         der[0,6,0,:]=s3*(dn*l+n*dl)
-        ind[0,6,0]=7
 
         mat[0,7,0]=0.5*s3*(ll-mm)
         der[0,7,0,:]=0.5*s3*(dll-dmm)
-        ind[0,7,0]=7
 
         mat[0,8,0]=nn-0.5*(ll+mm)
         der[0,8,0,:]=dnn-0.5*(dll+dmm)
-        ind[0,8,0]=7
 
     if mxorb>=2: #pp
         mat[1,1,0:2]=[ll, 1-ll]
         der[1,1,0:2,:]=[dll, -dll]
-        ind[1,1,0:2]=[5,6]
 
         mat[1,2,0:2]=[l*m, -l*m]
         der[1,2,0:2,:]=[dl*m+l*dm, -(dl*m+l*dm)]
-        ind[1,2,0:2]=[5,6]
 
         mat[1,3,0:2]=[l*n, -l*n]
         der[1,3,0:2,:]=[dl*n+l*dn, -(dl*n+l*dn)]
-        ind[1,3,0:2]=[5,6]
 
     if mxorb>=5: #pd
         mat[1,4,0:2]=[s3*ll*m, m*(1-2*ll)]
         der[1,4,0:2,:]=[s3*(dll*m+ll*dm), dm*(1-2*ll)+m*(-2*dll)]
-        ind[1,4,0:2]=[3,4]
 
         mat[1,5,0:2]=[s3*l*m*n, -2*l*m*n]
         der[1,5,0:2,:]=[s3*(dl*m*n+l*dm*n+l*m*dn), -2*(dl*m*n+l*dm*n+l*m*dn)]
-        ind[1,5,0:2]=[3,4]
 
         mat[1,6,0:2]=[s3*ll*n, n*(1-2*ll)]
         der[1,6,0:2,:]=[s3*(dll*n+ll*dn), dn*(1-2*ll)+n*(-2*dll)]
-        ind[1,6,0:2]=[3,4]
 
         mat[1,7,0:2]=[0.5*s3*l*(ll-mm), l*(1-ll+mm)]
         der[1,7,0:2,:]=[0.5*s3*(dl*(ll-mm)+l*(dll-dmm)), dl*(1-ll+mm)+l*(-dll+dmm)]
-        ind[1,7,0:2]=[3,4]
 
         mat[1,8,0:2]=[l*(nn-0.5*(ll+mm)), -s3*l*nn]
         der[1,8,0:2,:]=[dl*(nn-0.5*(ll+mm))+l*(dnn-0.5*(dll+dmm)), -s3*(dl*nn+l*dnn)]
-        ind[1,8,0:2]=[3,4]
 
     if mxorb>=2:
         mat[2,2,0:2]=[mm, 1-mm]
         der[2,2,0:2,:]=[dmm, -dmm]
-        ind[2,2,0:2]=[5,6]
 
         mat[2,3,0:2]=[m*n, -m*n]
         der[2,3,0:2,:]=[dm*n+m*dn, -(dm*n+m*dn)]
-        ind[2,3,0:2]=[5,6]
 
     if mxorb>=5:
         mat[2,4,0:2]=[s3*mm*l, l*(1-2*mm)]
         der[2,4,0:2,:]=[s3*(dmm*l+mm*dl), dl*(1-2*mm)+l*(-2*dmm)]
-        ind[2,4,0:2]=[3,4]
 
         mat[2,5,0:2]=[s3*mm*n, n*(1-2*mm)]
         der[2,5,0:2,:]=[s3*(dmm*n+mm*dn), dn*(1-2*mm)+n*(-2*dmm)]
-        ind[2,5,0:2]=[3,4]
 
         mat[2,6,0:2]=[s3*m*n*l, -2*m*n*l]
         der[2,6,0:2,:]=[s3*(dm*n*l+m*dn*l+m*n*dl), -2*(dm*n*l+m*dn*l+m*n*dl)]
-        ind[2,6,0:2]=[3,4]
 
         mat[2,7,0:2]=[0.5*s3*m*(ll-mm), -m*(1+ll-mm)]
         der[2,7,0:2,:]=[0.5*s3*(dm*(ll-mm)+m*(dll-dmm)), -(dm*(1+ll-mm)+m*(dll-dmm))]
-        ind[2,7,0:2]=[3,4]
 
         mat[2,8,0:2]=[m*(nn-0.5*(ll+mm)), -s3*m*nn]
         der[2,8,0:2,:]=[dm*(nn-0.5*(ll+mm))+m*(dnn-0.5*(dll+dmm)), -s3*(dm*nn+m*dnn)]
-        ind[2,8,0:2]=[3,4]
 
     if mxorb>=2:
         mat[3,3,0:2]=[nn, 1-nn]
         der[3,3,0:2,:]=[dnn, -dnn]
-        ind[3,3,0:2]=[5,6]
 
     if mxorb>=5:
         mat[3,4,0:2]=[s3*l*m*n, -2*m*n*l]
         der[3,4,0:2,:]=[s3*(dl*m*n+l*dm*n+l*m*dn), -2*(dm*n*l+m*dn*l+m*n*dl)]
-        ind[3,4,0:2]=[3,4]
 
         mat[3,5,0:2]=[s3*nn*m, m*(1-2*nn)]
         der[3,5,0:2,:]=[s3*(dnn*m+nn*dm), dm*(1-2*nn)+m*(-2*dnn)]
-        ind[3,5,0:2]=[3,4]
 
         mat[3,6,0:2]=[s3*nn*l, l*(1-2*nn)]
         der[3,6,0:2,:]=[s3*(dnn*l+nn*dl), dl*(1-2*nn)+l*(-2*dnn)]
-        ind[3,6,0:2]=[3,4]
 
         mat[3,7,0:2]=[0.5*s3*n*(ll-mm), -n*(ll-mm)]
         der[3,7,0:2,:]=[0.5*s3*(dn*(ll-mm)+n*(dll-dmm)), -(dn*(ll-mm)+n*(dll-dmm))]
-        ind[3,7,0:2]=[3,4]
 
         mat[3,8,0:2]=[n*(nn-0.5*(ll+mm)), s3*n*(ll+mm)]
         der[3,8,0:2,:]=[dn*(nn-0.5*(ll+mm))+n*(dnn-0.5*(dll+dmm)), s3*(dn*(ll+mm)+n*(dll+dmm))]
-        ind[3,8,0:2]=[3,4]
 
     if mxorb>=5:
         mat[4,4,0:3]=[3*ll*mm, ll+mm-4*ll*mm, nn+ll*mm]
         der[4,4,0:3,:]=[3*(dll*mm+ll*dmm), dll+dmm-4*(dll*mm+ll*dmm), dnn+(dll*mm+ll*dmm)]
-        ind[4,4,0:3]=[0,1,2]
 
         mat[4,5,0:3]= [3*l*mm*n, l*n*(1-4*mm), l*n*(mm-1)]
         der[4,5,0:3,:]= [3*(dl*mm*n+l*dmm*n+l*mm*dn), dl*n*(1-4*mm)+l*dn*(1-4*mm)+l*n*(-4*dmm), dl*n*(mm-1)+l*dn*(mm-1)+l*n*(dmm)]
-        ind[4,5,0:3]=[0,1,2]
 
         mat[4,6,0:3]=[3*ll*m*n, m*n*(1-4*ll), m*n*(ll-1)]
         der[4,6,0:3,:]=[3*(dll*m*n+ll*dm*n+ll*m*dn), dm*n*(1-4*ll)+m*dn*(1-4*ll)+m*n*(-4*dll), dm*n*(ll-1)+m*dn*(ll-1)+m*n*(dll)]
-        ind[4,6,0:3]=[0,1,2]
 
         mat[4,7,0:3]=[1.5*l*m*(ll-mm), 2*l*m*(mm-ll), 0.5*l*m*(ll-mm)]
         der[4,7,0:3,:]=[1.5*(dl*m*(ll-mm)+l*dm*(ll-mm)+l*m*(dll-dmm)),\
                     2*(dl*m*(mm-ll)+l*dm*(mm-ll)+l*m*(dmm-dll)),\
                     0.5*(dl*m*(ll-mm)+l*dm*(ll-mm)+l*m*(dll-dmm))]
-        ind[4,7,0:3]=[0,1,2]
 
         mat[4,8,0:3]=[s3*l*m*(nn-0.5*(ll+mm)), - 2*s3*l*m*nn, 0.5*s3*l*m*(1+nn)]
         der[4,8,0:3,:]=[s3*( dl*m*(nn-0.5*(ll+mm))+l*dm*(nn-0.5*(ll+mm))+l*m*(dnn-0.5*(dll+dmm)) ),\
                     -2*s3*(dl*m*nn+l*dm*nn+l*m*dnn),\
                     0.5*s3*( dl*m*(1+nn)+l*dm*(1+nn)+l*m*(dnn) )]
-        ind[4,8,0:3]=[0,1,2]
 
         mat[5,5,0:3]=[3*mm*nn,  (mm+nn-4*mm*nn), (ll+mm*nn)]
         der[5,5,0:3,:]=[3*(dmm*nn+mm*dnn), (dmm+dnn-4*(dmm*nn+mm*dnn)),  (dll+dmm*nn+mm*dnn)]
-        ind[5,5,0:3]=[0,1,2]
 
         mat[5,6,0:3]=[3*m*nn*l, m*l*(1-4*nn), m*l*(nn-1)]
         der[5,6,0:3,:]=[3*(dm*nn*l+m*dnn*l+m*nn*dl),\
                     dm*l*(1-4*nn)+m*dl*(1-4*nn)+m*l*(-4*dnn),\
                     dm*l*(nn-1)+m*dl*(nn-1)+m*l*(dnn)]
-        ind[5,6,0:3]=[0,1,2]
 
         mat[5,7,0:3]=[1.5*m*n*(ll-mm), - m*n*(1+2*(ll-mm)), m*n*(1+0.5*(ll-mm))]
         der[5,7,0:3,:]=[1.5*( dm*n*(ll-mm)+m*dn*(ll-mm)+m*n*(dll-dmm) ),\
                     - ( dm*n*(1+2*(ll-mm))+m*dn*(1+2*(ll-mm))+m*n*(2*dll-2*dmm) ),\
                     dm*n*(1+0.5*(ll-mm))+m*dn*(1+0.5*(ll-mm))+m*n*(0.5*(dll-dmm))]
-        ind[5,7,0:3]=[0,1,2]
 
         mat[5,8,0:3]=[s3*m*n*(nn-0.5*(ll+mm)), s3*m*n*(ll+mm-nn), -0.5*s3*m*n*(ll+mm)]
         der[5,8,0:3,:]=[s3*( dm*n*(nn-0.5*(ll+mm)) + m*dn*(nn-0.5*(ll+mm))+m*n*(dnn-0.5*(dll+dmm)) ),\
                     s3*( dm*n*(ll+mm-nn)+m*dn*(ll+mm-nn)+m*n*(dll+dmm-dnn) ),\
                     - 0.5*s3*( dm*n*(ll+mm)+m*dn*(ll+mm)+m*n*(dll+dmm) )]
-        ind[5,8,0:3]=[0,1,2]
 
         mat[6,6,0:3]=[3*nn*ll, (nn+ll-4*nn*ll), (mm+nn*ll)]
         der[6,6,0:3,:]=[3*(dnn*ll+nn*dll), dnn+dll-4*(dnn*ll+nn*dll), (dmm+dnn*ll+nn*dll)]
-        ind[6,6,0:3]=[0,1,2]
 
         mat[6,7,0:3]=[1.5*n*l*(ll-mm), n*l*(1-2*(ll-mm)), - n*l*(1-0.5*(ll-mm))]
         der[6,7,0:3,:]=[1.5*( dn*l*(ll-mm)+n*dl*(ll-mm)+n*l*(dll-dmm) ),\
                     dn*l*(1-2*(ll-mm))+n*dl*(1-2*(ll-mm))+n*l*(-2*(dll-dmm)),\
                     -( dn*l*(1-0.5*(ll-mm))+n*dl*(1-0.5*(ll-mm))+n*l*(-0.5*(dll-dmm)) )]
-        ind[6,7,0:3]=[0,1,2]
 
         mat[6,8,0:3]=[s3*l*n*(nn-0.5*(ll+mm)), s3*l*n*(ll+mm-nn), - 0.5*s3*l*n*(ll+mm)]
         der[6,8,0:3,:]=[s3*( dl*n*(nn-0.5*(ll+mm))+l*dn*(nn-0.5*(ll+mm))+l*n*(dnn-0.5*(dll+dmm)) ),\
                     s3*( dl*n*(ll+mm-nn)+l*dn*(ll+mm-nn)+l*n*(dll+dmm-dnn) ),\
                     - 0.5*s3*( dl*n*(ll+mm)+l*dn*(ll+mm)+l*n*(dll+dmm) )]
-        ind[6,8,0:3]=[0,1,2]
 
         mat[7,7,0:3]=[0.75*(ll-mm)**2, (ll+mm-(ll-mm)**2), (nn+0.25*(ll-mm)**2)]
         der[7,7,0:3,:]=[0.75*2*(ll-mm)*(dll-dmm), (dll+dmm-2*(ll-mm)*(dll-dmm)), (dnn+0.25*2*(ll-mm)*(dll-dmm))]
-        ind[7,7,0:3]=[0,1,2]
 
         mat[7,8,0:3]=[0.5*s3*(ll-mm)*(nn-0.5*(ll+mm)), s3*nn*(mm-ll), 0.25*s3*(1+nn)*(ll-mm)]
         der[7,8,0:3,:]=[0.5*s3*( (dll-dmm)*(nn-0.5*(ll+mm))+(ll-mm)*(dnn-0.5*(dll+dmm)) ),\
                     s3*( dnn*(mm-ll)+nn*(dmm-dll) ),\
                     0.25*s3*( dnn*(ll-mm)+(1+nn)*(dll-dmm) )]
-        ind[7,8,0:3]=[0,1,2]
 
         mat[8,8,0:3]=[(nn-0.5*(ll+mm))**2, 3*nn*(ll+mm), 0.75*(ll+mm)**2]
         der[8,8,0:3,:]=[2*(nn-0.5*(ll+mm))*(dnn-0.5*(dll+dmm)),\
                     3*( dnn*(ll+mm)+nn*(dll+dmm) ),\
                     0.75*2*(ll+mm)*(dll+dmm)]
-        ind[8,8,0:3]=[0,1,2]
 
     # use the same rules for orbitals when they are reversed (pd ->dp)...
-    for a in range(9):
-        for b in range(a+1,9):
-            mat[b,a,:]=mat[a,b,:]
-            der[b,a,:,:]=der[a,b,:,:]
-            ind[b,a,:]=ind[a,b,:]
+    a,b=np.triu_indices(9,1)
+    mat[b,a]=mat[a,b]
+    der[b,a]=der[a,b]
+
+    mat=mat[:noi,:noj].transpose((3,0,1,2))
+    der=der[:noi,:noj].transpose((4,0,1,2,3))
+    ind=slako_ind[:noi,:noj]
+    hsel, ssel = h[:,ind], s[:,ind]
+
+    ht=np.einsum('pijk,pijk->pij',mat,hsel)
+    st=np.einsum('pijk,pijk->pij',mat,ssel)
+    if dh is None:
+        return ht, st, None, None
+    dhsel, dssel = dh[:,ind,:], ds[:,ind,:]
+    dht=np.einsum('pijk,pijka->pija',mat,dhsel)+np.einsum('pijka,pijk->pija',der,hsel)
+    dst=np.einsum('pijk,pijka->pija',mat,dssel)+np.einsum('pijka,pijk->pija',der,ssel)
+    return ht, st, dht, dst
 
-    # ...but use different indices from table
-    #pd 3:5-->10:12
-    #sd 7->12
-    #sp 8->13
-    ind[1,0,0]=13
-    ind[2,0,0]=13
-    ind[3,0,0]=13
-    ind[4,0,0]=12
-    ind[5,0,0]=12
-    ind[6,0,0]=12
-    ind[7,0,0]=12
-    ind[8,0,0]=12
-    ind[4,1,0:2]=[10,11]
-    ind[5,1,0:2]=[10,11]
-    ind[6,1,0:2]=[10,11]
-    ind[7,1,0:2]=[10,11]
-    ind[8,1,0:2]=[10,11]
-    ind[4,2,0:2]=[10,11]
-    ind[5,2,0:2]=[10,11]
-    ind[6,2,0:2]=[10,11]
-    ind[7,2,0:2]=[10,11]
-    ind[8,2,0:2]=[10,11]
-    ind[4,3,0:2]=[10,11]
-    ind[5,3,0:2]=[10,11]
-    ind[6,3,0:2]=[10,11]
-    ind[7,3,0:2]=[10,11]
-    ind[8,3,0:2]=[10,11]
 
-    for i in range(noi):
-        for j in range(noj):
-            ht[i,j]=sum( [mat[i,j,k]*h[ind[i,j,k]] for k in range(cnt[i,j])] )
-            st[i,j]=sum( [mat[i,j,k]*s[ind[i,j,k]] for k in range(cnt[i,j])] )
-            for a in range(3):
-                dht[i,j,a]=sum( [mat[i,j,k]*dh[ind[i,j,k],a]+der[i,j,k,a]*h[ind[i,j,k]] for k in range(cnt[i,j])] )
-                dst[i,j,a]=sum( [mat[i,j,k]*ds[ind[i,j,k],a]+der[i,j,k,a]*s[ind[i,j,k]] for k in range(cnt[i,j])] )
-    return ht, st, dht, dst
+def slako_transformations(rhat,dist,noi,noj,h,s,dh,ds):
+    """
+    Apply Slater-Koster transformation rules to orbitals iorbs and orbitals jorbs,
+    where rhat is vector i->j and table gives the values for given tabulated
+    matrix elements. Convention: orbital name starts with s,p,d,...
+    """
+    ht, st, dht, dst = slako_transformations_batch(np.reshape(rhat,(1,3)),
+                                   np.array([dist]),noi,noj,
+                                   np.reshape(h,(1,14)),np.reshape(s,(1,14)),
+                                   np.reshape(dh,(1,14,3)),np.reshape(ds,(1,14,3)))
+    return ht[0], st[0], dht[0], dst[0]
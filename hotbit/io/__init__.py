@@ -1,6 +1,9 @@
 """
 Input module. Contains functions to read element, Slater-Koster and repulsion
 data.
+
+Files can also be in a compiled parameter bundle (see hotbit.io.bundle),
+given as e.g. 'param.hbb/C.elm'.
 """
 
 def read_element(filename, symbol, format=None):
@@ -24,66 +27,122 @@ def read_element(filename, symbol, format=None):
         from hotbit.io.dftb import read_element_from_skf
         return read_element_from_skf(filename, symbol)
 
-    raise RuntimeError('File format "'+format+'" not recognized!')
+    if format == 'bundle':
+        from hotbit.io.bundle import read_element_from_bundle
+        return read_element_from_bundle(filename, symbol)
+
+    raise RuntimeError('File format "'+str(format)+'" not recognized!')
 
 
 
-def read_HS(filename, symboli, symbolj, format=None):
+def read_HS(filename, symboli, symbolj, format=None, derivatives=False):
     """
     Read Slater-Koster tables from files.
 
     Parameters:
     -----------
-    fileobj:   filename of file-object to read from
-    symboli:   chemical symbol of the first element
-    symbolj:   chemical symbol of the second element
+    fileobj:     filename of file-object to read from
+    symboli:     chemical symbol of the first element
+    symbolj:     chemical symbol of the second element
+    derivatives: return also the second derivatives of the (natural cubic)
+                 splines through the table columns (precomputed in bundles)
     """
 
     if format is None:
         format = filetype(filename)
 
+    if format == 'bundle':
+        from hotbit.io.bundle import read_HS_from_bundle
+        x, table, d2 = read_HS_from_bundle(filename, symboli, symbolj)
+        if derivatives:
+            return x, table, d2
+        return x, table
+
     if format == 'par':
         from hotbit.io.native import read_HS_from_par
-        return read_HS_from_par(filename, symboli, symbolj)
-
-    if format == 'skf':
+        x, table = read_HS_from_par(filename, symboli, symbolj)
+    elif format == 'skf':
         from hotbit.io.dftb import read_HS_from_skf
-        return read_HS_from_skf(filename, symboli, symbolj)
+        x, table = read_HS_from_skf(filename, symboli, symbolj)
+    else:
+        raise RuntimeError('File format "'+str(format)+'" not recognized!')
 
-    raise RuntimeError('File format "'+format+'" not recognized!')
+    if derivatives:
+        from box.interpolation import natural_spline_second_derivatives
+        return x, table, natural_spline_second_derivatives(x, table)
+    return x, table
 
 
 
-def read_repulsion(filename, format=None):
+def read_repulsion(filename, format=None, tck=False):
     """
     Read Slater-Koster tables from files.
 
     Parameters:
     -----------
     fileobj:   filename of file-object to read from
+    tck:       return also the cubic B-spline representation of the
+               repulsion (precomputed in bundles)
     """
 
     if format is None:
         format = filetype(filename)
 
+    if format == 'bundle':
+        from hotbit.io.bundle import read_repulsion_from_bundle
+        x, v, spline = read_repulsion_from_bundle(filename)
+        if tck:
+            return x, v, spline
+        return x, v
+
     if format == 'par':
         from hotbit.io.native import read_repulsion_from_par
-        return read_repulsion_from_par(filename)
-
-    if format == 'skf':
+        x, v = read_repulsion_from_par(filename)
+    elif format == 'skf':
         from hotbit.io.dftb import read_repulsion_from_skf
-        return read_repulsion_from_skf(filename)
+        x, v = read_repulsion_from_skf(filename)
+    else:
+        raise RuntimeError('File format "'+str(format)+'" not recognized!')
 
-    raise RuntimeError('File format "'+format+'" not recognized!')
+    if tck:
+        from scipy.interpolate import splrep
+        return x, v, splrep(x, v, s=0, k=3)
+    return x, v
+
+
+
+def find_value(filename, key, fmt='default', default=None):
+    """
+    Find value for key from a parameter file (see box.mix.find_value).
+
+    For bundles only the comments are available.
+    """
+    if filetype(filename) == 'bundle':
+        from hotbit.io.bundle import find_value
+    else:
+        from hotbit.io.native import find_value
+    return find_value(filename, key, fmt=fmt, default=default)
+
+
+
+def isfile(filename):
+    """ Return True if filename is a file or a file in a bundle. """
+    from os import path
+    from hotbit.io.bundle import isfile as bundle_isfile
+    return path.isfile(filename) or bundle_isfile(filename)
 
 
 
 def filetype(filename):
+    from hotbit.io.bundle import split_path
+    if split_path(filename) is not None:
+        return 'bundle'
+
     if filename.lower().endswith('.elm'):
         return 'elm'
 
     if filename.lower().endswith('.par'):
         return 'par'
 
-    if filename.lower().endswith('.skf') or filename.lower.endswith('.spl'):
+    if filename.lower().endswith('.skf') or filename.lower().endswith('.spl'):
         return 'skf'
@@ -0,0 +1,318 @@
+"""
+Binary parameter bundles.
+
+A directory of parameter files (.elm, .par, .skf) is compiled into a
+single .hbb file, which contains the parsed data together with the
+precomputed spline representations (B-spline coefficients of the
+element functions and the repulsion, second derivatives of the
+Slater-Koster tables). The numerical data is memory-mapped when read,
+so that processes using the same bundle share the pages.
+
+Files in a bundle are referred to as if the bundle was a directory,
+e.g. 'param.hbb/C_H.par'; HOTBIT_PARAMETERS can also point to a bundle.
+
+    usage: python -m hotbit.io.bundle directory [bundle.hbb]
+"""
+import os
+import sys
+import copy
+import json
+import struct
+
+import numpy as np
+
+from box.data import data as box_data
+from box.interpolation import Function, SplineFunction, natural_spline_second_derivatives
+from hotbit.auxil import separate_symbols
+
+MAGIC = b'HOTBITPB'
+VERSION = 2
+EXTENSION = '.hbb'
+# data section starts at multiple of ALIGN bytes
+ALIGN = 4096
+
+
+
+# The header is JSON (tuples are stored as lists); numerical data is
+# referred to by names of arrays in the data section:
+# stored SplineFunction: [SPLINE, x, y, t, c, k]
+SPLINE = 'spline'
+# stored numpy array: [ARRAY, name]
+ARRAY = 'array'
+
+
+
+class _Writer:
+    """ Collect arrays (float64) and their offsets in the data section. """
+    def __init__(self):
+        self.arrays = []
+        self.index = {}
+        self.size = 0
+
+    def add(self, name, a):
+        a = np.ascontiguousarray(a, dtype=float)
+        self.index[name] = (self.size, a.size, a.shape)
+        self.arrays.append(a)
+        self.size += a.size
+        return name
+
+    def add_spline(self, name, f):
+        """ Store Function/SplineFunction f. """
+        if isinstance(f, Function):
+            f = f.f
+        t, c, k = f.tck
+        return (SPLINE, self.add(name+'/x', f.x), self.add(name+'/y', f.y),
+                self.add(name+'/t', t), self.add(name+'/c', c), int(k))
+
+
+
+def _pack(writer, name, obj):
+    """ Replace functions and arrays in (nested dictionary) obj by stored ones. """
+    if isinstance(obj, dict):
+        return dict([(key, _pack(writer, '%s/%s' % (name, key), obj[key])) for key in obj])
+    elif isinstance(obj, (Function, SplineFunction)):
+        return writer.add_spline(name, obj)
+    elif isinstance(obj, np.ndarray):
+        return (ARRAY, writer.add(name, obj))
+    else:
+        return obj
+
+
+
+def compile_bundle(directory, filename=None):
+    """
+    Compile all parameter files in directory (recursively) into a bundle.
+
+    Parameters:
+    -----------
+    directory:   parameter directory (e.g. HOTBIT_PARAMETERS)
+    filename:    name of the bundle (default: directory + '.hbb')
+
+    Return the name of the bundle.
+    """
+    from hotbit.io import read_element, read_HS, read_repulsion, filetype
+    from hotbit.io.native import get_parameter_file
+
+    directory = os.path.normpath(directory)
+    if filename is None:
+        filename = directory + EXTENSION
+
+    writer = _Writer()
+    members = {}
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for fn in sorted(files):
+            path = os.path.join(root, fn)
+            member = os.path.relpath(path, directory).replace(os.sep, '/')
+            format = filetype(fn)
+            if format is None:
+                continue
+            base = os.path.splitext(fn)[0]
+            entry = {'format': format, 'elements': {}, 'tables': {},
+                     'repulsion': None, 'comments': {}}
+
+            if format == 'elm':
+                symbol = get_parameter_file(path).find_value('symbol').strip()
+                if symbol not in box_data:
+                    continue
+                data, functions = read_element(path, symbol)
+                entry['elements'][symbol] = (_pack(writer, member+'/'+symbol, data),
+                                             _pack(writer, member, functions))
+                symbols = []
+            elif format == 'par':
+                pf = get_parameter_file(path)
+                symbols = [key[:-len('_table')].split('_') for key in pf.keys
+                           if key.endswith('_table') and key.count('_')==2]
+                for key in ['slako_comment', 'repulsion_comment']:
+                    if pf.find_value(key, fmt='test'):
+                        entry['comments'][key] = pf.find_value(key, fmt='strings', default=[])
+            else:
+                symbols = [separate_symbols(base.replace('-', ''))]
+                if symbols[0][0] == symbols[0][1]:
+                    data, functions = read_element(path, symbols[0][0])
+                    entry['elements'][symbols[0][0]] = (_pack(writer, member+'/'+symbols[0][0], data),
+                                                        _pack(writer, member, functions))
+
+            for si, sj in symbols:
+                x, table = read_HS(path, si, sj)
+                name = '%s/%s_%s_table' % (member, si, sj)
+                entry['tables']['%s_%s_table' % (si, sj)] = (
+                    writer.add(name+'/x', x), writer.add(name, table),
+                    writer.add(name+'/d2', natural_spline_second_derivatives(x, table)) )
+
+            if format in ['par', 'skf']:
+                x, v, tck = read_repulsion(path, tck=True)
+                entry['repulsion'] = writer.add_spline(member+'/repulsion', SplineFunction(x, v, k=3, tck=tck))
+            members[member] = entry
+
+    header = json.dumps({'version': VERSION, 'members': members,
+                         'arrays': writer.index, 'size': writer.size}).encode('utf-8')
+    start = len(MAGIC) + 12 + len(header)
+    start += (-start) % ALIGN
+    f = open(filename, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<IQ', VERSION, len(header)))
+    f.write(header)
+    f.write(b'\0' * (start - f.tell()))
+    for a in writer.arrays:
+        f.write(a.tobytes())
+    f.close()
+    return filename
+
+
+
+class Bundle:
+    def __init__(self, filename):
+        """ Open compiled parameter bundle; the data is memory-mapped. """
+        self.filename = filename
+        f = open(filename, 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            f.close()
+            raise RuntimeError('%s is not a Hotbit parameter bundle.' % filename)
+        version, n = struct.unpack('<IQ', f.read(12))
+        if version != VERSION:
+            f.close()
+            raise RuntimeError('Bundle %s has version %i, expected %i; '
+                               'compile it again.' % (filename, version, VERSION))
+        header = json.loads(f.read(n).decode('utf-8'))
+        f.close()
+        start = len(MAGIC) + 12 + n
+        start += (-start) % ALIGN
+        self.members = header['members']
+        self.index = header['arrays']
+        if header['size'] > 0:
+            self.data = np.memmap(filename, dtype=float, mode='r', offset=start, shape=(header['size'],))
+        else:
+            self.data = np.zeros(0)
+
+
+    def __contains__(self, member):
+        return member in self.members
+
+
+    def _array(self, name):
+        offset, size, shape = self.index[name]
+        return self.data[offset:offset+size].reshape(shape)
+
+
+    def _unpack(self, obj):
+        if isinstance(obj, dict):
+            return dict([(key, self._unpack(obj[key])) for key in obj])
+        elif isinstance(obj, list) and len(obj) == 6 and obj[0] == SPLINE:
+            x, y, t, c, k = obj[1:]
+            tck = (self._array(t), self._array(c), k)
+            return Function('spline', self._array(x), self._array(y), k=k, tck=tck)
+        elif isinstance(obj, list) and len(obj) == 2 and obj[0] == ARRAY:
+            return self._array(obj[1])
+        else:
+            return obj
+
+
+    def _member(self, member):
+        if member not in self.members:
+            raise RuntimeError('File %s not found from bundle %s.' % (member, self.filename))
+        return self.members[member]
+
+
+    def read_element(self, member, symbol):
+        """ Return element data and functions (see hotbit.io.read_element). """
+        elements = self._member(member)['elements']
+        if symbol not in elements:
+            raise RuntimeError('No element %s in %s of bundle %s.' % (symbol, member, self.filename))
+        data, functions = elements[symbol]
+        return copy.deepcopy(self._unpack(data)), self._unpack(functions)
+
+
+    def read_HS(self, member, symboli, symbolj):
+        """ Return x-grid, table and its spline second derivatives. """
+        tables = self._member(member)['tables']
+        key = '%s_%s_table' % (symboli, symbolj)
+        if 'X_X_table' in tables:
+            key = 'X_X_table'
+        if key not in tables:
+            raise RuntimeError('key '+key+' not found from file '+member)
+        x, table, d2 = tables[key]
+        return self._array(x), self._array(table), self._array(d2)
+
+
+    def read_repulsion(self, member):
+        """ Return x-grid, repulsion and its B-spline representation. """
+        f = self._unpack(self._member(member)['repulsion']).f
+        return f.x, f.y, f.tck
+
+
+    def find_value(self, member, key, fmt='default', default=None):
+        """ Return the stored comments (fmt 'strings' or 'test'). """
+        comments = self._member(member)['comments']
+        if fmt == 'test':
+            return key in comments
+        if key in comments and fmt == 'strings' and len(comments[key]) > 0:
+            return comments[key]
+        if default is not None:
+            return default
+        raise RuntimeError('key '+key+' not found from file '+member)
+
+
+
+# opened bundles, by (path, modification time, size)
+_bundles = {}
+
+def split_path(filename):
+    """
+    Return (bundle, member) if filename refers to a file in a bundle,
+    otherwise None.
+    """
+    i = filename.find(EXTENSION + '/')
+    if i < 0:
+        return None
+    bundle, member = filename[:i+len(EXTENSION)], filename[i+len(EXTENSION)+1:]
+    if not os.path.isfile(bundle):
+        return None
+    return bundle, os.path.normpath(member).replace(os.sep, '/')
+
+
+def get_bundle(filename):
+    """ Return the Bundle (opened only once per process) containing filename. """
+    bundle, member = split_path(filename)
+    st = os.stat(bundle)
+    key = (os.path.abspath(bundle), st.st_mtime_ns, st.st_size)
+    if key not in _bundles:
+        _bundles[key] = Bundle(bundle)
+    return _bundles[key], member
+
+
+def isfile(filename):
+    """ Return True if filename is a file in a bundle. """
+    if split_path(filename) is None:
+        return False
+    bundle, member = get_bundle(filename)
+    return member in bundle
+
+
+def read_element_from_bundle(filename, symbol):
+    bundle, member = get_bundle(filename)
+    return bundle.read_element(member, symbol)
+
+
+def read_HS_from_bundle(filename, symboli, symbolj):
+    bundle, member = get_bundle(filename)
+    return bundle.read_HS(member, symboli, symbolj)
+
+
+def read_repulsion_from_bundle(filename):
+    bundle, member = get_bundle(filename)
+    return bundle.read_repulsion(member)
+
+
+def find_value(filename, key, fmt='default', default=None):
+    bundle, member = get_bundle(filename)
+    return bundle.find_value(member, key, fmt=fmt, default=default)
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        print(__doc__)
+        sys.exit(1)
+    fn = compile_bundle(*sys.argv[1:])
+    print('Parameters in %s compiled into %s' % (sys.argv[1], fn))
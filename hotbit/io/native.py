@@ -1,6 +1,7 @@
 """
 Native Hotbit file format.
 """
+import os
 from copy import copy
 
 import numpy as np
@@ -10,6 +11,121 @@ from box.data import data as box_data
 from box.interpolation import Function
 
 
+class ParameterFile:
+    """
+    Index of all 'key=' lines of a native parameter file.
+
+    The file is read once; values are looked up with find_value,
+    which follows box.mix.find_value (the first occurrence of a key,
+    and data blocks as in box.mix.read). Parsed data blocks are kept.
+    """
+
+    def __init__(self, fileobj):
+        if isinstance(fileobj, str):
+            self.name = fileobj
+            f = open(fileobj)
+            self.lines = f.read().split('\n')
+            f.close()
+        else:
+            self.name = getattr(fileobj, 'name', '<file>')
+            fileobj.seek(0)
+            self.lines = fileobj.read().split('\n')
+        self.keys = {}
+        for i, line in enumerate(self.lines):
+            if '=' in line:
+                key = line.split('=')[0].strip()
+                if key not in self.keys:
+                    self.keys[key] = i
+        self.blocks = {}
+
+
+    def _block(self, i):
+        """ Return the non-comment lines of the data set after line i. """
+        block = []
+        for line in self.lines[i+1:]:
+            line = line.strip()
+            if len(line)==0:
+                if len(block)==0: continue   # initial blank line
+                break                        # next blank line stops the data set
+            if line[0]=='#': continue        # ignore comment line
+            block.append(line)
+        return block
+
+
+    def _matrix(self, key):
+        """ Return the data set after key as two-dimensional array (or None). """
+        if key not in self.blocks:
+            block = self._block(self.keys[key])
+            if len(block)==0:
+                m = None
+            else:
+                values = ' '.join(block).split()
+                ncol = len(block[0].split())
+                if len(values)==ncol*len(block):
+                    m = np.array(values, dtype=float).reshape(len(block), ncol)
+                else:
+                    m = np.array([[float(x) for x in line.split()] for line in block])
+            self.blocks[key] = m
+        return self.blocks[key]
+
+
+    def find_value(self, key, fmt='default', default=None):
+        """ Find value for key; see box.mix.find_value for fmt and default. """
+        key = key.strip()
+        ret = None
+        if key in self.keys:
+            i = self.keys[key]
+            value = self.lines[i].split('=')[1]
+            if fmt=='test':      ret = True
+            elif fmt=='bool':    ret = mix.true_false(value)
+            elif fmt=='matrix':
+                ret = self._matrix(key)
+                if ret is not None: ret = ret.copy()
+            elif fmt=='strings': ret = self._block(i) or None
+            elif fmt=='default': ret = value.split()[0]
+            elif fmt=='onestr':  ret = value
+            elif fmt=='all':     ret = value.split()
+        if fmt=='test' and ret is None:
+            return False
+        elif ret is not None:
+            return ret
+        elif default is not None:
+            return default
+        else:
+            raise RuntimeError('key '+key+' not found from file '+self.name)
+
+
+# parsed files, by path: ((modification time, size), ParameterFile);
+# only the latest version of each file is kept
+_files = {}
+
+def get_parameter_file(fileobj):
+    """
+    Return the ParameterFile for a file name or file object.
+
+    Files given by name are parsed only once (until they are modified),
+    and shared by all readers. The parsed file is kept for the lifetime
+    of the process, one per path; a modified file replaces its old
+    version.
+    """
+    if isinstance(fileobj, ParameterFile):
+        return fileobj
+    if not isinstance(fileobj, str):
+        return ParameterFile(fileobj)
+    st = os.stat(fileobj)
+    path, version = os.path.abspath(fileobj), (st.st_mtime_ns, st.st_size)
+    if path not in _files or _files[path][0] != version:
+        _files[path] = (version, ParameterFile(fileobj))
+    return _files[path][1]
+
+
+def find_value(fileobj, key, fmt='default', default=None):
+    """
+    Find value for key from file (as box.mix.find_value, but indexed).
+    """
+    return get_parameter_file(fileobj).find_value(key, fmt=fmt, default=default)
+
+
 
 def read_element_from_elm(fileobj, symbol):
     """
@@ -17,28 +133,27 @@ def read_element_from_elm(fileobj, symbol):
 
     Parameters:
     -----------
-    fileobj:   filename of file-object to read from
+    fileobj:   filename of file-object (or ParameterFile) to read from
     symbol:    chemical symbol of the element
     """
 
-    if isinstance(fileobj, str):
-        fileobj = open(fileobj)
+    fileobj = get_parameter_file(fileobj)
 
-    symb = mix.find_value(fileobj, 'symbol').strip()
+    symb = fileobj.find_value('symbol').strip()
     assert symb == symbol
 
     data = copy(box_data[symbol])
 
-    data['U'] = float(mix.find_value(fileobj, 'U'))
-    data['FWHM'] = float(mix.find_value(fileobj, 'FWHM'))
+    data['U'] = float(fileobj.find_value('U'))
+    data['FWHM'] = float(fileobj.find_value('FWHM'))
     data['epsilon'] = { }
     for orbital in data['valence_orbitals']:
         data['epsilon'][orbital] = float(
-            mix.find_value(fileobj, 'epsilon_%s' % orbital)
+            fileobj.find_value('epsilon_%s' % orbital)
             )
-    data['comment'] = mix.find_value(fileobj, 'comment',
-                                     fmt='strings',
-                                     default=['no comment'])
+    data['comment'] = fileobj.find_value('comment',
+                                         fmt='strings',
+                                         default=['no comment'])
 
     functions = _read_functions(fileobj, data['valence_orbitals'])
 
@@ -54,9 +169,9 @@ def read_element_from_elm(fileobj, symbol):
     data['valence_energies'] = np.array(energies, dtype=float)
 
     # vdW correction
-    data['C6'] = mix.find_value(fileobj, 'C6', default=-1.0)
-    data['p']  = mix.find_value(fileobj, 'p',  default=-1.0)
-    data['R0'] = mix.find_value(fileobj, 'R0', default=-1.0)
+    data['C6'] = fileobj.find_value('C6', default=-1.0)
+    data['p']  = fileobj.find_value('p',  default=-1.0)
+    data['R0'] = fileobj.find_value('R0', default=-1.0)
 
     return data, functions
 
@@ -75,15 +190,15 @@ def _read_functions(fileobj, valence_orbitals):
         }
 
     for nl in valence_orbitals:
-        m = mix.find_value(fileobj, 'u_%s' % nl, fmt='matrix', default=default)
+        m = fileobj.find_value('u_%s' % nl, fmt='matrix', default=default)
         functions['unl'][nl]=Function('spline', m[:,0], m[:,1])
         functions['Rnl'][nl]=Function('spline', m[:,0], m[:,1]/m[:,0])
 
-    m = mix.find_value(fileobj, 'effective_potential',
-                        fmt='matrix', default=default)
+    m = fileobj.find_value('effective_potential',
+                           fmt='matrix', default=default)
     functions['effective_potential'] = Function('spline', m[:,0], m[:,1])
-    m = mix.find_value(fileobj, 'confinement_potential',
-                       fmt='matrix', default=default)
+    m = fileobj.find_value('confinement_potential',
+                           fmt='matrix', default=default)
     functions['confinement_potential'] = Function('spline', m[:,0], m[:,1])
 
     return functions
@@ -101,14 +216,12 @@ def read_HS_from_par(fileobj, symboli, symbolj):
     symbolj:   chemical symbol of the second element
     """
 
-    if mix.find_value(fileobj, 'X_X_table', fmt='test'):
-        table = mix.find_value(fileobj,
-                               'X_X_table' % ( symboli, symbolj ),
-                               fmt='matrix')
+    fileobj = get_parameter_file(fileobj)
+    if fileobj.find_value('X_X_table', fmt='test'):
+        table = fileobj.find_value('X_X_table', fmt='matrix')
     else:
-        table = mix.find_value(fileobj,
-                               '%s_%s_table' % ( symboli, symbolj ),
-                               fmt='matrix')
+        table = fileobj.find_value('%s_%s_table' % ( symboli, symbolj ),
+                                   fmt='matrix')
 
     return table[:, 0], table[:, 1:]
 
@@ -123,8 +236,9 @@ def read_repulsion_from_par(fileobj):
     fileobj:   filename of file-object to read from
     """
 
+    fileobj = get_parameter_file(fileobj)
     try:
-        v = mix.find_value(fileobj, 'repulsion', fmt='matrix')
+        v = fileobj.find_value('repulsion', fmt='matrix')
     except:
         v = np.array([[0,0],[1,0],[2,0],[3,0]])
 
@@ -53,12 +53,130 @@ def sappend(x, y):
         return np.append(x, y, axis=0)
 
 
+def _symmetry_operations(a, cutoff):
+    """
+    Return the list of symmetry operations (3-tuples) to be scanned,
+    with the translations r1[n] and rotations T[n] such that the image of
+    position r is r1[n] + dot(T[n], r).
+    """
+    # FIXME!!! Brute force scan in the neighboring 5 cells in all directions.
+    # This might not be enough, i.e. for chiral nanotubes. Maybe the container
+    # itself should contain a function to return nearest neighbor periodic
+    # cells.
+    sym_ranges  = a.get_symmetry_operation_ranges()
+    if cutoff is None:
+        n1, n2, n3  = n_from_ranges(sym_ranges, np.Inf)
+    else:
+        n1, n2, n3  = n_from_ranges(sym_ranges, 5)
+
+    # Some reference coordinate, the origin should be fine
+    r0_v = np.zeros(3, dtype=float)
+
+    ops = [ ]
+    r1  = [ ]
+    T   = [ ]
+    for x1 in range(*n1):
+        for x2 in range(*n2):
+            for x3 in range(*n3):
+                ops += [ (x1, x2, x3) ]
+                r1  += [ a.transform(r0_v, [x1, x2, x3]) ]
+                T   += [ a.rotation([x1, x2, x3]) ]
+    return ops, np.array(r1).reshape(-1, 3), np.array(T).reshape(-1, 3, 3)
+
+
+def cell_list_pairs(r, rimg, cutoff):
+    """
+    Return all pairs (i,k) with |r[i]-rimg[k]| < cutoff.
+
+    Both sets of points are binned into cells of at least the cutoff size;
+    only points in neighboring cells are compared, hence the cost is linear
+    in the number of points.
+    """
+    lo    = np.minimum(r.min(axis=0), rimg.min(axis=0))
+    hi    = np.maximum(r.max(axis=0), rimg.max(axis=0)) + 1E-10
+
+    # cells at least cutoff in size, but not (many) more cells than points
+    ncell = np.maximum(((hi-lo)/cutoff).astype(int), 1)
+    maxcells = 8*(len(r)+len(rimg))
+    if np.prod(ncell) > maxcells:
+        ncell = np.maximum((ncell*(float(maxcells)/np.prod(ncell))**(1./3)).astype(int), 1)
+    size   = (hi-lo)/ncell
+    stride = np.array([ ncell[1]*ncell[2], ncell[2], 1 ])
+
+    def cell_of(x):
+        return np.minimum(((x-lo)/size).astype(int), ncell-1)
+
+    # sort image points by cell, first[c]:first[c+1] are the points in cell c
+    cid    = np.dot(cell_of(rimg), stride)
+    order  = np.argsort(cid, kind='mergesort')
+    first  = np.searchsorted(cid[order], np.arange(np.prod(ncell)+1))
+
+    ci = cell_of(r)
+    il = [ ]
+    kl = [ ]
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                c  = ci + np.array([dx, dy, dz])
+                ok = np.all((c >= 0) & (c < ncell), axis=1)
+                i  = np.flatnonzero(ok)
+                c  = np.dot(c[ok], stride)
+                start = first[c]
+                cnt   = first[c+1] - start
+                if cnt.sum() == 0:
+                    continue
+                # expand (i, start, cnt) into individual candidate pairs
+                i     = np.repeat(i, cnt)
+                off   = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt)-cnt, cnt)
+                k     = order[np.repeat(start, cnt) + off]
+                dr    = r[i] - rimg[k]
+                mask  = np.sum(dr*dr, axis=1) < cutoff**2
+                il   += [ i[mask] ]
+                kl   += [ k[mask] ]
+
+    if len(il) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(il), np.concatenate(kl)
+
+
+def _pairs_within_cutoff(r, r1, T, cutoff):
+    """
+    Return (i, j, s) for all atoms j in symmetry operation s closer than
+    cutoff to atom i, sorted by (s, i, j).
+    """
+    nat   = len(r)
+    lo    = r.min(axis=0) - cutoff
+    hi    = r.max(axis=0) + cutoff
+
+    # collect images that can be within cutoff from some primary atom
+    rimg  = [ ]
+    kimg  = [ ]
+    for s in range(len(r1)):
+        rs     = r1[s] + np.dot(r, T[s].transpose())
+        inside = np.flatnonzero( np.all((rs >= lo) & (rs <= hi), axis=1) )
+        rimg  += [ rs[inside] ]
+        kimg  += [ s*nat + inside ]
+    rimg  = np.concatenate(rimg)
+    kimg  = np.concatenate(kimg)
+    if len(kimg) == 0:
+        return kimg, kimg, kimg
+
+    i, k  = cell_list_pairs(r, rimg, cutoff)
+    k     = kimg[k]
+    s, j  = k//nat, k%nat
+    order = np.lexsort((j, i, s))
+    return i[order], j[order], s[order]
+
+
 def get_neighbors(a, cutoff=None):
     """
     Given a Hotbit atoms object, return a list of neighbors that are within a
     certain cutoff. Neighbors are returned for each atom, along with the
     distance and the normal vector pointing to the neighbor.
 
+    With a cutoff, the search uses a cell list and scales linearly with the
+    number of atoms.
+
     Parameters:
     -----------
     a:        Hotbit atoms object
@@ -72,64 +190,85 @@ def get_neighbors(a, cutoff=None):
     d:   Distances
     n:   Normal vectors
     """
-    # FIXME!!! Brute force scan in the neighboring 5 cells in all directions.
-    # This might not be enough, i.e. for chiral nanotubes. Maybe the container
-    # itself should contain a function to return nearest neighbor periodic
-    # cells.
-    # For large systems, some kind of binning scheme should implemented.
-    sym_ranges  = a.get_symmetry_operation_ranges()
     if cutoff is None and not a.is_cluster():
         raise RuntimeError("Please specify a cutoff when searching for "
                            "neighbors in a periodic system.")
 
+    ops, r1, T = _symmetry_operations(a, cutoff)
+    r = a.get_positions()
+    nat = len(r)
+
     if cutoff is None:
-        n1, n2, n3  = n_from_ranges(sym_ranges, np.Inf)
+        s, i, j = [ x.ravel() for x in np.indices((len(ops), nat, nat)) ]
     else:
-        n1, n2, n3  = n_from_ranges(sym_ranges, 5)
+        i, j, s = _pairs_within_cutoff(r, r1, T, cutoff)
+    i, j, s = _exclude_self(ops, i, j, s)
+    return _distances(r, r1, T, i, j, s, cutoff)
 
-    nat = len(a)
-    r = a.get_positions()
 
-    # Some reference coordinate, the origin should be fine
-    r0_v = np.zeros(3, dtype=float)
+def _exclude_self(ops, i, j, s):
+    """ Remove self-interactions (i==j for the identity operation). """
+    s0 = np.all(np.array(ops).reshape(-1, 3) == 0, axis=1)
+    ok = np.logical_not( (i == j) & s0[s] )
+    return i[ok], j[ok], s[ok]
 
-    jl = np.tile(np.arange(nat, dtype=int), (nat, 1))
-    il = jl.transpose()
 
-    i = None
-    j = None
-    d = None
-    n = None
+def _distances(r, r1, T, i, j, s, cutoff=None):
+    """
+    Return i, j, distances and normal vectors for given pairs (j operated
+    by s), keeping only pairs within cutoff.
+    """
+    dr  = r[i] - ( r1[s] + np.einsum('pab,pb->pa', T[s], r[j]) )
+    d   = np.sqrt(np.sum(dr*dr, axis=1))
+    if cutoff is not None:
+        mask = d < cutoff
+        i, j, d, dr = i[mask], j[mask], d[mask], dr[mask]
+    if len(i) == 0:
+        return None, None, None, None
+    return i, j, d, dr/d.reshape(-1, 1)
+
 
-    # Contribution of neighboring boxes
-    for x1 in range(*n1):
-        for x2 in range(*n2):
-            for x3 in range(*n3):
-                # construct a matrix with distances
-                r1      = a.transform(r0_v, [x1, x2, x3])
-                T       = a.rotation([x1, x2, x3])
-                    
-                rT      = np.dot(r-r0_v, np.transpose(T))
-
-                dr      = r.reshape(nat, 1, 3) - (r1+rT).reshape(1, nat, 3)
-                abs_dr  = np.sqrt(np.sum(dr*dr, axis=2))
-                if cutoff is None:
-                    mask  = np.ones([nat, nat], dtype=bool)
-                else:
-                    mask  = abs_dr < cutoff
-
-                # Do not return self-interactions
-                if x1 == 0 and x2 == 0 and x3 == 0:
-                    mask[diag_indices_from(mask)] = False
-
-                if np.any(mask):
-                    i       = sappend(i, il[mask])
-                    j       = sappend(j, jl[mask])
-
-                    abs_dr  = abs_dr[mask]
-                    dr      = dr[mask, :]/abs_dr.reshape(-1, 1)
-
-                    d       = sappend(d, abs_dr)
-                    n       = sappend(n, dr)
-
-    return i, j, d, n
+
+class NeighborList:
+    def __init__(self, cutoff, skin=0.0):
+        """
+        Neighbor list with Verlet-skin reuse.
+
+        Candidate pairs are searched within cutoff+skin; as long as no atom
+        has moved more than skin/2 since and the symmetry operations are
+        unchanged, get_neighbors only recalculates the distances of the
+        candidates.
+
+        Parameters:
+        -----------
+        cutoff:   neighbor cutoff
+        skin:     extra shell for candidate pairs
+        """
+        self.cutoff = cutoff
+        self.skin = skin
+        self.r0 = None
+        self.nbuilds = 0
+
+
+    def _needs_rebuild(self, r, r1, T):
+        if self.r0 is None or self.r0.shape != r.shape:
+            return True
+        if self.r1.shape != r1.shape or \
+           not np.allclose(self.r1, r1) or not np.allclose(self.T, T):
+            return True
+        dr = r - self.r0
+        return np.max(np.sum(dr*dr, axis=1)) > (0.5*self.skin)**2
+
+
+    def get_neighbors(self, a):
+        """
+        Return (i, j, d, n) as hotbit.neighbors.get_neighbors(a, cutoff).
+        """
+        ops, r1, T = _symmetry_operations(a, self.cutoff)
+        r = a.get_positions()
+        if self._needs_rebuild(r, r1, T):
+            i, j, s = _pairs_within_cutoff(r, r1, T, self.cutoff+self.skin)
+            self.i, self.j, self.s = _exclude_self(ops, i, j, s)
+            self.r0, self.r1, self.T = r.copy(), r1, T
+            self.nbuilds += 1
+        return _distances(r, r1, T, self.i, self.j, self.s, self.cutoff)
@@ -1,52 +1,112 @@
 import numpy as np
-from scipy.optimize import brentq
+from math import factorial, pi, sqrt
+from scipy.special import erfc
+from numpy.polynomial.hermite import hermval
 import sys
 if sys.version_info < (2,6):
     MAX_EXP_ARGUMENT = np.log(1E90)
 else:
     MAX_EXP_ARGUMENT = np.log(sys.float_info.max)
 
+# states farther than this (in units of width) from the Fermi level
+# are treated as fully occupied or empty
+WINDOW = {'fermi':40.0, 'methfessel-paxton':8.0, 'cold':8.0}
+
+
+def fermi_dirac(x):
+    """ Return the Fermi-Dirac occupation [0,1] and -d/dx of it for x=(e-mu)/width. """
+    # np.exp will return np.inf with RuntimeWarning if the input value
+    # is too large, better to feed it nu.inf in the beginning
+    x = np.where(x < MAX_EXP_ARGUMENT, x, np.inf)
+    f = 1/(np.exp(x)+1)
+    return f, f*(1-f)
+
+
+def methfessel_paxton(x, order=1):
+    """
+    Return the Methfessel-Paxton occupation and -d/dx of it for x=(e-mu)/width.
+
+    M. Methfessel and A.T. Paxton, Phys. Rev. B 40, 3616 (1989).
+    Occupations may be slightly negative or above one.
+    """
+    A = [ (-1)**n/(factorial(n)*4**n*sqrt(pi)) for n in range(order+1) ]
+    # f = erfc(x)/2 + sum_n A_n H_(2n-1)(x) exp(-x^2)
+    # delta = sum_n A_n H_2n(x) exp(-x^2)
+    codd = np.zeros(2*order)
+    ceven = np.zeros(2*order+1)
+    for n in range(order+1):
+        ceven[2*n] = A[n]
+        if n>0:
+            codd[2*n-1] = A[n]
+    g = np.exp(-x**2)
+    f = 0.5*erfc(x) + hermval(x,codd)*g
+    return f, hermval(x,ceven)*g
+
+
+def cold(x):
+    """
+    Return the cold smearing occupation and -d/dx of it for x=(e-mu)/width.
+
+    N. Marzari, D. Vanderbilt, A. De Vita and M.C. Payne,
+    Phys. Rev. Lett. 82, 3296 (1999).
+    """
+    u = x + 1/sqrt(2)
+    g = np.exp(-u**2)
+    f = 0.5*erfc(u) + g/sqrt(2*pi)
+    return f, g*(2+sqrt(2)*x)/sqrt(pi)
+
+
 
 class Occupations:
-    def __init__(self,nel,width,wk):
+    def __init__(self,nel,width,wk,smearing='fermi',order=1):
         '''
         Initialize parameters for occupations.
-        
-        @param nel: Number of electrons 
+
+        @param nel: Number of electrons
         @param width: Fermi-broadening
         @param wk: k-point weights
+        @param smearing: 'fermi', 'methfessel-paxton' or 'cold'
+        @param order: order of Methfessel-Paxton smearing
         '''
         self.nel=nel
         self.width=width
         self.wk=wk
         self.nk=len(wk)
-        
-        
+        self.smearing=smearing.lower()
+        self.order=order
+        if self.smearing not in WINDOW:
+            raise ValueError('Unknown smearing %s' %smearing)
+
+
     def get_mu(self):
         """ Return the Fermi-level (or chemical potential). """
         return self.mu
 
 
+    def smear(self,x):
+        """ Return the occupation [0,1] and -d/dx of it for x=(e-mu)/width. """
+        if self.smearing=='fermi':
+            return fermi_dirac(x)
+        elif self.smearing=='methfessel-paxton':
+            return methfessel_paxton(x,self.order)
+        else:
+            return cold(x)
+
+
     def fermi(self,mu):
-        """ Occupy states with given chemical potential. 
-        
+        """ Occupy states with given chemical potential.
+
         Occupations are 0...2; without k-point weights
         """
-        args = (self.e-mu)/self.width
-        # np.exp will return np.inf with RuntimeWarning if the input value
-        # is too large, better to feed it nu.inf in the beginning
-        args = np.where(args < MAX_EXP_ARGUMENT, args, np.inf)
-        exps = np.exp(args)
-        return 2/(exps+1)        
-        
-        
+        return 2*self.smear((self.e-mu)/self.width)[0]
+
+
     def fermi_function(self,e):
         """
         Return Fermi function for given energy [0,1]
         """
-        arg = (e-self.mu)/self.width
-        return 1/(np.exp(arg)+1)  
-        
+        return self.smear((e-self.mu)/self.width)[0]
+
 
     def root_function(self,mu):
         """ This function is exactly zero when mu is right. """
@@ -56,10 +116,24 @@ class Occupations:
         return kf.sum()-self.nel
 
 
+    def _count(self,mu,e,n,nfull):
+        """
+        Return the number of electrons and its derivative wrt. mu,
+        for states e with weights n (window) and nfull electrons below.
+        """
+        f, delta = self.smear((e-mu)/self.width)
+        return nfull + np.dot(n,f), np.dot(n,delta)/self.width
+
+
     def occupy(self,e):
         '''
         Calculate occupation numbers with given Fermi-broadening.
-        
+
+        The Fermi level is bracketed from the cumulative occupation of
+        sorted states, and solved by Newton steps (bisection as a
+        safeguard) evaluating only the states within a window of
+        a few widths around the bracket.
+
         @param e: e[k,a] energy of k-point, state a
         @param wk: wk[:] weights for k-points
         @param width: The Fermi-broadening
@@ -69,27 +143,64 @@ class Occupations:
         ind = np.argsort( eflat )
         e_sorted = eflat[ind]
         n_sorted = (self.wk*np.ones_like(e).transpose()*2).transpose().flatten()[ind]
-        sum = n_sorted.cumsum() 
-        ifermi = np.searchsorted(sum,self.nel)
-        
+        cumsum = n_sorted.cumsum()
+        ifermi = min( np.searchsorted(cumsum,self.nel-1E-12), len(e_sorted)-1 )
+
         xtol = 1E-13
-        
-        try:
-            # make the first guess (simple guess, assuming equal k-point weights)
-            elo = e_sorted[ifermi-1]
-            ehi = e_sorted[ifermi-1]
-            guess = e_sorted(ifermi)
-            dmu = np.max((self.width,guess-elo,ehi-guess))
-            mu  = brentq(self.root_function,guess-dmu,guess+dmu,xtol=xtol)
-        except:
-            # probably a bad guess        
-            dmu = self.width 
-            mu = brentq(self.root_function,e_sorted[0]-dmu,e_sorted[-1]+dmu,xtol=xtol)
-        
-        if np.abs( self.root_function(mu) )>1E-10:
-            raise RuntimeError('Fermi level could not be assigned reliably. Has the system fragmented?')
-            
+        w = self.width
+        window = WINDOW[self.smearing]*w
+        # zero-temperature level, between the highest (partially) filled and the next state
+        lo = e_sorted[ifermi] - w
+        hi = e_sorted[min(ifermi+1,len(e_sorted)-1)] + w
+
+        def states(lo,hi):
+            i1 = np.searchsorted(e_sorted,lo-window)
+            i2 = np.searchsorted(e_sorted,hi+window,side='right')
+            nfull = 0.0 if i1==0 else cumsum[i1-1]
+            return e_sorted[i1:i2], n_sorted[i1:i2], nfull
+
+        # widen the bracket until the number of electrons is bracketed
+        for it in range(200):
+            es, ns, nfull = states(lo,hi)
+            nlo = self._count(lo,es,ns,nfull)[0]-self.nel
+            nhi = self._count(hi,es,ns,nfull)[0]-self.nel
+            if nlo<=0 and nhi>=0:
+                break
+            d = hi-lo
+            if nlo>0:
+                lo -= d
+            if nhi<0:
+                hi += d
+        else:
+            raise RuntimeError('Fermi level could not be bracketed.')
+
+        mu = 0.5*(lo+hi)
+        for it in range(200):
+            n, dn = self._count(mu,es,ns,nfull)
+            r = n-self.nel
+            if abs(r)<1E-13*max(self.nel,1):
+                break
+            if r>0:
+                hi = mu
+            else:
+                lo = mu
+            if hi-lo<xtol:
+                break
+            # Newton step only when it stays within the bracket, otherwise bisect
+            # (also avoids overflow in r/dn for tiny dn)
+            mu_new = 0.5*(lo+hi)
+            if abs(r)<dn*(hi-lo):
+                mu_new = mu - r/dn
+                if not lo<=mu_new<=hi:
+                    mu_new = 0.5*(lo+hi)
+            step, mu = mu_new-mu, mu_new
+            if abs(step)<xtol:
+                break
+
         f = self.fermi(mu)
+        if np.abs( np.dot(self.wk,f.sum(axis=1))-self.nel )>1E-10:
+            raise RuntimeError('Fermi level could not be assigned reliably. Has the system fragmented?')
+
         self.mu, self.f = mu, f
         return f
 
@@ -103,10 +214,3 @@ class Occupations:
         pl.xlabel('energy (Ha)')
         pl.ylabel('occupation')
         pl.show()
-
-
-
-
-
-
-
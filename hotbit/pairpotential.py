@@ -6,6 +6,7 @@ from __future__ import print_function
 import numpy as np
 from my_ase.units import Hartree, Bohr
 from weakref import proxy
+from hotbit.shortrange import pair_sum, group_by_label, evaluate
 
 def ij2s(i,j):
     return '%04i%04i' %(i,j)
@@ -21,6 +22,8 @@ class PairPotential:
         self.atomv = {}
         self.elemv = {}
         self.rcut=0.0
+        self.pairs=None
+        self.result=None
         self.symbols = [s[0] for s in self.calc.el.get_property_lists(['s'])]
         self.greet = False
         
@@ -53,7 +56,7 @@ class PairPotential:
         # construct a function that works in atomic units
         if eVA:
             def v2(r,der=0):
-                if r==None:
+                if r is None:
                     return v(None)/Bohr
                 if der==0:
                     return v(r/Bohr,der)/Hartree
@@ -72,6 +75,7 @@ class PairPotential:
             self.elemv[j+i]=v2
         self.rcut = max(self.rcut, v2(None))
         self.ex = True
+        self.pairs = None
         
         
     def _get_full_v(self,i,j):
@@ -94,6 +98,38 @@ class PairPotential:
         return v      
 
 
+    def _pair_groups(self,i,j):
+        """
+        Return the list of (indices,potential) for given pairs; element pair
+        potentials are evaluated for all pairs of the same elements at once.
+        """
+        present = sorted(set(self.symbols))
+        types = np.array([present.index(s) for s in self.symbols])
+        labels = types[i]*len(present)+types[j]
+        groups = []
+        for l,indices in group_by_label(labels):
+            sij = present[l//len(present)]+present[l%len(present)]
+            if sij in self.elemv:
+                groups.append( (indices,self.elemv[sij]) )
+        for ij in self.atomv:
+            a, b = int(ij[:4]), int(ij[4:])
+            groups.append( (np.flatnonzero((i==a) & (j==b)),self.atomv[ij]) )
+        return groups
+
+
+    def _evaluate(self):
+        """
+        Return the energy, forces and virial (atomic units), calculated
+        once for each geometry (pair list) and set of potentials.
+        """
+        pairs = self.calc.el.get_pair_list(self.rcut,full=True)
+        if pairs is not self.pairs:
+            i, j, n, rij, dij = pairs
+            self.result = pair_sum(self.N,i,rij,dij,self._pair_groups(i,j))
+            self.pairs = pairs
+        return self.result
+
+
     def get_energy(self):
         """ Return the energy in pair potentials (in eV). """
         if not self.ex:
@@ -102,21 +138,7 @@ class PairPotential:
         if not self.greet:
             self.greetings()
             self.greet = True            
-        
-        lst=self.calc.el.get_property_lists(['i','s'])
-        Rijn = self.calc.el.rijn
-        epp=0.0
-        for i,si in lst: 
-            for j,sj in lst[i:]:
-                for n,rijn in enumerate(Rijn[:,i,j]): 
-                    if i==j and n==0: continue
-                    d = np.sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-                    if d>self.rcut: continue
-                    v = self._get_full_v(i,j)                 
-                    if i==j:
-                        epp+=0.5*v(d)
-                    else:
-                        epp+=v(d)
+        epp, f, virial = self._evaluate()
         self.calc.stop_timing('e_pp') 
         return epp*Hartree
     
@@ -129,17 +151,13 @@ class PairPotential:
         ===========
         i,j:     atom indices
         """
-        Rijn = self.calc.el.rijn
-        epp=0.0
-        for n,rijn in enumerate(Rijn[:,i,j]): 
-            if i==j and n==0: continue
-            d = np.sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-            if d>self.rcut: continue
-            v = self._get_full_v(i,j)
-            if i==j:
-                epp += 0.5*v(d)
-            else:
-                epp += v(d)
+        if not self.ex:
+            return 0.0
+        pi, pj, n, rij, dij = self.calc.el.get_pair_list(self.rcut,full=True)
+        select = (pi==i) & (pj==j)
+        epp = evaluate(self._get_full_v(i,j),dij[select]).sum()
+        if i==j:
+            epp *= 0.5
         return epp
     
 
@@ -149,22 +167,24 @@ class PairPotential:
         
         F_i = sum_(j,n) V'(rijn) rijn/dijn, with rijn = r_j^n -r_i and dijn=|rijn|
         """
-        f=np.zeros((self.N,3))
-        if not self.exists:
-            return f
+        if not self.ex:
+            return np.zeros((self.N,3))
         self.calc.start_timing('f_pp')
-        lst = self.calc.el.get_property_lists(['i','s'])
-        Rijn = self.calc.el.rijn
-        for i,si in lst:
-            for j,sj in lst:
-                V = self._get_full_v(i,j)
-                for n,rijn in enumerate(Rijn[:,i,j]):
-                    if i==j and n==0: continue
-                    dijn = np.sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-                    if dijn<self.rcut:
-                        f[i,:] = f[i,:] + V(dijn,der=1)*rijn/dijn
+        epp, f, virial = self._evaluate()
         self.calc.stop_timing('f_pp')
-        return f
+        return f.copy()
+
+
+    def get_virial(self):
+        """
+        Return the pair potential virial in atomic units.
+
+        W_ab = 1/2 sum_(i,j,n) V'(dijn) rijn_a rijn_b/dijn
+        """
+        if not self.ex:
+            return np.zeros((3,3))
+        epp, f, virial = self._evaluate()
+        return virial.copy()
 
 
     def get_table(self, i, j, n=1000):
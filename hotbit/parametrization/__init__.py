@@ -1,4 +1,5 @@
-from .atom import KSAllElectron
+from .atom import KSAllElectron, run_atoms
+from .cache import AtomCache
 from .slako import SlaterKosterTable 
 from .fitting import RepulsiveFitting
 from .fitting import ParametrizationTest
@@ -2,16 +2,19 @@ from __future__ import division, print_function
 
 import numpy as np
 from scipy.integrate import odeint
+from scipy.linalg import solve_banded
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from box.data import data
 from copy import copy
 from box.interpolation import Function, SplineFunction
 import sys
 import os
 from box.timing import Timer
+from .cache import AtomCache
 from time import asctime
 import math
 import pickle
-import collections
 
 try:
     import pylab as pl
@@ -23,6 +26,15 @@ sqrt=math.sqrt
 pi=math.pi
 log=math.log
 
+# the inward integration in shoot starts where the solution has
+# decayed below exp(-LOG_TAIL) relative to the turning point
+LOG_TAIL=345.0
+
+# attributes set by KSAllElectron.run
+SOLUTION=['enl','d_enl','unlg','Rnlg','unl_fct','Rnl_fct','veff','dveff','dens',
+          'conf','nucl','Hartree','vxc','exc','bs_energy','Hartree_energy',
+          'vxc_energy','exc_energy','confinement_energy','total_energy']
+
 class KSAllElectron:
     def __init__(self,symbol,
                       configuration={},
@@ -39,7 +51,8 @@ class KSAllElectron:
                       verbose=False,
                       txt=None,
                       restart=None,
-                      write=None):
+                      write=None,
+                      cache=None):
         """
         Make Kohn-Sham all-electron calculation for given atom.
 
@@ -73,6 +86,10 @@ class KSAllElectron:
                         density to a file for further calculations.
         restart:        filename: make an initial guess for effective
                         potential and density from another calculation.
+        cache:          directory (or AtomCache) for caching solved atoms; identical
+                        calculations are then read from the cache. Default is
+                        the directory in HOTBIT_ATOM_CACHE environment variable
+                        (no caching if not set). cache=False disables caching.
         """
         self.symbol=symbol
         self.valence=valence
@@ -90,6 +107,14 @@ class KSAllElectron:
         self.timer.start('init')
         self.restart = restart
         self.write = write
+        if cache is None:
+            cache = os.environ.get('HOTBIT_ATOM_CACHE')
+        if cache is None or cache is False:
+            self.cache = None
+        elif isinstance(cache,AtomCache):
+            self.cache = cache
+        else:
+            self.cache = AtomCache(cache)
 
         # element data
         self.data=copy( data[self.symbol] )
@@ -145,11 +170,19 @@ class KSAllElectron:
         """ Return dictionary of all pickable items. """
         d=self.__dict__.copy()
         for key in self.__dict__:
-            if isinstance(d[key], collections.Callable):
+            if callable(d[key]) or key in ['txt','timer','xcf','cache']:
                 d.pop(key)
-        d.pop('out')
         return d
 
+    def get_solution(self):
+        """ Return dictionary of the solved quantities (see run). """
+        return dict( [(key,self.__dict__[key]) for key in SOLUTION if key in self.__dict__] )
+
+    def set_solution(self,solution):
+        """ Set the solved quantities from get_solution. """
+        self.__dict__.update(solution)
+        self.solved=True
+
     def set_output(self,txt):
         """ Set output channel and give greetings. """
         if txt == '-':
@@ -236,18 +269,10 @@ class KSAllElectron:
         n0=0.5*(self.dens[1:]+self.dens[:-1])
         n0*=self.nel/sum(n0*dV)
 
-        lo, hi, Hartree=np.zeros(N), np.zeros(N), np.zeros(N)
-        lo[0]=0.0
-        for i in range(1,N):
-            lo[i] = lo[i-1] + dV[i-1]*n0[i-1]
-
-        hi[-1]=0.0
-        for i in range(N-2,-1,-1):
-            hi[i] = hi[i+1] + n0[i]*dV[i]/r0[i]
-
-        for i in range(N):
-            Hartree[i] = lo[i]/r[i] + hi[i]
-        self.Hartree=Hartree
+        lo, hi=np.zeros(N), np.zeros(N)
+        lo[1:]=np.cumsum(dV*n0)
+        hi[:-1]=np.cumsum((n0*dV/r0)[::-1])[::-1]
+        self.Hartree=lo/r + hi
         self.timer.stop('Hartree')
 
 
@@ -289,8 +314,8 @@ class KSAllElectron:
                 dens = pickle.load(f)
                 v = splrep(rgrid, veff)
                 d = splrep(rgrid, dens)
-                self.veff = array([splev(r,v) for r in self.rgrid])
-                self.dens = array([splev(r,d) for r in self.rgrid])
+                self.veff = splev(self.rgrid,v)
+                self.dens = splev(self.rgrid,d)
                 f.close()
                 done = True
             except:
@@ -304,7 +329,16 @@ class KSAllElectron:
     def run(self):
         """
         Solve the self-consistent potential.
+
+        If the atom has been solved before with the same cache,
+        the solution is read from there.
         """
+        if self.cache is not None and self.cache.load(self):
+            print('\nSolution read from cache %s' %self.cache.directory, file=self.txt)
+            self.calculate_energies(echo=True)
+            self.write_restart()
+            self.txt.flush()
+            return
         self.timer.start('solve ground state')
         print('\nStart iteration...', file=self.txt)
         self.enl={}
@@ -316,8 +350,8 @@ class KSAllElectron:
         N=self.grid.get_N()
 
         # make confinement and nuclear potentials; intitial guess for veff
-        self.conf=array([self.confinement_potential(r) for r in self.rgrid])
-        self.nucl=array([self.V_nuclear(r) for r in self.rgrid])
+        self.conf=self.confinement_potential(self.rgrid)*np.ones(N)
+        self.nucl=self.V_nuclear(self.rgrid)
         self.get_veff_and_dens()
         self.calculate_Hartree_potential()
         #self.Hartree=np.zeros((N,))
@@ -326,7 +360,7 @@ class KSAllElectron:
             self.veff=self.mix*self.calculate_veff()+(1-self.mix)*self.veff
             if self.scalarrel:
                 veff = SplineFunction(self.rgrid, self.veff)
-                self.dveff = array([veff(r, der=1) for r in self.rgrid])
+                self.dveff = veff(self.rgrid, der=1)
             d_enl_max, itmax=self.solve_eigenstates(it)
 
             dens0=self.dens.copy()
@@ -354,6 +388,13 @@ class KSAllElectron:
         self.timer.summary()
         self.txt.flush()
         self.solved=True
+        if self.cache is not None:
+            self.cache.store(self)
+        self.write_restart()
+
+
+    def write_restart(self):
+        """ Save rgrid, effective potential and density into file given by write. """
         if self.write != None:
             f=open(self.write,'wb')
             pickle.dump(self.rgrid, f)
@@ -477,7 +518,7 @@ class KSAllElectron:
             c1 = -np.ones(self.N)
         else:
             # from Paolo Giannozzi: Notes on pseudopotential generation
-            ScR_mass = array([1 + 0.5*(eps-V)/c**2 for V in self.veff])
+            ScR_mass = 1 + 0.5*(eps-self.veff)/c**2
             c0 = -l*(l+1) - 2*ScR_mass*self.rgrid**2*(self.veff-eps) - self.dveff*self.rgrid/(2*ScR_mass*c**2)
             c1 = self.rgrid*self.dveff/(2*ScR_mass*c**2) - 1
         return c0, c1, c2
@@ -642,6 +683,57 @@ class KSAllElectron:
         print('\n\n', file=o)
 
 
+# atoms solved by the worker processes (inherited by fork, see run_atoms)
+_forked_atoms=None
+
+
+def _run_atom(i):
+    """ Solve one atom in a worker process and return its solution. """
+    atom=_forked_atoms[i]
+    atom.run()
+    return atom.get_solution()
+
+
+def run_atoms(atoms,workers=None):
+    """
+    Solve several atoms (e.g. a scan of confinements) in parallel.
+
+    The atoms are solved in a pool of processes, and the solved
+    states (energies, wave functions and the Rnl and unl functions)
+    are copied into the given KSAllElectron instances. Output of
+    each atom goes to its txt as usual.
+
+    parameters:
+    -----------
+    atoms:      list of KSAllElectron instances
+    workers:    number of processes (default: number of CPUs);
+                with workers=1 the atoms are solved one by one.
+
+    Parallel runs need the 'fork' start method of multiprocessing.
+    """
+    global _forked_atoms
+    if workers is None:
+        workers=multiprocessing.cpu_count()
+    workers=min(workers,len(atoms))
+    if workers<=1:
+        for atom in atoms:
+            atom.run()
+        return atoms
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise RuntimeError('Parallel atom calculations need the fork start method.')
+    for atom in atoms:
+        atom.txt.flush()
+    _forked_atoms=atoms
+    try:
+        with ProcessPoolExecutor(workers,mp_context=multiprocessing.get_context('fork')) as pool:
+            solutions=list(pool.map(_run_atom,range(len(atoms))))
+    finally:
+        _forked_atoms=None
+    for atom,solution in zip(atoms,solutions):
+        atom.set_solution(solution)
+    return atoms
+
+
 def shoot(u,dx,c2,c1,c0,N):
     """
     Integrate diff equation
@@ -659,6 +751,13 @@ def shoot(u,dx,c2,c1,c0,N):
 
     u[0:2] *has already been set* according to boundary conditions.
 
+    The three-term recursions (inwards down to the classical turning
+    point and outwards up to it) are solved as banded triangular
+    systems. Inwards the solution grows exponentially; the integration
+    starts from the point where it has decayed below exp(-LOG_TAIL)
+    relative to the turning point (estimated from the local growth
+    rate), and u is zero beyond that.
+
     return u, number of nodes, the discontinuity of derivative at
     classical turning point (ctp), and ctp
     c0(r) is negative with large r, and turns positive at ctp.
@@ -667,28 +766,54 @@ def shoot(u,dx,c2,c1,c0,N):
     fm=c2/dx**2 - 0.5*c1/dx
     f0=c0-2*c2/dx**2
 
-    # backward integration down to classical turning point ctp
-    # (or one point beyond to get derivative)
+    # classical turning point ctp (or one point beyond to get derivative)
     # If no ctp, integrate half-way
-    u[-1]=1.0
-    u[-2]=u[-1]*f0[-1]/fm[-1]
-    all_negative=np.all(c0<0)
-    for i in range(N-2,0,-1):
-        u[i-1]=(-fp[i]*u[i+1]-f0[i]*u[i])/fm[i]
-        if abs(u[i-1])>1E10: u[i-1:]*=1E-10 #numerical stability
-        if c0[i]>0:
-            ctp=i
-            break
-        if all_negative and i==N//2:
-            ctp=N//2
-            break
+    positive=np.nonzero(c0[1:N-1]>0)[0]
+    if len(positive)>0:
+        ctp=positive[-1]+1
+    else:
+        ctp=N//2
+
+    # local growth of the solution per step inwards, the larger root of
+    # fm*x**2 + f0*x + fp = 0; start where the total growth is LOG_TAIL
+    a, b=-f0[ctp:]/fm[ctp:], -fp[ctp:]/fm[ctp:]
+    growth=np.log(np.maximum(0.5*(np.abs(a)+np.sqrt(np.maximum(a*a+4*b,0.0))),1.0))
+    i0=ctp+np.searchsorted(np.cumsum(growth),LOG_TAIL)
+    i0=min(max(i0,ctp+1),N-1)
+
+    # backward integration: fm[i]*u[i-1]+f0[i]*u[i]+fp[i]*u[i+1]=0
+    # for i=ctp...i0-1, unknowns u[ctp-1...i0-2]
+    u[i0+1:]=0.0
+    u[i0]=1.0
+    u[i0-1]=u[i0]*f0[i0]/fm[i0]
+    m=i0-ctp
+    ab=np.zeros((3,m))
+    ab[0,2:]=fp[ctp:i0-2]
+    ab[1,1:]=f0[ctp:i0-1]
+    ab[2,:]=fm[ctp:i0]
+    rhs=np.zeros(m)
+    rhs[-1]=-fp[i0-1]*u[i0]-f0[i0-1]*u[i0-1]
+    if m>1:
+        rhs[-2]=-fp[i0-2]*u[i0-1]
+    u[ctp-1:i0-1]=solve_banded((0,2),ab,rhs,overwrite_ab=True,overwrite_b=True,check_finite=False)
+    umax=np.abs(u[ctp-1:i0+1]).max()
+    if umax>1E10:
+        u[ctp-1:i0+1]/=umax #numerical stability
 
     utp=u[ctp]
     utp1=u[ctp+1]
     dright=(u[ctp+1]-u[ctp-1])/(2*dx)
 
-    for i in range(1,ctp+1):
-        u[i+1]=(-f0[i]*u[i]-fm[i]*u[i-1])/fp[i]
+    # forward integration: unknowns u[ctp+1...2] (in this order)
+    ab=np.zeros((3,ctp))
+    ab[0,2:]=fm[ctp:2:-1]
+    ab[1,1:]=f0[ctp:1:-1]
+    ab[2,:]=fp[ctp:0:-1]
+    rhs=np.zeros(ctp)
+    rhs[-1]=-f0[1]*u[1]-fm[1]*u[0]
+    if ctp>1:
+        rhs[-2]=-fm[2]*u[1]
+    u[ctp+1:1:-1]=solve_banded((0,2),ab,rhs,overwrite_ab=True,overwrite_b=True,check_finite=False)
 
     dleft=(u[ctp+1]-u[ctp-1])/(2*dx)
     scale=utp/u[ctp]
@@ -697,7 +822,7 @@ def shoot(u,dx,c2,c1,c0,N):
     dleft*=scale
     u=u*np.sign(u[1])
 
-    nodes=sum( (u[0:ctp-1]*u[1:ctp])<0 )
+    nodes=np.count_nonzero( (u[0:ctp-1]*u[1:ctp])<0 )
     A=(dright-dleft)*utp
     return u, nodes, A, ctp
 
@@ -841,8 +966,8 @@ class XC_PW92:
             exc_clip = self.clipped_exc(n,der=der)
         elif (n.ndim==1):
             exc_clip = np.zeros_like(n)
-            for i_n, n_i in enumerate(n):
-                exc_clip[i_n] = self.clipped_exc(n_i,der=der)
+            mask = n>=self.small
+            exc_clip[mask] = self.e_x(n[mask],der=der)+self.e_corr(n[mask],der=der)
         else:
             msg = "Got density of unexpected dimensionality "+str(n.ndim)
             raise ValueError(msg)
@@ -0,0 +1,125 @@
+from __future__ import division, print_function
+
+import os
+import pickle
+import hashlib
+
+# increase when the stored solution changes
+CACHE_VERSION=1
+
+
+class AtomCache:
+    def __init__(self,directory,maxsize=200):
+        """
+        On-disk cache of solved KSAllElectron calculations.
+
+        Solutions are stored in files named by a hash of everything
+        that defines the calculation (symbol, configuration, confinement,
+        xc functional, radial grid, scalar-relativistic flag and
+        convergence criteria), so an identical atom is never solved twice.
+        The least recently used solutions are removed when there are
+        more than maxsize of them.
+
+        parameters:
+        -----------
+        directory:  cache directory (created if needed)
+        maxsize:    maximum number of cached atoms
+        """
+        self.directory=os.path.expanduser(directory)
+        self.maxsize=maxsize
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+
+    def get_key(self,atom):
+        """ Return the content hash of the given atom calculation. """
+        if atom.confinement is None:
+            confinement=None
+        else:
+            confinement=sorted(atom.confinement.items())
+        content=( CACHE_VERSION,
+                  atom.symbol,
+                  sorted(atom.occu.items()),
+                  confinement,
+                  atom.xc,
+                  (atom.rmin,atom.rmax,atom.N),
+                  bool(atom.scalarrel),
+                  sorted(atom.convergence.items()) )
+        return hashlib.sha1(repr(content).encode()).hexdigest()
+
+
+    def get_filename(self,atom):
+        return os.path.join(self.directory,self.get_key(atom)+'.atom')
+
+
+    def load(self,atom):
+        """
+        Set the solution of atom from the cache.
+
+        Return True if the solution was found, False otherwise.
+        """
+        fn=self.get_filename(atom)
+        try:
+            f=open(fn,'rb')
+        except IOError:
+            return False
+        try:
+            solution=pickle.load(f)
+        except Exception:
+            # corrupted entry, solve again
+            f.close()
+            self._remove(fn)
+            return False
+        f.close()
+        atom.set_solution(solution)
+        # mark as recently used
+        try:
+            os.utime(fn,None)
+        except OSError:
+            pass
+        return True
+
+
+    def store(self,atom):
+        """ Store the solution of atom and remove least recently used entries. """
+        fn=self.get_filename(atom)
+        tmp='%s.%i.tmp' %(fn,os.getpid())
+        f=open(tmp,'wb')
+        pickle.dump(atom.get_solution(),f,protocol=pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.replace(tmp,fn)
+        self.evict()
+
+
+    def evict(self):
+        """ Remove the least recently used entries beyond maxsize. """
+        entries=[]
+        for name in os.listdir(self.directory):
+            if not name.endswith('.atom'):
+                continue
+            fn=os.path.join(self.directory,name)
+            try:
+                entries.append((os.path.getmtime(fn),fn))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime,fn in entries[:max(len(entries)-self.maxsize,0)]:
+            self._remove(fn)
+
+
+    def clear(self):
+        """ Remove all cached atoms. """
+        for name in os.listdir(self.directory):
+            if name.endswith('.atom'):
+                self._remove(os.path.join(self.directory,name))
+
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.directory) if name.endswith('.atom')])
+
+
+    def _remove(self,fn):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
@@ -5,6 +5,8 @@ import sys
 from box.timing import Timer
 from .util import tail_smoothening
 from time import asctime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import math
 sin=math.sin
 cos=math.cos
@@ -14,6 +16,34 @@ sqrt=math.sqrt
 pi=math.pi
 zeros=np.zeros
 
+# table calculated by the worker processes (inherited by fork, see run)
+_forked_table=None
+
+
+def _table_row(args):
+    """ Calculate one R-point of the table in a worker process. """
+    return _forked_table.calculate_row(*args)
+
+
+def on_grid(f,r):
+    """
+    Return f(r) for an array r.
+
+    Functions are called once with the whole array; functions
+    that accept only scalars are called point by point.
+    """
+    try:
+        y=np.asarray(f(r),float)
+        if y.shape==r.shape:
+            return y
+        if y.shape==():
+            # constant, e.g. no confinement
+            return np.full(r.shape,float(y))
+    except (TypeError,ValueError):
+        pass
+    return np.array([f(x) for x in r],float)
+
+
 class SlaterKosterTable:
     def __init__(self,ela,elb,txt=None,timing=False):
         """ Construct Slater-Koster table for given elements.
@@ -24,9 +54,15 @@ class SlaterKosterTable:
         elb:    element objects (KSAllElectron or Element)    
         txt:    output file object or file name
         timing: output of timing summary after calculation
+
+        KSAllElectron atoms that are not solved yet are run here
+        (or read from their cache).
         """
         self.ela=ela
         self.elb=elb
+        for el in [ela,elb]:
+            if not getattr(el,'solved',True):
+                el.run()
         self.timing=timing
         if txt==None:
             self.txt=sys.stdout
@@ -177,7 +213,7 @@ class SlaterKosterTable:
         self.timer.stop('define ranges')        
         
         
-    def run(self,R1,R2,N,ntheta=150,nr=50,wflimit=1E-7):
+    def run(self,R1,R2,N,ntheta=150,nr=50,wflimit=1E-7,workers=1):
         """ Calculate the Slater-Koster table. 
          
         parameters:
@@ -189,7 +225,10 @@ class SlaterKosterTable:
                 with ntheta=150, nr=50 you get~1E-4 accuracy for H-elements
                 (beyond that, gain is slow with increasing grid size)
         wflimit: use max range for wfs such that at R(rmax)<wflimit*max(R(r))
+        workers: number of processes calculating the R-points in parallel
+                (needs the 'fork' start method of multiprocessing)
         """
+        global _forked_table
         if R1<1E-3:
             raise AssertionError('For stability; use R1>~1E-3')
         self.timer.start('calculate tables')   
@@ -203,21 +242,30 @@ class SlaterKosterTable:
         else: self.tables=[np.zeros((N,20)),np.zeros((N,20))]
         
         print('Start making table...', file=self.txt)
-        for Ri,R in enumerate(Rgrid):
-            if R>2*self.wf_range: 
-                break
-            grid, areas = self.make_grid(R,nt=ntheta,nr=nr)
+        args=[(R,ntheta,nr) for R in Rgrid if R<=2*self.wf_range]
+        if workers>1 and len(args)>1:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise RuntimeError('Parallel table construction needs the fork start method.')
+            _forked_table=self
+            try:
+                with ProcessPoolExecutor(workers,mp_context=multiprocessing.get_context('fork')) as pool:
+                    rows=list(pool.map(_table_row,args))
+            finally:
+                _forked_table=None
+        else:
+            rows=[self.calculate_row(*arg) for arg in args]
+
+        for Ri,(R,(ngrid,mels)) in enumerate(zip(Rgrid,rows)):
             if  Ri==N-1 or N//10 == 0 or np.mod(Ri,N//10)==0:                    
-                    print('R=%8.2f, %i grid points ...' %(R,len(grid)), file=self.txt)
+                    print('R=%8.2f, %i grid points ...' %(R,ngrid), file=self.txt)
             for p,(e1,e2) in enumerate(self.pairs):
-                selected=select_integrals(e1,e2) 
                 if Ri==0:
-                    print('R=%8.2f %s-%s, %i grid points, ' %(R,e1.get_symbol(),e2.get_symbol(),len(grid)), end=' ', file=self.txt)
+                    print('R=%8.2f %s-%s, %i grid points, ' %(R,e1.get_symbol(),e2.get_symbol(),ngrid), end=' ', file=self.txt)
                     print('integrals:', end=' ', file=self.txt) 
-                    for s in selected: print(s[0], end=' ', file=self.txt)
+                    for s in select_integrals(e1,e2): print(s[0], end=' ', file=self.txt)
                     print(file=self.txt) 
                 
-                S,H,H2=self.calculate_mels(selected,e1,e2,R,grid,areas)
+                S,H,H2=mels[p]
                 self.Hmax=max(self.Hmax,max(abs(H)))
                 self.dH=max(self.dH,max(abs(H-H2)))
                 self.tables[p][Ri,:10]=H
@@ -229,8 +277,19 @@ class SlaterKosterTable:
         self.timer.stop('calculate tables')  
         self.comment+='\n'+asctime()
         self.txt.flush()
-                    
-                    
+
+
+    def calculate_row(self,R,ntheta,nr):
+        """
+        Return the number of grid points and (S,H,H2) for each element pair
+        at distance R (see calculate_mels).
+        """
+        grid, areas = self.make_grid(R,nt=ntheta,nr=nr)
+        mels=[]
+        for e1,e2 in self.pairs:
+            selected=select_integrals(e1,e2)
+            mels.append( self.calculate_mels(selected,e1,e2,R,grid,areas) )
+        return len(grid), mels
                     
                     
     def calculate_mels(self,selected,e1,e2,R,grid,area):
@@ -263,34 +322,36 @@ class SlaterKosterTable:
         self.timer.start('calculate_mels')
         Sl, Hl, H2l=np.zeros(10), np.zeros(10), np.zeros(10)
         
-        # common for all integrals (not wf-dependent parts)
+        # common for all integrals (not wf-dependent parts),
+        # evaluated for all grid points at once
         self.timer.start('prelude')
-        N=len(grid)
-        gphi, radii, v1, v2=zeros((N,10)), zeros((N,2)), zeros(N), zeros(N)
-        for i,(d,z) in enumerate(grid):
-            r1, r2=sqrt(d**2+z**2), sqrt(d**2+(R-z)**2)
-            t1, t2=arccos(z/r1), arccos((z-R)/r2)
-            radii[i,:]=[r1,r2]
-            gphi[i,:]=g(t1,t2)
-            v1[i]=e1.effective_potential(r1)-e1.confinement_potential(r1) 
-            v2[i]=e2.effective_potential(r2)-e2.confinement_potential(r2) 
+        d, z=grid[:,0], grid[:,1]
+        r1, r2=np.sqrt(d**2+z**2), np.sqrt(d**2+(R-z)**2)
+        t1, t2=np.arccos(z/r1), np.arccos((z-R)/r2)
+        gphi=g(t1,t2)
+        conf1=on_grid(e1.confinement_potential,r1)
+        v1=on_grid(e1.effective_potential,r1)-conf1
+        v2=on_grid(e2.effective_potential,r2)-on_grid(e2.confinement_potential,r2)
+        dA=area*d
         self.timer.stop('prelude')                             
         
-        # calculate all selected integrals
+        # calculate all selected integrals; radial functions
+        # are evaluated once for each orbital
+        Rnl1, Rnl2, ddunl2={}, {}, {}
         for integral,nl1,nl2 in selected:           
             index=integrals.index(integral)
-            S, H, H2=0.0, 0.0, 0.0
             l2=angular_momentum[nl2[1]]
-            for i,dA in enumerate(area):            
-                r1, r2=radii[i,:]
-                d, z=grid[i]
-                aux=gphi[i,index]*dA*d
-                
-                Rnl1, Rnl2, ddunl2=e1.Rnl(r1,nl1), e2.Rnl(r2,nl2), e2.unl(r2,nl2,der=2)
-                
-                S+= Rnl1*Rnl2*aux 
-                H+= Rnl1*( -0.5*ddunl2/r2 + (v1[i]+v2[i]+l2*(l2+1)/(2*r2**2))*Rnl2 )*aux
-                H2+= Rnl1*Rnl2*aux*( v2[i]-e1.confinement_potential(r1) )
+            if nl1 not in Rnl1:
+                Rnl1[nl1]=on_grid(lambda r: e1.Rnl(r,nl1),r1)
+            if nl2 not in Rnl2:
+                Rnl2[nl2]=on_grid(lambda r: e2.Rnl(r,nl2),r2)
+                ddunl2[nl2]=on_grid(lambda r: e2.unl(r,nl2,der=2),r2)
+            aux=gphi[index]*dA
+            RR=Rnl1[nl1]*Rnl2[nl2]*aux
+            
+            S=RR.sum()
+            H=np.dot( Rnl1[nl1]*aux, -0.5*ddunl2[nl2]/r2 + (v1+v2+l2*(l2+1)/(2*r2**2))*Rnl2[nl2] )
+            H2=np.dot( RR, v2-conf1 )
             H2+=e1.get_epsilon(nl1)*S 
             Sl[index]=S
             Hl[index]=H
@@ -469,8 +530,10 @@ def g(t1,t2):
     integral (it) with t1=theta_1 (atom at origin)
     and t2=theta2 (atom at z=Rz). These dependencies
     come after integrating analytically over phi.
+    For arrays t1 and t2 the factors are g[integral,point].
     """
-    c1, c2, s1, s2=cos(t1), cos(t2), sin(t1), sin(t2)   
+    c1, c2, s1, s2=np.cos(t1), np.cos(t2), np.sin(t1), np.sin(t2)
+    ones=np.ones_like(c1)
     return np.array([5.0/8*(3*c1**2-1)*(3*c2**2-1),\
             15.0/4*s1*c1*s2*c2,\
             15.0/16*s1**2*s2**2,\
@@ -480,7 +543,7 @@ def g(t1,t2):
             3.0/4*s1*s2,\
             sqrt(5.0)/4*(3*c2**2-1),\
             sqrt(3.0)/2*c2,\
-            0.5])
+            0.5*ones])
            
         
 if __name__=='__main__':
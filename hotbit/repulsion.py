@@ -5,7 +5,8 @@ import numpy as np
 from my_ase.units import Bohr,Hartree
 from box import mix
 from box.interpolation import Function
-from hotbit.io import read_repulsion
+from hotbit.io import read_repulsion, find_value
+from hotbit.shortrange import pair_sum, group_by_label, evaluate
 import os
 import my_ase
 from weakref import proxy
@@ -29,6 +30,8 @@ class Repulsion:
                 self.vrep[si+sj]=RepulsivePotential(self.files[si+sj])
                 self.rmax = max( self.rmax, self.vrep[si+sj].get_r_cut() )
         self.N=calc.el.get_N()
+        self.pairs=None
+        self.result=None
 
     def __del__(self):
         pass
@@ -43,7 +46,7 @@ class Repulsion:
                     txt+='  %s%s: None\n' %(s1,s2)
                 else:
                     txt+='  %s%s in %s\n' %(s1,s2,file)
-                    doc=mix.find_value(file,'repulsion_comment',fmt='strings',default=['no repulsion doc'])
+                    doc=find_value(file,'repulsion_comment',fmt='strings',default=['no repulsion doc'])
                     for line in doc:
                         txt+='    *'+line.lstrip()+'\n'
         return txt
@@ -66,44 +69,42 @@ class Repulsion:
         =======
         d:          numpy array of distances (in Angstroms) below r_cut
         """
-        lst = self.calc.el.get_property_lists(['i','s'])
-        Rijn = self.calc.el.rijn
-        r_cut /= Bohr
-        
-        dlist=[]
-        for i,si in lst:
-            for j,sj in lst[i:]:
-                if not ((si==ela and sj==elb) or (sj==ela and si==elb)) :
-                    continue
-                for n,rijn in enumerate(Rijn[:,i,j]):
-                    if i==j and n==0: continue
-                    d = np.sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-                    if d<=r_cut:
-                        dlist.append(d)
-        return np.array(dlist)*Bohr
-                    
-    
+        i, j, n, rij, dij = self.calc.el.get_pair_list(r_cut/Bohr)
+        symbols = np.array(self.calc.el.symbols)
+        si, sj = symbols[i], symbols[j]
+        select = ((si==ela) & (sj==elb)) | ((si==elb) & (sj==ela))
+        return dij[select]*Bohr
+
+
+    def _pair_groups(self,i,j):
+        """ Return the list of (indices,potential) for the element pairs of given pairs. """
+        present = self.calc.el.get_present()
+        types = np.array([present.index(s) for s in self.calc.el.symbols])
+        labels = types[i]*len(present)+types[j]
+        return [ (indices,self.vrep[present[l//len(present)]+present[l%len(present)]]) \
+                 for l,indices in group_by_label(labels) ]
+
+
+    def _evaluate(self):
+        """
+        Return the repulsive energy, forces and virial (atomic units)
+        with all pairs (within rmax) of the same elements evaluated at once.
+
+        The pair list is new for each geometry; the result is calculated
+        once for it and reused for energy, forces and virial.
+        """
+        pairs = self.calc.el.get_pair_list(self.rmax,full=True)
+        if pairs is not self.pairs:
+            i, j, n, rij, dij = pairs
+            self.result = pair_sum(self.N,i,rij,dij,self._pair_groups(i,j))
+            self.pairs = pairs
+        return self.result
+
 
     def get_repulsive_energy(self):
         """ Return the repulsive energy (in eV). """
         self.calc.start_timing('e_rep')
-        
-        # TODO: be more selective with n (for efficiency)
-        lst=self.calc.el.get_property_lists(['i','s'])
-        Rijn = self.calc.el.rijn
-        erep=0.0
-        for i,si in lst: 
-            for j,sj in lst[i:]:
-                for n,rijn in enumerate(Rijn[:,i,j]): 
-                    if i==j and n==0: continue
-                    d = np.sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-                    if d>self.rmax: continue
-                    # TODO: remove following assert
-                    assert(d>1E-10)
-                    if i==j:
-                        erep+=0.5*self.vrep[si+sj](d)
-                    else:
-                        erep+=self.vrep[si+sj](d)
+        erep, f, virial = self._evaluate()
         self.calc.stop_timing('e_rep') 
         return erep*Hartree
     
@@ -116,18 +117,12 @@ class Repulsion:
         ===========
         i,j:     atom indices
         """
-        si = self.calc.el.symbols[i]
-        sj = self.calc.el.symbols[j]                        
-        Rijn = self.calc.el.rijn
-        erep=0.0
-        for n,rijn in enumerate(Rijn[:,i,j]): 
-            if i==j and n==0: continue
-            d = np.sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-            if d>self.rmax: continue
-            if i==j:
-                erep += 0.5*self.vrep[si+sj](d)
-            else:
-                erep += self.vrep[si+sj](d)
+        pi, pj, n, rij, dij = self.calc.el.get_pair_list(self.rmax,full=True)
+        select = (pi==i) & (pj==j)
+        V = self.vrep[self.calc.el.symbols[i]+self.calc.el.symbols[j]]
+        erep = evaluate(V,dij[select]).sum()
+        if i==j:
+            erep *= 0.5
         return erep
     
 
@@ -138,19 +133,19 @@ class Repulsion:
         F_i = sum_(j,n) V'(rijn) rijn/dijn, with rijn = r_j^n -r_i and dijn=|rijn|
         """
         self.calc.start_timing('f_rep')
-        f=np.zeros((self.N,3))
-        lst = self.calc.el.get_property_lists(['i','s'])
-        Rijn = self.calc.el.rijn
-        for i,si in lst:
-            for j,sj in lst:
-                V = self.vrep[si+sj]
-                for n,rijn in enumerate(Rijn[:,i,j]):
-                    if i==j and n==0: continue
-                    dijn = sqrt( rijn[0]**2+rijn[1]**2+rijn[2]**2 )
-                    if dijn<self.rmax:
-                        f[i,:] = f[i,:] + V(dijn,der=1)*rijn/dijn
+        erep, f, virial = self._evaluate()
         self.calc.stop_timing('f_rep')
-        return f
+        return f.copy()
+
+
+    def get_repulsive_virial(self):
+        """
+        Return the repulsive virial in atomic units.
+
+        W_ab = 1/2 sum_(i,j,n) V'(dijn) rijn_a rijn_b/dijn
+        """
+        erep, f, virial = self._evaluate()
+        return virial.copy()
 
     def get_repulsion(self, ela, elb):
         return self.vrep[ela+elb]
@@ -175,8 +170,8 @@ class RepulsivePotential:
 
     def read_repulsion(self,file):
         """ Read the repulsive potential from par-file. """
-        x, v = read_repulsion(file)
-        self.v=Function('spline', x, v, k=3)
+        x, v, tck = read_repulsion(file, tck=True)
+        self.v=Function('spline', x, v, k=3, tck=tck)
         self.r_cut=x[-1]
 
     def plot(self):
@@ -0,0 +1,81 @@
+"""
+Vectorized sums of short-range pair potentials (repulsion, pair potentials).
+"""
+
+# Copyright (C) 2008 NSC Jyvaskyla
+# Please see the accompanying LICENSE file for further information.
+
+import numpy as np
+
+
+def evaluate(v, r, der=0):
+    """
+    Return v(r,der) for an array of distances r.
+
+    Potentials are called once with the whole array; functions
+    that accept only scalars are called distance by distance.
+    """
+    if len(r)==0:
+        return np.zeros(0)
+    try:
+        y = np.asarray(v(r,der=der),float)
+        if y.shape==r.shape:
+            return y
+    except (TypeError,ValueError):
+        pass
+    return np.array([v(x,der=der) for x in r],float)
+
+
+def group_by_label(labels):
+    """
+    Return the list of (label, indices) for unique labels.
+
+    E.g. labels=[2,0,2] returns [(0,[1]),(2,[0,2])].
+    """
+    labels = np.asarray(labels)
+    if len(labels)==0:
+        return []
+    order = np.argsort(labels,kind='mergesort')
+    u, start = np.unique(labels[order],return_index=True)
+    return list(zip(u,np.split(order,start[1:])))
+
+
+def pair_sum(N, i, rij, dij, groups):
+    """
+    Return the energy, forces and virial of pair potentials.
+
+    The pairs are given as a full pair list (both (i,j,n) and the
+    reverse pair are listed), as returned by Elements.get_pair_list
+    with full=True. Each potential is evaluated once for all its pairs.
+
+    parameters:
+    ===========
+    N:          number of atoms
+    i:          first atom of each pair (npairs,)
+    rij:        rijn = R_j^n-R_i for each pair (npairs,3)
+    dij:        |rijn| (npairs,)
+    groups:     list of (indices, v), where v(r,der=0) is the potential
+                for the pairs given by indices (potentials for same
+                pairs add up)
+
+    return:
+    =======
+    e:          energy 1/2 sum_(i,j,n) V(dijn)
+    f:          forces F_i = sum_(j,n) V'(dijn) rijn/dijn  (N,3)
+    virial:     W_ab = 1/2 sum_(i,j,n) V'(dijn) rijn_a rijn_b/dijn  (3,3)
+    """
+    v = np.zeros(len(dij))
+    dv = np.zeros(len(dij))
+    for indices, function in groups:
+        if len(indices)==0:
+            continue
+        v[indices] += evaluate(function,dij[indices])
+        dv[indices] += evaluate(function,dij[indices],der=1)
+
+    e = 0.5*v.sum()
+    g = dv/dij
+    f = np.zeros((N,3))
+    for a in range(3):
+        f[:,a] = np.bincount(i,weights=g*rij[:,a],minlength=N)
+    virial = 0.5*np.dot(rij.transpose()*g,rij)
+    return e, f, virial
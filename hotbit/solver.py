@@ -3,15 +3,21 @@
 
 from scipy.linalg import eig
 from scipy.linalg import eigh
+from scipy.linalg import cholesky, solve_triangular, LinAlgError
 import numpy as np
 from numpy.linalg import solve
 from box.buildmixer import BuildMixer
 from weakref import proxy
 from random import randint
+from time import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Wrapper for the LAPACK dsygvd, zhegvd solvers
 from _hotbit import geig
 
+# energy (in Hartree) given to states not solved by the subset eigensolver
+E_UNSOLVED = 1E3
+
 class Solver:
     def __init__(self,calc):
         self.calc = proxy(calc)
@@ -21,9 +27,29 @@ class Solver:
         self.norb = self.calc.el.norb
         self.iterations = None
         self.iter_history = []
+        self.workers = calc.get('eigensolver_workers')
+        self.pool_type = calc.get('eigensolver_pool')
+        self.norm_check_interval = calc.get('norm_check_interval')
+        self.method = calc.get('eigensolver')
+        if self.method not in ['geig','cholesky']:
+            raise ValueError('Unknown eigensolver %s' %self.method)
+        self.nbands = None
+        self.buffer = calc.get('eigensolver_buffer')
+        if self.buffer is not None:
+            if self.method!='cholesky':
+                raise ValueError('Subset eigensolver (eigensolver_buffer) requires eigensolver cholesky.')
+            nocc = int(np.ceil(0.5*self.calc.el.get_number_of_electrons()))
+            self.nbands = min(nocc+self.buffer,self.norb)
+        self.chol = None
+        self.chol_S = None
+        self.pool = None
+        self.ndiag = 0
+        self.k_timings = None
+        self.k_timings_total = None
 
     def __del__(self):
-        pass
+        if self.pool is not None:
+            self.pool.shutdown()
 
     def get_nr_iterations(self):
         return self.iterations
@@ -32,16 +58,93 @@ class Solver:
         if len(self.iter_history) == 0:
             return 'Solved zero times.'
         elif len(self.iter_history) == 1:
-            return 'Solved one time; Iterations: %i' % self.iter_history[0]
-        iter_history = np.array(self.iter_history)
-        avg, mx, mn=np.mean(iter_history), np.min(iter_history), np.max(iter_history)
+            return 'Solved one time; Iterations: %i' % self.iter_history[0]['iterations']
+        iter_history = np.array([h['iterations'] for h in self.iter_history])
+        avg, mx, mn=np.mean(iter_history), np.max(iter_history), np.min(iter_history)
         return 'Solved %i times; Iterations: avg %.1f, max %i, min %i' %(len(self.iter_history),avg,mx,mn)
 
 
-    def get_eigenvalues_and_wavefunctions(self, H0, S, H1=None):
+    def get_scc_timings(self):
+        """
+        Return the total wall times (s) of SCC iterations by stage
+        ('h1', 'diagonalization', 'states', 'mixing'), summed over iter_history.
+        """
+        timings = {'h1':0.0, 'diagonalization':0.0, 'states':0.0, 'mixing':0.0}
+        for h in self.iter_history:
+            for it in h['scc']:
+                for key in timings:
+                    timings[key] += it[key]
+        return timings
+
+
+    def get_k_timings(self,total=False):
+        """
+        Return the wall times spent in the eigensolver for each k-point.
+
+        @param total: if True, return the times summed over all
+                      diagonalizations, otherwise the times of the last one.
+        """
+        if total:
+            return self.k_timings_total
+        else:
+            return self.k_timings
+
+
+    def _get_pool(self):
+        """ Return the pool of workers for k-points (created once). """
+        if self.pool is None:
+            if self.pool_type=='thread':
+                self.pool = ThreadPoolExecutor(self.workers)
+            elif self.pool_type=='process':
+                self.pool = ProcessPoolExecutor(self.workers)
+            else:
+                raise ValueError('Unknown eigensolver pool type %s' %self.pool_type)
+        return self.pool
+
+
+    def _check_now(self):
+        """ Should the eigenvector norms be checked for the next diagonalization? """
+        interval = self.norm_check_interval
+        check = interval>0 and self.ndiag%interval==0
+        self.ndiag += 1
+        return check
+
+
+    def _map(self, func, args):
+        """ Return [func(*arg) for arg in args], using the pool of workers if given. """
+        if self.workers>1 and len(args)>1:
+            pool = self._get_pool()
+            jobs = [pool.submit(func, *arg) for arg in args]
+            return [job.result() for job in jobs]
+        else:
+            return [func(*arg) for arg in args]
+
+
+    def get_cholesky_factors(self, S):
+        """
+        Return the lower-triangular Cholesky factors L(k) of S(k)=L(k)L(k)^H.
+
+        The factors are calculated once for given overlap matrices
+        and reused as long as the same S is given.
+        """
+        if self.chol_S is not S:
+            self.calc.start_timing('Cholesky factorization')
+            self.chol = self._map(cholesky_k, [(S[ik],) for ik in range(len(S))])
+            self.chol_S = S
+            self.calc.stop_timing('Cholesky factorization')
+        return self.chol
+
+
+    def get_eigenvalues_and_wavefunctions(self, H0, S, H1=None, nbands=None):
         """
         Solve the generalized eigenvalue problem for a fixed electrostatic
         potential, i.e. a single SCC iteration.
+
+        With internal 'eigensolver_workers'>1, the k-points are distributed
+        over a pool of threads or processes ('eigensolver_pool'). With
+        internal 'eigensolver'='cholesky', the Cholesky factors of S are
+        reused and only a standard eigenvalue problem is solved; then
+        optionally only the nbands lowest states are solved.
         """
         print("")
         print("Enter get_eigenvalues_and_wavefunctions:")
@@ -54,12 +157,33 @@ class Solver:
         e  = np.zeros((nk, norb))
         wf = np.zeros((nk, norb, norb), dtype=H0.dtype)
 
-        for ik in range(nk):
+        def hamiltonian(ik):
             if H1 is not None:
-                H = H0[ik] + H1*S[ik]
+                return H0[ik] + H1*S[ik]
             else:
-                H = H0[ik]
-            e[ik], wf[ik] = self.diagonalize(H, S[ik])
+                return H0[ik]
+
+        checks = [self._check_now() for ik in range(nk)]
+        if self.method=='cholesky':
+            L = self.get_cholesky_factors(S)
+        self.calc.start_timing('LAPACK eigensolver')
+        if self.method=='cholesky':
+            args = [(hamiltonian(ik), S[ik], L[ik], checks[ik], nbands) for ik in range(nk)]
+            results = self._map(solve_k_cholesky, args)
+        else:
+            args = [(hamiltonian(ik), S[ik], checks[ik]) for ik in range(nk)]
+            results = self._map(solve_k, args)
+        self.calc.stop_timing('LAPACK eigensolver')
+
+        self.k_timings = np.zeros(nk)
+        for ik, (ek, wfk, maxdev, dt) in enumerate(results):
+            if maxdev is not None:
+                self.check_norm(hamiltonian(ik), S[ik], maxdev)
+            e[ik], wf[ik] = ek, wfk
+            self.k_timings[ik] = dt
+        if self.k_timings_total is None or len(self.k_timings_total)!=nk:
+            self.k_timings_total = np.zeros(nk)
+        self.k_timings_total += self.k_timings
 
         print("")
         print("Exit get_eigenvalues_and_wavefunctions:")
@@ -69,38 +193,82 @@ class Solver:
 
 
     def get_states(self,calc,dq,H0,S):
-        """ Solve the (non)SCC generalized eigenvalue problem. """
+        """
+        Solve the (non)SCC generalized eigenvalue problem.
+
+        For SCC, the convergence of each solution is recorded in
+        iter_history as a dictionary with keys
+            'iterations':  number of iterations (as in get_nr_iterations)
+            'converged':   whether the charges converged
+            'mixer':       name of the mixer
+            'scc':         list with a dictionary for each iteration, with
+                           the maximum residual of the Mulliken charges
+                           ('residual') and the wall times (s) spent in
+                           constructing H1 ('h1'), the eigensolver
+                           ('diagonalization'), occupations and charges
+                           ('states') and mixing ('mixing')
+        """
         st = calc.st
         es = st.es
         mixer = self.mixer
         mixer.reset()
         H1 = None
+        history = {'iterations':None, 'converged':False, 'mixer':mixer.get('name'), 'scc':[]}
         #from box.convergence_plotter import ConvergencePlotter
         #convergence_plotter = ConvergencePlotter(self.calc)
         #convergence_plotter.draw(dq)
         for i in range(self.maxiter):
+            t0 = time()
             # diagonalize for all k-points at once
             if self.SCC:
                 H1 = es.construct_h1(dq)
-            e, wf = self.get_eigenvalues_and_wavefunctions(H0, S, H1=H1)
-            st.update(e,wf)
+                if i==0 and hasattr(mixer,'set_gamma'):
+                    # metric for the preconditioner, now for this geometry
+                    try:
+                        mixer.set_gamma(es.get_gamma())
+                    except NotImplementedError:
+                        mixer.set_gamma(es.G)
+            t1 = time()
+            # intermediate SCC iterations may solve only the lowest states
+            nbands = self.nbands if self.SCC else None
+            while True:
+                e, wf = self.get_eigenvalues_and_wavefunctions(H0, S, H1=H1, nbands=nbands)
+                t2 = time()
+                st.update(e,wf)
+                if not self.unsolved_occupied(st,nbands):
+                    break
+                # highest solved band is occupied, enlarge the buffer
+                self.buffer = max(2*self.buffer,1)
+                nbands = self.nbands = min(nbands+self.buffer,self.norb)
 
             # If we don't do SCC, stop here
             if not self.SCC:
                 break
 
             dq_out=st.get_dq()
+            t3 = time()
             done,dq=mixer(dq,dq_out)
+            t4 = time()
+            history['scc'].append( {'residual':mixer.fmax[-1], 'h1':t1-t0,
+                    'diagonalization':t2-t1, 'states':t3-t2, 'mixing':t4-t3} )
             #convergence_plotter.draw(dq)
             if i%10 == 0:
                 self.calc.get_output().flush()
             if self.calc.get('verbose_SCC'):
                 mixer.echo(self.calc.get_output())
             if done:
+                if nbands is not None and nbands<self.norb:
+                    # converged; solve all the states for the final H1
+                    e, wf = self.get_eigenvalues_and_wavefunctions(H0, S, H1=H1)
+                    st.update(e,wf)
                 self.iterations=i
-                self.iter_history.append(i)
+                history['iterations'] = i
+                history['converged'] = True
+                self.iter_history.append(history)
                 break
             if i==self.maxiter-1:
+                history['iterations'] = i
+                self.iter_history.append(history)
                 mixer.out_of_iterations(self.calc.get_output())
                 #if self.calc.get('verbose_SCC'):
                 #    convergence_plotter.show()
@@ -110,33 +278,25 @@ class Solver:
         return st.e,st.wf
 
 
+    def unsolved_occupied(self,st,nbands):
+        """
+        Return True if the highest of the nbands solved states has
+        occupation above tol_occupation at any k-point.
+        """
+        if nbands is None or nbands>=self.norb:
+            return False
+        return st.f[:,nbands-1].max()>self.calc.get('tol_occupation')
+
+
     def diagonalize(self,H,S):
         """ Solve the eigenstates. """
         if True:
             # via C wrapper
             self.calc.start_timing('LAPACK eigensolver')
-            e, wf = geig(H,S)
+            e, wf, maxdev, dt = solve_k(H,S,self._check_now())
             self.calc.stop_timing('LAPACK eigensolver')
-            wf = wf.transpose()
-
-            # if S happened not to be positive definite, LAPACK
-            # results in wrong norm.
-            self.calc.start_timing('Check norm (remove?)')
-            norms = ( np.dot(wf.conj(),S)*wf ).sum(axis=1)
-            maxdev = np.abs(norms-1).max()
-            if maxdev>self.calc.get('tol_eigenvector_norm'):
-                eval,efunc = eigh(S)
-                evmin =  eval.min()
-                if evmin<0:
-                    raise AssertionError('Eigenfunction norm deviations from LAPACK %.8f. Minimum eigenvalue of S is %.4f - overlap matrix is not positive definite.' %(maxdev,evmin))
-                else:
-                    print('diag(H)=',H.diagonal())
-                    #print 'H=',H
-                    print('diag(S)=',S.diagonal())
-                    #print 'S=',S
-                    raise AssertionError('LAPACK: Eigenfunctions norm deviates from one by %.8f, but overlap matrix is still positive definite?' %(maxdev))
-            self.calc.stop_timing('Check norm (remove?)')
-
+            if maxdev is not None:
+                self.check_norm(H,S,maxdev)
 
         if False:
             #raise NotImplementedError('Not checked for complex stuff')
@@ -152,6 +312,88 @@ class Solver:
 
         return e,wf
 
+
+    def check_norm(self,H,S,maxdev):
+        """
+        Raise error if the eigenvector norms deviate too much from one.
+
+        If S happened not to be positive definite, LAPACK results in wrong norm.
+        """
+        if maxdev>self.calc.get('tol_eigenvector_norm'):
+            eval,efunc = eigh(S)
+            evmin =  eval.min()
+            if evmin<0:
+                raise AssertionError('Eigenfunction norm deviations from LAPACK %.8f. Minimum eigenvalue of S is %.4f - overlap matrix is not positive definite.' %(maxdev,evmin))
+            else:
+                print('diag(H)=',H.diagonal())
+                #print 'H=',H
+                print('diag(S)=',S.diagonal())
+                #print 'S=',S
+                raise AssertionError('LAPACK: Eigenfunctions norm deviates from one by %.8f, but overlap matrix is still positive definite?' %(maxdev))
+
+###
+
+def solve_k(H,S,check=True):
+    """
+    Solve the generalized eigenvalue problem for a single k-point.
+
+    Module-level function, such that it can be run in a pool of workers;
+    LAPACK releases the GIL, so threads run in parallel.
+
+    @param check: calculate the maximum deviation of eigenvector norms from one
+    @return: eigenvalues, eigenvectors (as rows), maximum norm deviation
+             (None if not checked), wall time
+    """
+    t0 = time()
+    e, wf = geig(H,S)
+    wf = wf.transpose()
+    maxdev = None
+    if check:
+        norms = ( np.dot(wf.conj(),S)*wf ).sum(axis=1)
+        maxdev = np.abs(norms-1).max()
+    return e, wf, maxdev, time()-t0
+
+
+def cholesky_k(S):
+    """ Return the lower-triangular Cholesky factor of S for a single k-point. """
+    try:
+        return cholesky(S,lower=True)
+    except LinAlgError:
+        raise AssertionError('Cholesky factorization failed - overlap matrix is not positive definite.')
+
+
+def solve_k_cholesky(H,S,L,check=True,nbands=None):
+    """
+    Solve the generalized eigenvalue problem for a single k-point,
+    given the Cholesky factor L of S=LL^H.
+
+    The problem is reduced to the standard eigenvalue problem of
+    L^-1 H L^-H. If nbands is given, only the nbands lowest states are
+    solved; the rest get energy E_UNSOLVED and zero eigenvectors.
+
+    @return: as in solve_k
+    """
+    t0 = time()
+    n = len(H)
+    A = solve_triangular(L,H,lower=True)
+    A = solve_triangular(L,A.conj().transpose(),lower=True).conj().transpose()
+    A = 0.5*(A+A.conj().transpose())
+    if nbands is None or nbands>=n:
+        e, y = eigh(A)
+    else:
+        e0, y = eigh(A,subset_by_index=[0,nbands-1])
+        e = np.zeros(n) + E_UNSOLVED
+        e[:nbands] = e0
+    x = solve_triangular(L,y,lower=True,trans='C')
+    wf = np.zeros((n,n),dtype=x.dtype)
+    wf[:x.shape[1]] = x.transpose()
+    maxdev = None
+    if check:
+        x = wf[:x.shape[1]]
+        norms = ( np.dot(x.conj(),S)*x ).sum(axis=1)
+        maxdev = np.abs(norms-1).max()
+    return e, wf, maxdev, time()-t0
+
 ###
 
 def get_HS_shape(H, S):
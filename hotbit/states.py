@@ -13,6 +13,29 @@ from box.mix import divisors
 
 pi = np.pi
 
+# Coefficients (kappa, alpha, c_0...c_K) of the dissipative extended Lagrangian
+# propagation of the charges, A.M.N. Niklasson, P. Steneteg, A. Odell, N. Bock,
+# M. Challacombe, C.J. Tymczak, E. Holmstrom, G. Zheng and V. Weber,
+# J. Chem. Phys. 130, 214109 (2009).
+XLBOMD_COEFFICIENTS = {
+    3: (1.69, 0.150, [-2, 3, 0, -1]),
+    4: (1.75, 0.057, [-3, 6, -2, -2, 1]),
+    5: (1.82, 0.018, [-6, 14, -8, -3, 4, -1]),
+    6: (1.84, 0.0055, [-14, 36, -27, -2, 12, -6, 1]),
+    7: (1.86, 0.0016, [-36, 99, -88, 11, 32, -25, 8, -1])
+    }
+
+
+def aspc_coefficients(k):
+    """
+    Return the coefficients B_j (j=0...k+1) of the always stable
+    predictor-corrector (ASPC) extrapolation of order k,
+    q(n+1) = sum_j B_j q(n-j); J. Kolafa, J. Comput. Chem. 25, 335 (2004).
+    """
+    from scipy.special import comb
+    return np.array([ (-1)**(j+1)*j*comb(2*k+4,k+2-j)/comb(2*k+2,k+1)
+                      for j in range(1,k+3) ])
+
 
 #
 # Constructing the density matrix, and the energy
@@ -20,24 +43,23 @@ pi = np.pi
 # and occupations.
 #
 
-def compute_rho(wf, occ):
-    nk, n, m = wf.shape
-    nk2, k = occ.shape
+def compute_rho(wf, occ, tol=0.0):
+    """
+    Return the density matrices rho[k] = wf[k]^T f[k] wf[k]^*.
 
-    assert n == m
-    assert n == k
-    assert nk == nk2
-  
-    rho = np.zeros(wf.shape, dtype=wf.dtype)
-    for k in range(nk):
-        rho[k,:,:] = np.dot(
-            wf[k,:,:].transpose(),
-            occ[k,:].reshape(n,-1) * wf[k,:,:].conj()
-            )
-    return rho
+    States with occupation below tol in all k-points are left out.
+    """
+    return compute_rhoe(wf, occ, None, tol)
 
 
-def compute_rhoe(wf, occ, e):
+def compute_rhoe(wf, occ, e, tol=0.0):
+    """
+    Return the energy-weighted density matrices rhoe[k] = wf[k]^T e[k]f[k] wf[k]^*.
+
+    If e is None, return the density matrices. States with occupation
+    below tol in all k-points are left out (occupations may be negative
+    with Methfessel-Paxton smearing).
+    """
     nk, n, m = wf.shape
     nk2, k = occ.shape
 
@@ -45,13 +67,12 @@ def compute_rhoe(wf, occ, e):
     assert n == k
     assert nk == nk2
 
-    rhoe = np.zeros(wf.shape, dtype=wf.dtype)
-    for k in range(nk):
-        rhoe[k,:,:] = np.dot(
-            wf[k,:,:].transpose(),
-            e[k,:].reshape(n,-1)*occ[k,:].reshape(n,-1) * wf[k,:,:].conj()
-            )
-    return rhoe
+    occupied = np.flatnonzero( np.any(np.abs(occ)>tol, axis=0) )
+    w = occ[:,occupied]
+    if e is not None:
+        w = w*e[:,occupied]
+    wfo = wf[:,occupied,:]
+    return np.matmul( wfo.transpose((0,2,1)), w[:,:,None]*wfo.conj() )
 
 
 #
@@ -68,12 +89,14 @@ class States:
         self.calc = proxy(calc)
         self.nat = len(calc.el)
         self.norb = calc.el.get_nr_orbitals()
-        self.prev_dq = [None,None]
+        self.prev_dq = []
+        self.aux_dq = []
         self.count = 0
         self.first_solve = True
         self.SCC = calc.get('SCC')
         self.rho = None
         self.rhoe0 = None
+        self.H1 = None
         self.nk = None
         
        
@@ -177,6 +200,19 @@ class States:
         
 
     def guess_dq(self):
+        """
+        Return the initial guess of the charges for the SCC cycle.
+
+        The charges of previous solutions are extrapolated, according to
+        internal 'dq_extrapolation':
+            'linear':  linear extrapolation of the last two
+            'aspc':    always stable predictor of order 'dq_extrapolation_order'
+            'xlbomd':  propagation of auxiliary charges as in extended
+                       Lagrangian Born-Oppenheimer MD, with dissipation
+                       of order 'dq_extrapolation_order' (3...7)
+        The higher order schemes assume subsequent solutions to be
+        equally spaced steps of a trajectory, as in MD.
+        """
         n=len(self.calc.el)
         if not self.SCC:
             return np.zeros((n,))
@@ -184,8 +220,28 @@ class States:
             return np.zeros((n,)) - float(self.calc.get('charge'))/n
         elif self.count==1:    # use previous charges
             return self.prev_dq[0]
-        else:                  # linear extrapolation
+
+        method = self.calc.get('dq_extrapolation')
+        order = self.calc.get('dq_extrapolation_order')
+        if method=='aspc':
+            k = min(order,len(self.prev_dq)-2)
+            B = aspc_coefficients(k)
+            return np.dot(B,self.prev_dq[:k+2])
+        elif method=='xlbomd':
+            kappa, alpha, c = XLBOMD_COEFFICIENTS[order]
+            if len(self.aux_dq)<len(c):
+                # not enough history yet, start with linear extrapolation
+                aux = self.prev_dq[0] + (self.prev_dq[0]-self.prev_dq[1])
+            else:
+                aux = 2*self.aux_dq[0] - self.aux_dq[1] + \
+                      kappa*(self.prev_dq[0]-self.aux_dq[0]) + \
+                      alpha*np.dot(c,self.aux_dq[:len(c)])
+            self.aux_dq = [aux] + self.aux_dq[:len(c)-1]
+            return aux
+        elif method=='linear':
             return self.prev_dq[0] + (self.prev_dq[0]-self.prev_dq[1])
+        else:
+            raise ValueError('Unknown dq_extrapolation %s' %method)
 
 
     def solve(self):
@@ -193,7 +249,8 @@ class States:
             physical = self.calc.get('physical_k')
             self.nk, self.k, self.kl, self.wk = self.setup_k_sampling( self.calc.get('kpts'),physical=physical,rs=self.calc.get('rs') )
             width=self.calc.get('width')
-            self.occu = Occupations(self.calc.el.get_number_of_electrons(),width,self.wk)
+            self.occu = Occupations(self.calc.el.get_number_of_electrons(),width,self.wk,
+                                    smearing=self.calc.get('smearing'),order=self.calc.get('smearing_order'))
         self.calc.start_timing('solve')
         
         # TODO: enable fixed dq-calculations in SCC (for band-structures)
@@ -201,7 +258,7 @@ class States:
         if self.first_solve:
             self.calc.memory_estimate()
             self.first_solve = False
-        self.H0, self.S, self.dH0, self.dS = self.calc.ia.get_matrices()
+        self.H0, self.S, dH0, dS = self.calc.ia.get_matrices()
 
         if self.SCC:
             self.es.construct_Gamma_matrix(self.calc.el.atoms)
@@ -237,7 +294,7 @@ class States:
         self.wf=wf
         self.f=self.occu.occupy(e)
         self.calc.start_timing('rho')
-        self.rho = compute_rho(self.wf,self.f)
+        self.rho = compute_rho(self.wf,self.f,self.calc.get('tol_occupation'))
                 
         self.calc.stop_timing('rho')
         if self.SCC:
@@ -250,21 +307,40 @@ class States:
         """ Update stuff from eigenstates needed later for forces etc. """
         self.calc.start_timing('final update')
         self.Swf = None
-        self.dH = np.zeros_like(self.dH0)
         if self.SCC:
-            self.prev_dq=[self.dq, self.prev_dq[0]]
-            # TODO: do k-sum with numpy
-            for ik in range(self.nk):
-                for a in range(3):
-                    self.dH[ik,:,:,a] = self.dH0[ik,:,:,a] + self.es.get_h1()*self.dS[ik,:,:,a]
+            # history for extrapolating the charges (see guess_dq)
+            self.prev_dq=[self.dq] + self.prev_dq[:9]
+            self.H1 = self.es.get_h1()
         else:
-            self.dH = self.dH0
+            self.H1 = None
 
         # density matrix weighted by eigenenergies
-        self.rhoe = compute_rhoe(self.wf,self.f,self.e)
+        self.rhoe = compute_rhoe(self.wf,self.f,self.e,self.calc.get('tol_occupation'))
         self.calc.stop_timing('final update')
 
 
+    def get_dH(self):
+        """
+        Return dH[k,i,j,a] = dH0[k,i,j,a] + H1[i,j]*dS[k,i,j,a].
+
+        The forces do not need this (calculated from the blocks).
+        """
+        dH0, dS = self.calc.ia.get_dense_derivatives()
+        if self.H1 is None:
+            return dH0
+        else:
+            return dH0 + self.H1[None,:,:,None]*dS
+
+    # dense derivatives are constructed only on demand
+    dH0 = property(lambda self: self.calc.ia.get_dense_derivatives()[0])
+    dS = property(lambda self: self.calc.ia.get_dense_derivatives()[1])
+
+
+    def _sum_over_orbitals(self, x):
+        """ Sum the orbital contributions x[i,...] atom-wise. """
+        return np.add.reduceat(x, self.calc.el.first_orbitals, axis=0)
+
+
     def get_dq(self):
         return self.dq.copy()
 
@@ -320,13 +396,8 @@ class States:
                where diag(k)_i = Re [sum_j rho(k)_ij * S(k)^T_ij] 
                and diag_i = sum_k w_k diag(k)_i 
         '''
-        diag = np.zeros((self.norb))
-        for ik in range(self.nk):
-            diag_k = ( self.rho[ik]*self.S[ik].transpose() ).sum(axis=1).real            
-            diag = diag + self.wk[ik] * diag_k
-        q=[]
-        for o1, no in self.calc.el.get_property_lists(['o1','no']):
-            q.append( diag[o1:o1+no].sum() )
+        diag = np.einsum('k,kij,kji->i', self.wk, self.rho, self.S).real
+        q = self._sum_over_orbitals(diag)
             
         dq = np.array(q)-self.calc.el.get_valences()
         q,c = sum(-dq),self.calc.get('charge') 
@@ -340,13 +411,9 @@ class States:
         Return band structure energy.
         
         ebs = sum_k w_k ( sum_ij rho_ij * H0_ji )
-            = sum_k w_k ( sum_i [sum_j rho_ij * H0^T_ij] )
         '''
         self.calc.start_timing('e_bs')
-        ebs = 0.0
-        for ik in range(self.nk):
-            diagonal = ( self.rho[ik]*self.H0[ik].transpose() ).sum(axis=1)
-            ebs += self.wk[ik] * diagonal.sum()
+        ebs = np.dot( self.wk, np.einsum('kij,kji->k',self.rho,self.H0) )
         assert ebs.imag<self.calc.get('tol_imaginary_e')
         self.calc.stop_timing('e_bs')
         return ebs.real 
@@ -362,20 +429,30 @@ class States:
                 where diag_i(k) = [dH(k)*rho(k) - dS(k)*rhoe(k)]_ii
                                 = sum_j [dH(k)_ij*rho(k)_ji - dS(k)_ij*rhoe(k)_ji]
                                 = sum_j [dH(k)_ij*rho(k)^T_ij - dS(k)_ij*rhoe(k)^T_ij]
+
+        The derivatives dH(k) and dS(k) are not constructed; the sums are
+        accumulated directly from the atom pair blocks.
         '''
         self.calc.start_timing('f_bs')       
-        diag = np.zeros((self.norb,3),complex)
-        
-        for a in range(3):
-            for ik in range(self.nk):
-                diag_k = ( self.dH[ik,:,:,a]*self.rho[ik].transpose()  \
-                         - self.dS[ik,:,:,a]*self.rhoe[ik].transpose() ).sum(axis=1)
-                diag[:,a] = diag[:,a] - self.wk[ik] * diag_k
-            
-        f=[]            
-        for o1, no in self.calc.el.get_property_lists(['o1','no']):
-            f.append( 2*diag[o1:o1+no,:].sum(axis=0).real )
-            
+        ia = self.calc.ia
+        blocks = ia.get_blocks(derivatives=True)
+        f = blocks.get_forces(ia.get_phases(), self.calc.el.Rot, self.wk,
+                              self.rho, self.rhoe, self.H1)
         self.calc.stop_timing('f_bs')
         return f
 
+
+    def get_band_structure_virial(self):
+        '''
+        Return the band structure virial (in atomic units).
+
+        W_ab = sum_(i,j,n) rijn_a dE/drijn_b, accumulated from the same
+        atom pair blocks as the band structure forces.
+        '''
+        self.calc.start_timing('virial_bs')
+        ia = self.calc.ia
+        blocks = ia.get_blocks(derivatives=True)
+        W = blocks.get_virial(ia.get_phases(), self.calc.el.Rot, self.wk,
+                              self.rho, self.rhoe, self.H1)
+        self.calc.stop_timing('virial_bs')
+        return W
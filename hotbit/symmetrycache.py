@@ -0,0 +1,94 @@
+"""
+Cache for quantities that depend only on the symmetry operations.
+"""
+
+# Copyright (C) 2008 NSC Jyvaskyla
+# Please see the accompanying LICENSE file for further information.
+
+import numpy as np
+
+
+def symmetry_key(atoms):
+    """
+    Return a key for the cell and the container parameters of hotbit atoms.
+
+    The key changes whenever the symmetry operations may change.
+    """
+    c = atoms.container
+    par = []
+    for key in sorted(c.__dict__):
+        value = c.__dict__[key]
+        if key=='atoms' or not isinstance(value,(int,float,str,np.ndarray,tuple,list)):
+            continue
+        par.append( (key,repr(np.asarray(value).tolist())) )
+    return ( c.type, atoms.get_cell().tobytes(),
+             tuple(atoms.get_pbc()), tuple(par) )
+
+
+def get_phases(ntuples, ks):
+    """
+    Return phases[n,k] = exp(i n.k) for symmetry operations n and k-points k.
+    """
+    ntuples = np.asarray(ntuples,float).reshape(-1,3)
+    ks = np.asarray(ks,float).reshape(-1,3)
+    return np.exp( 1j*np.dot(ntuples,ks.transpose()) )
+
+
+
+class SymmetryCache:
+    def __init__(self):
+        """
+        Cache for quantities of symmetry operations, shared by Elements
+        and Interactions.
+
+        The quantities (affine transformations, rotations, orbital
+        transformations, phases) are stored in tables by symmetry operation
+        (or other item), and they are kept as long as the key given
+        to update (see symmetry_key) remains the same.
+        """
+        self.key = None
+        self.clear()
+
+
+    def clear(self):
+        """ Empty all tables. """
+        self.tables = {}
+
+
+    def update(self, key):
+        """ Clear the cache if the key (cell and container parameters) has changed. """
+        if key!=self.key:
+            self.clear()
+            self.key = key
+
+
+    def get(self, table, item, function):
+        """
+        Return the cached value of given item in given table.
+
+        parameters:
+        ===========
+        table:     name of the table, e.g. 'rotation'
+        item:      hashable item, e.g. symmetry operation 3-tuple
+        function:  function (no arguments) to calculate the value if not cached
+        """
+        tab = self.tables.setdefault(table,{})
+        if item not in tab:
+            tab[item] = function()
+        return tab[item]
+
+
+    def get_phases(self, ntuples, ks):
+        """
+        Return phases[n,k] for given symmetry operations and k-points.
+
+        Only the latest phases are kept, since the symmetry operations
+        in use change with the geometry and the k-points between
+        calculations (e.g. band structures).
+        """
+        ks = np.asarray(ks,float)
+        item = ( tuple([tuple(nt) for nt in ntuples]), ks.tobytes() )
+        latest = self.tables.get('phases')
+        if latest is None or latest[0]!=item:
+            self.tables['phases'] = ( item, get_phases(ntuples,ks) )
+        return self.tables['phases'][1]
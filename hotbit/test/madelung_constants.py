@@ -9,7 +9,7 @@ from ase.io import write
 from ase.lattice.compounds import CsCl, NaCl, ZnS
 
 from hotbit.atoms import Atoms as HotbitAtoms
-from hotbit.coulomb import EwaldSum, MultipoleExpansion
+from hotbit.coulomb import EwaldSum, MultipoleExpansion, ParticleMeshEwald
 
 ###
 
@@ -59,7 +59,8 @@ systems = [
 solvers = [
     MultipoleExpansion(L_MAX, 3, K),
 #    MultipoleExpansion(L_MAX, 4, K),
-    EwaldSum(12, 0.001)
+    EwaldSum(12, 0.001),
+    ParticleMeshEwald(3*a0, 10)
 ]
 
 if debug:
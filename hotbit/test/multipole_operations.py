@@ -13,8 +13,9 @@ import numpy as np
 import ase
 
 from hotbit.coulomb.multipole import zero_moments, get_moments
+from hotbit.coulomb.multipole import get_solid_harmonics, local_to_atoms
 
-from _hotbit import multipole_to_multipole, multipole_to_local, local_to_local, transform_multipole
+from _hotbit import solid_harmonic_R, multipole_to_multipole, multipole_to_local, local_to_local, transform_multipole
 
 ###
 
@@ -49,6 +50,8 @@ TOL_MOM   = 1e-6
 TOL_PHI   = 1e-4
 TOL_PHI2  = 1e-4
 TOL_ROT   = 1e-9
+TOL_HARM  = 1e-12
+TOL_L2A   = 1e-12
 
 debug  = False
 
@@ -73,6 +76,13 @@ for run in range(NRUNS):
     for i in range(8):
         M += [ get_moments(a[i].get_positions(), a[i].get_initial_charges(), L_MAX, r0) ]
 
+    # The harmonics of all atoms at once agree with those atom by atom
+    R0_al, R_aL = get_solid_harmonics(a[0].get_positions(), L_MAX, r0)
+    for r, R0_l, R_L in zip(a[0].get_positions(), R0_al, R_aL):
+        cR0_l, cR_L = solid_harmonic_R(r-r0, L_MAX)
+        assert np.all(np.abs(R0_l-cR0_l) < TOL_HARM*(1+np.abs(cR0_l)))
+        assert np.all(np.abs(R_L-cR_L) < TOL_HARM*(1+np.abs(cR_L)))
+
     # Construct a composite atoms object
     # and compute the corresponding multipole
     # expansion
@@ -157,6 +167,19 @@ for run in range(NRUNS):
     assert err_phi3 < TOL_PHI2
     assert err_phi4 < TOL_PHI2
 
+    # Evaluation of the expansion at many points at once agrees with
+    # local_to_local to l = 1 point by point
+    r_av = r0tar + (2*np.random.random([NAT,3])-1)*SX
+    R0_al, R_aL = get_solid_harmonics(r_av, L_MAX, r0tar)
+    phi_a, E_av = local_to_atoms(L0_l, L_L, R0_al, R_aL)
+    for r, phi, E in zip(r_av, phi_a, E_av):
+        loc0_l, loc_L = local_to_local(r - r0tar, L_MAX, L0_l, L_L, 1)
+        scale = abs(loc0_l[0]) + np.max(np.abs(loc_L)) + np.max(np.abs(loc0_l))
+        assert abs(phi - loc0_l[0]) < TOL_L2A*scale
+        assert np.max(np.abs(E - np.array([ -loc_L[0].real,
+                                            -loc_L[0].imag,
+                                             loc0_l[1] ]))) < TOL_L2A*scale
+
     # Compute the multipole moment directly
     Md0_l, Md_L = get_moments(b.get_positions(), b.get_initial_charges(), L_MAX, r0c)
 
@@ -0,0 +1,59 @@
+#
+# Test the cell-list neighbor search against a brute force scan of all
+# periodic images, and the Verlet-skin reuse of the neighbor list.
+#
+
+import numpy as np
+from ase.build import bulk
+
+from hotbit import Atoms
+from hotbit.neighbors import get_neighbors, NeighborList
+
+###
+
+CUTOFF  = 5.0
+SKIN    = 0.6
+NCELL   = 2
+TOL     = 1e-12
+
+###
+
+def brute_force(a, cutoff):
+    r = a.get_positions()
+    pairs = [ ]
+    for n1 in range(-NCELL, NCELL+1):
+        for n2 in range(-NCELL, NCELL+1):
+            for n3 in range(-NCELL, NCELL+1):
+                for i in range(len(a)):
+                    for j in range(len(a)):
+                        if i==j and n1==n2==n3==0:
+                            continue
+                        rj = a.transform(r[j], [n1,n2,n3])
+                        d = np.linalg.norm(r[i]-rj)
+                        if d<cutoff:
+                            pairs.append( (i,j,d) )
+    return sorted(pairs)
+
+np.random.seed(1)
+b = bulk('C', 'diamond', a=3.57, cubic=True)
+b.rattle(0.05)
+a = Atoms(b, container='Bravais')
+a.set_pbc(True)
+
+i, j, d, n = get_neighbors(a, CUTOFF)
+ref = brute_force(a, CUTOFF)
+assert len(ref)==len(i)
+for (i0,j0,d0), (i1,j1,d1) in zip(ref, sorted(zip(i,j,d))):
+    assert i0==i1 and j0==j1 and abs(d0-d1)<TOL
+
+# normal vectors point from neighbor to the primary atom
+assert np.all( np.abs(np.sum(n*n,axis=1)-1)<TOL )
+
+nl = NeighborList(CUTOFF, skin=SKIN)
+for step in range(5):
+    a.set_positions( a.get_positions()+np.random.normal(size=(len(a),3))*0.02 )
+    i0, j0, d0, n0 = get_neighbors(a, CUTOFF)
+    i1, j1, d1, n1 = nl.get_neighbors(a)
+    assert np.all(i0==i1) and np.all(j0==j1)
+    assert np.all(np.abs(d0-d1)<TOL) and np.all(np.abs(n0-n1)<TOL)
+assert nl.nbuilds==1
@@ -0,0 +1,100 @@
+#
+# Compile a small parameter directory (.elm, .par and .skf files) into
+# a bundle, and check that the bundle gives the same data as the text
+# files: element data and functions, Slater-Koster tables with their
+# spline second derivatives, repulsions with their B-splines, and the
+# Hotbit energy.
+#
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.interpolate import splrep
+
+from ase import Atoms
+from hotbit import Hotbit, hbpar
+from hotbit.io import read_element, read_HS, read_repulsion
+from hotbit.io.bundle import compile_bundle
+from box.interpolation import natural_spline_second_derivatives
+
+###
+
+files   = [ 'C.elm', 'H.elm', 'C_C.par', 'C_H.par', 'H_H.par', 'MoS-skf/SS.skf' ]
+
+debug   = False
+
+###
+
+def assert_same(a, b):
+    """ Assert that (nested) data a and b are identical. """
+    if isinstance(a, dict):
+        assert sorted(a.keys()) == sorted(b.keys())
+        for key in a:
+            assert_same(a[key], b[key])
+    elif isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        assert np.array_equal(a, b)
+    elif a is None:
+        assert b is None
+    elif hasattr(a, 'f'):
+        # Function
+        assert_same(a.f.x, b.f.x)
+        assert_same(a.f.y, b.f.y)
+        for x, y in zip(a.f.tck, b.f.tck):
+            assert_same(x, y)
+    else:
+        assert a == b
+
+
+tmp = tempfile.mkdtemp()
+try:
+    src = os.path.join(tmp, 'param')
+    os.mkdir(src)
+    for fn in files:
+        shutil.copy(os.path.join(hbpar, fn), src)
+    bundle = compile_bundle(src, os.path.join(tmp, 'param.hbb'))
+
+    for fn, symbol in [ ('C.elm', 'C'), ('H.elm', 'H'), ('SS.skf', 'S') ]:
+        data, functions = read_element(os.path.join(src, fn), symbol)
+        bdata, bfunctions = read_element(bundle+'/'+fn, symbol)
+        if debug:
+            print(fn, sorted(bdata.keys()))
+        assert_same(data, bdata)
+        assert_same(functions, bfunctions)
+
+    for fn, si, sj in [ ('C_C.par', 'C', 'C'), ('C_H.par', 'C', 'H'),
+                        ('C_H.par', 'H', 'C'), ('H_H.par', 'H', 'H'),
+                        ('SS.skf', 'S', 'S') ]:
+        x, table = read_HS(os.path.join(src, fn), si, sj)
+        bx, btable, d2 = read_HS(bundle+'/'+fn, si, sj, derivatives=True)
+        assert_same(x, bx)
+        assert_same(table, btable)
+        assert_same(natural_spline_second_derivatives(x, table), d2)
+
+    for fn in [ 'C_C.par', 'C_H.par', 'H_H.par', 'SS.skf' ]:
+        x, v = read_repulsion(os.path.join(src, fn))
+        bx, bv, tck = read_repulsion(bundle+'/'+fn, tck=True)
+        assert_same(x, bx)
+        assert_same(v, bv)
+        for a, b in zip(splrep(x, v, s=0, k=3), tck):
+            assert_same(a, b)
+
+    # the same calculation with the text files and with the bundle
+    e = [ ]
+    hbp = os.environ.get('HOTBIT_PARAMETERS')
+    try:
+        for parameters in [ src, bundle ]:
+            os.environ['HOTBIT_PARAMETERS'] = parameters
+            atoms = Atoms('CH4', [ (0, 0, 0), (0.63, 0.63, 0.63), (-0.63, -0.63, 0.63),
+                                   (-0.63, 0.63, -0.63), (0.63, -0.63, -0.7) ])
+            atoms.center(vacuum=5)
+            atoms.set_calculator(Hotbit(SCC=True, txt='-'))
+            e += [ atoms.get_potential_energy() ]
+    finally:
+        os.environ['HOTBIT_PARAMETERS'] = hbp
+    if debug:
+        print(e)
+    assert e[0] == e[1]
+finally:
+    shutil.rmtree(tmp)
@@ -0,0 +1,99 @@
+#
+# Test the indexed parameter file reader against box.mix.find_value,
+# for all keys of real parameter files and a file with comment lines
+# in the data blocks, all formats, and missing keys with and without
+# a default.
+#
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from box import mix
+from hotbit import hbpar
+from hotbit.io import native
+from hotbit.io.native import ParameterFile, get_parameter_file
+
+###
+
+files   = [ 'C.elm', 'H.elm', 'Au.elm', 'C_H.par', 'Au_Au.par' ]
+fmts    = [ 'default', 'all', 'onestr', 'strings', 'matrix', 'test', 'bool' ]
+
+debug   = False
+
+###
+
+test_file = """\
+symbol = X
+flag=yes
+other_flag = False
+comment=
+# comment at the start of the data set
+first line
+# comment within the data set
+second line
+
+two words = one two
+
+table=
+
+# comment before the data
+0.0  1.0
+# comment within the data
+1.0  2.0
+2.0  3.0
+
+table= repeated key, the first one counts
+5.0  6.0
+"""
+
+
+def result(f, *args, **kwargs):
+    """ Return the value found by f, or the type of the error raised. """
+    try:
+        return f(*args, **kwargs)
+    except Exception as e:
+        return type(e)
+
+
+def assert_same(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        assert np.array_equal(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    else:
+        assert a == b
+
+
+tmp = tempfile.mkdtemp()
+try:
+    names = [ ]
+    for fn in files:
+        shutil.copy(os.path.join(hbpar, fn), tmp)
+        names += [ os.path.join(tmp, fn) ]
+    names += [ os.path.join(tmp, 'test.elm') ]
+    f = open(names[-1], 'w')
+    f.write(test_file)
+    f.close()
+
+    for name in names:
+        pf = ParameterFile(name)
+        assert get_parameter_file(name) is get_parameter_file(name)
+        for key in list(pf.keys) + [ 'missing' ]:
+            for fmt in fmts:
+                for default in [ None, 'default' ]:
+                    ref = result(mix.find_value, name, key, fmt=fmt, default=default)
+                    value = result(pf.find_value, key, fmt=fmt, default=default)
+                    if debug:
+                        print(os.path.basename(name), key, fmt, default, repr(value)[:40])
+                    assert_same(ref, value)
+
+    # a modified file replaces its parsed version in the cache
+    n = len(native._files)
+    f = open(names[-1], 'w')
+    f.write(test_file.replace('symbol = X', 'symbol = Y  ')+'\n')
+    f.close()
+    assert get_parameter_file(names[-1]).find_value('symbol') == 'Y'
+    assert len(native._files) == n
+finally:
+    shutil.rmtree(tmp)
@@ -0,0 +1,139 @@
+#
+# Test the batched Slater-Koster transformations against independent
+# references: hand-known blocks along the coordinate axes, and the
+# Slater-Koster table (Phys. Rev. 94, 1498 (1954)) written out for all
+# orbital pairs. The derivatives are compared with finite differences
+# of the table.
+#
+
+import numpy as np
+
+from hotbit.interactions import slako_transformations, slako_transformations_batch, integrals
+
+###
+
+NPAIRS  = 10
+DX      = 1e-6
+TOL     = 1e-10
+TOL_FD  = 1e-6
+
+debug   = False
+
+###
+
+s3 = np.sqrt(3.0)
+
+def sk_table(l,m,n):
+    """
+    Return the Slater-Koster table {(a,b):{integral:coefficient}} for
+    orbitals s,px,py,pz,dxy,dyz,dzx,dx2-y2,d3z2-r2 (a<=b).
+    """
+    ll, mm, nn = l*l, m*m, n*n
+    c = nn-0.5*(ll+mm)
+    t = {}
+    t[0,0] = {'sss':1}
+    t[0,1] = {'sps':l}
+    t[0,2] = {'sps':m}
+    t[0,3] = {'sps':n}
+    t[0,4] = {'sds':s3*l*m}
+    t[0,5] = {'sds':s3*m*n}
+    t[0,6] = {'sds':s3*n*l}
+    t[0,7] = {'sds':0.5*s3*(ll-mm)}
+    t[0,8] = {'sds':c}
+    t[1,1] = {'pps':ll, 'ppp':1-ll}
+    t[2,2] = {'pps':mm, 'ppp':1-mm}
+    t[3,3] = {'pps':nn, 'ppp':1-nn}
+    t[1,2] = {'pps':l*m, 'ppp':-l*m}
+    t[1,3] = {'pps':l*n, 'ppp':-l*n}
+    t[2,3] = {'pps':m*n, 'ppp':-m*n}
+    t[1,4] = {'pds':s3*ll*m, 'pdp':m*(1-2*ll)}
+    t[1,5] = {'pds':s3*l*m*n, 'pdp':-2*l*m*n}
+    t[1,6] = {'pds':s3*ll*n, 'pdp':n*(1-2*ll)}
+    t[2,4] = {'pds':s3*mm*l, 'pdp':l*(1-2*mm)}
+    t[2,5] = {'pds':s3*mm*n, 'pdp':n*(1-2*mm)}
+    t[2,6] = {'pds':s3*l*m*n, 'pdp':-2*l*m*n}
+    t[3,4] = {'pds':s3*l*m*n, 'pdp':-2*l*m*n}
+    t[3,5] = {'pds':s3*nn*m, 'pdp':m*(1-2*nn)}
+    t[3,6] = {'pds':s3*nn*l, 'pdp':l*(1-2*nn)}
+    t[1,7] = {'pds':0.5*s3*l*(ll-mm), 'pdp':l*(1-ll+mm)}
+    t[2,7] = {'pds':0.5*s3*m*(ll-mm), 'pdp':-m*(1+ll-mm)}
+    t[3,7] = {'pds':0.5*s3*n*(ll-mm), 'pdp':-n*(ll-mm)}
+    t[1,8] = {'pds':l*c, 'pdp':-s3*l*nn}
+    t[2,8] = {'pds':m*c, 'pdp':-s3*m*nn}
+    t[3,8] = {'pds':n*c, 'pdp':s3*n*(ll+mm)}
+    t[4,4] = {'dds':3*ll*mm, 'ddp':ll+mm-4*ll*mm, 'ddd':nn+ll*mm}
+    t[5,5] = {'dds':3*mm*nn, 'ddp':mm+nn-4*mm*nn, 'ddd':ll+mm*nn}
+    t[6,6] = {'dds':3*nn*ll, 'ddp':nn+ll-4*nn*ll, 'ddd':mm+nn*ll}
+    t[4,5] = {'dds':3*l*mm*n, 'ddp':l*n*(1-4*mm), 'ddd':l*n*(mm-1)}
+    t[4,6] = {'dds':3*ll*m*n, 'ddp':m*n*(1-4*ll), 'ddd':m*n*(ll-1)}
+    t[5,6] = {'dds':3*m*nn*l, 'ddp':m*l*(1-4*nn), 'ddd':m*l*(nn-1)}
+    t[4,7] = {'dds':1.5*l*m*(ll-mm), 'ddp':2*l*m*(mm-ll), 'ddd':0.5*l*m*(ll-mm)}
+    t[5,7] = {'dds':1.5*m*n*(ll-mm), 'ddp':-m*n*(1+2*(ll-mm)), 'ddd':m*n*(1+0.5*(ll-mm))}
+    t[6,7] = {'dds':1.5*n*l*(ll-mm), 'ddp':n*l*(1-2*(ll-mm)), 'ddd':-n*l*(1-0.5*(ll-mm))}
+    t[4,8] = {'dds':s3*l*m*c, 'ddp':-2*s3*l*m*nn, 'ddd':0.5*s3*l*m*(1+nn)}
+    t[5,8] = {'dds':s3*m*n*c, 'ddp':s3*m*n*(ll+mm-nn), 'ddd':-0.5*s3*m*n*(ll+mm)}
+    t[6,8] = {'dds':s3*l*n*c, 'ddp':s3*l*n*(ll+mm-nn), 'ddd':-0.5*s3*l*n*(ll+mm)}
+    t[7,7] = {'dds':0.75*(ll-mm)**2, 'ddp':ll+mm-(ll-mm)**2, 'ddd':nn+0.25*(ll-mm)**2}
+    t[7,8] = {'dds':0.5*s3*(ll-mm)*c, 'ddp':s3*nn*(mm-ll), 'ddd':0.25*s3*(1+nn)*(ll-mm)}
+    t[8,8] = {'dds':c**2, 'ddp':3*nn*(ll+mm), 'ddd':0.75*(ll+mm)**2}
+    return t
+
+
+# integrals with orbitals in reversed order (orbital of atom i first)
+reversed_integral = {'sps':'pss', 'sds':'dss', 'pds':'dps', 'pdp':'dpp'}
+
+def reference(rhat,noi,noj,h):
+    """ Return the block from the Slater-Koster table. """
+    t = sk_table(*rhat)
+    block = np.zeros((noi,noj))
+    for a in range(noi):
+        for b in range(noj):
+            for name, coeff in t[min(a,b),max(a,b)].items():
+                if a>b:
+                    name = reversed_integral.get(name,name)
+                block[a,b] += coeff*h[integrals[name]]
+    return block
+
+
+# hand-known blocks along the coordinate axes
+h = np.arange(1.0,15.0)
+for rhat, a, b, name in [ ([0,0,1], 3, 3, 'pps'), ([0,0,1], 1, 1, 'ppp'),
+                          ([1,0,0], 0, 1, 'sps'), ([1,0,0], 1, 0, 'pss'),
+                          ([0,1,0], 0, 1, None),  ([0,0,1], 8, 8, 'dds'),
+                          ([0,0,1], 6, 6, 'ddp'), ([0,0,1], 4, 4, 'ddd'),
+                          ([0,0,1], 3, 8, 'pds'), ([0,0,1], 1, 6, 'pdp'),
+                          ([0,0,1], 8, 0, 'dss'), ([1,0,0], 5, 5, 'ddd') ]:
+    ht = slako_transformations(np.array(rhat,dtype=float),1.0,9,9,h,h,np.zeros((14,3)),np.zeros((14,3)))[0]
+    expected = 0.0 if name is None else h[integrals[name]]
+    if debug:
+        print(rhat, a, b, name, ht[a,b], expected)
+    assert abs(ht[a,b]-expected)<TOL
+
+
+np.random.seed(1)
+for noi, noj in [ (1,1), (1,4), (4,1), (4,4), (1,9), (9,1), (4,9), (9,4), (9,9) ]:
+    r  = np.random.normal(size=(NPAIRS,3))
+    d  = np.sqrt( (r**2).sum(axis=1) )
+    h  = np.random.normal(size=(NPAIRS,14))
+    s  = np.random.normal(size=(NPAIRS,14))
+    dh = np.random.normal(size=(NPAIRS,14,3))
+    ds = np.random.normal(size=(NPAIRS,14,3))
+
+    ht, st, dht, dst = slako_transformations_batch(r/d.reshape(-1,1),d,noi,noj,h,s,dh,ds)
+
+    for p in range(NPAIRS):
+        assert np.abs(reference(r[p]/d[p],noi,noj,h[p])-ht[p]).max()<TOL
+        assert np.abs(reference(r[p]/d[p],noi,noj,s[p])-st[p]).max()<TOL
+
+        for a in range(3):
+            rp, rm = r[p].copy(), r[p].copy()
+            rp[a] += DX
+            rm[a] -= DX
+            # change of direction with fixed tables, and change of the tables
+            for x, dx, der in [ (h[p],dh[p],dht[p]), (s[p],ds[p],dst[p]) ]:
+                fd = ( reference(rp/np.linalg.norm(rp),noi,noj,x)
+                      -reference(rm/np.linalg.norm(rm),noi,noj,x) )/(2*DX)
+                fd += reference(r[p]/d[p],noi,noj,dx[:,a])
+                if debug:
+                    print(noi, noj, p, a, np.abs(fd-der[:,:,a]).max())
+                assert np.abs(fd-der[:,:,a]).max()<TOL_FD
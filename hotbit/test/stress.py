@@ -0,0 +1,36 @@
+#
+# Compare the analytic stress to finite differences of the energy
+# for a periodic methane crystal (band structure, Coulomb and repulsion).
+#
+
+from ase.build import molecule
+
+from hotbit import Hotbit
+from hotbit.test.misc import default_param
+from box.fd_forces import check_virial
+
+###
+
+TOL  = 1e-4
+
+###
+
+for charge_density in [ None, 'Gaussian', 'Slater' ]:
+    if charge_density is None:
+        print('    ... stress, no SCC')
+        calc = Hotbit(SCC=False, kpts=(2,2,2), txt='stress.cal',
+                      **default_param)
+    else:
+        print('    ... stress, SCC, charge density = %s' % charge_density)
+        calc = Hotbit(SCC=True, charge_density=charge_density, gamma_cut=3.0,
+                      kpts=(2,2,2), txt='stress.cal', **default_param)
+    atoms = molecule('CH4')
+    atoms.set_cell([[3.6,0.2,0.0],[0.0,3.5,0.3],[0.1,0.0,3.7]])
+    atoms.set_pbc(True)
+    atoms.rattle(0.03, seed=3)
+    atoms.set_calculator(calc)
+
+    sfd, s0, err = check_virial(atoms, de=1e-5)
+    if err > TOL:
+        raise RuntimeError('Stress and finite differences differ by %f eV/A^3.'
+                           % err)
@@ -8,6 +8,7 @@ tests = [
     'atom_dimer.py',
     'standard_set.py',
     'forces.py',
+    'stress.py',
     'external_field.py',
     'parametrization.py',
     'Au_chain.py',
@@ -20,8 +21,12 @@ tests = [
     'mulliken.py',
     'd-orbital_rotation_yaxis.py',
     'multipole_operations.py',
+    'slako_transformations.py',
+    'neighbors.py',
     'periodicity.py',
     'madelung_constants.py',
+    'parameter_bundle.py',
+    'parameter_file.py',
     'mio.py']
 
        